@@ -6,6 +6,8 @@ itineraries and to compute fare matrices.
 
 """
 
+import argparse
+import multiprocessing
 import os
 
 import geopandas
@@ -17,11 +19,19 @@ DATA_FOLDER = "/home/willem/Documents/Project/TED/data/"
 REGION = "BOS"
 TYPE = "limited"
 YEAR = "2023"
+WORKERS = max(multiprocessing.cpu_count() - 2, 1)
 # GTFS_DATE = "2020-02-24"
 # GTFS_DATE = "2023-09-25"
 # START_DATETIME = datetime.datetime(2020, 2, 26, 8)
 # START_DATETIME = datetime.datetime(2023, 9, 27, 8)
 
+parser = argparse.ArgumentParser(description="Generate fare itineraries and matrices")
+parser.add_argument(
+    "--retry-failed",
+    action="store_true",
+    help="only re-query the OTP pairs that came back without an itinerary",
+)
+
 ############################
 #       FARE ANALYSIS      #
 ############################
@@ -104,9 +114,10 @@ YEAR = "2023"
 #     )
 # )
 
+# Chunks already listed in the folder's job manifest are kept, so a rerun
+# resumes where the last one stopped
 # chunk_folder = f"../chunks/{REGION}"
-# for f in os.listdir(chunk_folder):
-#     os.remove(os.path.join(chunk_folder, f))
+# os.makedirs(chunk_folder, exist_ok=True)
 
 # run_otp_itineraries_from_pairs_list(
 #     fares_yaml=f"/home/willem/Documents/Project/TED/otp/{REGION}-{GTFS_DATE}-{TYPE}/config.yaml",
@@ -116,6 +127,7 @@ YEAR = "2023"
 #     output_folder=chunk_folder,
 #     region_key=REGION,
 #     chunk_size=50,
+#     retry_failed=args.retry_failed,
 # )
 
 # dechunkify(
@@ -138,9 +150,10 @@ YEAR = "2023"
 #     ),
 # )
 
-############ Compute a fare matrix from the fares
-df = pandas.read_parquet(
-    os.path.join(
+
+def main():
+    ############ Compute a fare matrix from the fares
+    itineraries = os.path.join(
         DATA_FOLDER,
         "region",
         REGION,
@@ -148,44 +161,37 @@ df = pandas.read_parquet(
         YEAR,
         f"itineraries_{YEAR}_{TYPE}.parquet",
     )
-).rename(columns={"mode": "transport_mode"})
-
-pairs = df.drop_duplicates(subset=["from_id", "to_id"])
-
-fares = {"from_id": [], "to_id": [], "fare_cost": []}
+    df = pandas.read_parquet(itineraries)
+
+    print("Making Fare Matrix")
+    fare_db = f"/home/willem/Documents/Project/TED/data/region/{REGION}/fare/{YEAR}/{REGION}{YEAR[-2:]}.db"
+    print("DB:", fare_db)
+    df["feed"] = df["feed"].str.replace("gtfs-", "")
+    df["feed"] = df["feed"].str.replace(
+        "california-golden-gate-ferry-0", "california-blue-gold-fleet-1178"
+    )
+    # The workers read their origins from disk, so the renamed feeds go there too
+    itineraries = itineraries.replace(".parquet", "_feeds.parquet")
+    df.to_parquet(itineraries)
+    del df
+
+    make_fare_matrix_from_itineraries(
+        itineraries,
+        f"/home/willem/Documents/Project/TED/data/region/{REGION}/fare/{YEAR}/fare_matrix_{YEAR}_{TYPE}.parquet",
+        fare_db,
+        REGION,
+        workers=WORKERS,
+    )
 
-print("Making Fare Matrix")
-fare_db = f"/home/willem/Documents/Project/TED/data/region/{REGION}/fare/{YEAR}/{REGION}{YEAR[-2:]}.db"
-print("DB:", fare_db)
-df["feed"] = df["feed"].str.replace("gtfs-", "")
-df["feed"] = df["feed"].str.replace(
-    "california-golden-gate-ferry-0", "california-blue-gold-fleet-1178"
-)
+    # ########## Map the fare matrix to the block groups
+    map_fare_matrix_to_bg(
+        f"../data/region/{REGION}/fare/{YEAR}/fare_matrix_{YEAR}_{TYPE}.parquet",
+        f"../data/region/{REGION}/fare/BG20_cluster.csv",
+        f"../data/region/{REGION}/{REGION}.gpkg",
+        f"../data/region/{REGION}/fare/{YEAR}/fare_matrix_{YEAR}_{TYPE}_BG20.parquet",
+    )
 
-for idx, pair in tqdm(pairs.iterrows(), total=pairs.shape[0]):
-    sub_df = df[(df.from_id == pair["from_id"]) & (df.to_id == pair["to_id"])].copy()
-    if sub_df.shape[0] > 1:
-        it = Itinerary(
-            sub_df,
-            REGION,
-            fare_db,
-        )
-        it.clean()
-        it.make_legs()
-        fares["from_id"].append(pair["from_id"])
-        fares["to_id"].append(pair["to_id"])
-        fares["fare_cost"].append(it.compute_fare())
-
-fare_df = pandas.DataFrame(fares)
-fare_df.to_csv(
-    f"/home/willem/Documents/Project/TED/data/region/{REGION}/fare/{YEAR}/fare_matrix_{YEAR}_{TYPE}.csv",
-    index=False,
-)
 
-# ########## Map the fare matrix to the block groups
-map_fare_matrix_to_bg(
-    f"../data/region/{REGION}/fare/{YEAR}/fare_matrix_{YEAR}_{TYPE}.csv",
-    f"../data/region/{REGION}/fare/BG20_cluster.csv",
-    f"../data/region/{REGION}/{REGION}.gpkg",
-    f"../data/region/{REGION}/fare/{YEAR}/fare_matrix_{YEAR}_{TYPE}_BG20.parquet",
-)
+if __name__ == "__main__":
+    args = parser.parse_args()
+    main()
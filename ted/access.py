@@ -0,0 +1,313 @@
+"""Access to opportunity measures over dense block group matrices
+
+This module computes cumulative opportunity measures from a `DenseMatrix` of
+travel times. Rather than scanning the matrix once per cutoff, each block of
+origins is binned into a per-minute histogram of the supply it reaches, and the
+running sum of the histogram gives the access at every cutoff at once."""
+
+import functools
+import os
+
+import numpy
+import pandas
+
+from .matrix import DenseMatrix, open_dense_matrix
+
+#: The longest travel time of the access curves (minutes)
+ACCESS_CURVE_MINUTES = 180
+#: The number of matrix cells binned at a time
+ACCESS_BLOCK_CELLS = 4000000
+
+
+def access_curves(
+    matrix: DenseMatrix,
+    supply: pandas.DataFrame,
+    supply_columns: list,
+    minutes: int = ACCESS_CURVE_MINUTES,
+    mask=None,
+) -> dict:
+    """Compute the opportunities within every whole minute of each origin
+
+    Parameters
+    ----------
+    matrix : DenseMatrix
+        The travel time matrix, in whole minutes
+    supply : pandas.DataFrame
+        The opportunities, indexed by block group
+    supply_columns : list
+        The supply columns to compute curves for
+    minutes : int, optional
+        The longest travel time of the curves, by default `ACCESS_CURVE_MINUTES`
+    mask : numpy.ndarray, optional
+        A boolean array of the matrix's shape marking the pairs that may count
+        towards access, by default None (all pairs)
+
+    Returns
+    -------
+    dict
+        For each supply column, an origins by `minutes + 1` array whose column
+        `t` is the supply within `t` minutes of each origin
+    """
+    size = len(matrix)
+    weights = (
+        supply[supply_columns]
+        .reindex(matrix.index)
+        .fillna(0)
+        .to_numpy(dtype=numpy.float64)
+    )
+    # Travel times beyond the curve and masked pairs fall into an overflow bin
+    overflow = minutes + 1
+    curves = {c: numpy.zeros((size, minutes + 1)) for c in supply_columns}
+    step = max(ACCESS_BLOCK_CELLS // max(size, 1), 1)
+    for first in range(0, size, step):
+        last = min(first + step, size)
+        bins = numpy.minimum(matrix.values[first:last], overflow).astype(numpy.intp)
+        if mask is not None:
+            bins[~numpy.asarray(mask[first:last], dtype=bool)] = overflow
+        bins += numpy.arange(last - first)[:, None] * (overflow + 1)
+        bins = bins.ravel()
+        for idx, c in enumerate(supply_columns):
+            histogram = numpy.bincount(
+                bins,
+                weights=numpy.broadcast_to(
+                    weights[:, idx], (last - first, size)
+                ).ravel(),
+                minlength=(last - first) * (overflow + 1),
+            ).reshape(last - first, overflow + 1)
+            numpy.cumsum(histogram[:, :overflow], axis=1, out=curves[c][first:last])
+    return curves
+
+
+def cumulative_access(
+    matrix: DenseMatrix,
+    supply: pandas.DataFrame,
+    measures: dict,
+    suffix: str = "",
+    mask=None,
+) -> pandas.DataFrame:
+    """Compute cumulative opportunity measures for several cutoffs in one pass
+
+    The results match `traccess.AccessComputer.cumulative_cutoff` with a
+    `travel_time <= cutoff` condition for each cutoff.
+
+    Parameters
+    ----------
+    matrix : DenseMatrix
+        The travel time matrix, in whole minutes
+    supply : pandas.DataFrame
+        The opportunities, indexed by block group
+    measures : dict
+        The supply columns to compute at each cutoff, e.g. `{30: ["C000"]}`
+    suffix : str, optional
+        A suffix for the column names, by default ""
+    mask : numpy.ndarray, optional
+        A boolean array of the matrix's shape marking the pairs that may count
+        towards access, by default None (all pairs)
+
+    Returns
+    -------
+    pandas.DataFrame
+        A `{supply column}_c{cutoff}{suffix}` column for each measure, indexed
+        by from_id
+    """
+    supply_columns = list(dict.fromkeys(c for cs in measures.values() for c in cs))
+    curves = access_curves(
+        matrix, supply, supply_columns, minutes=max(measures), mask=mask
+    )
+    return pandas.DataFrame(
+        {
+            f"{c}_c{cutoff}{suffix}": curves[c][:, cutoff]
+            for cutoff, columns in measures.items()
+            for c in columns
+        },
+        index=matrix.index.rename("from_id"),
+    )
+
+
+def closest_access(
+    matrix: DenseMatrix,
+    supply: pandas.DataFrame,
+    measures: dict,
+    suffix: str = "",
+) -> pandas.DataFrame:
+    """Compute the travel time to the nth closest opportunity of several kinds
+
+    Each block of origins is swept once per supply column, partitioning the
+    destinations that hold any of the supply to keep only the nearest few. A
+    destination holding several opportunities counts each of them, so the
+    third closest grocery store can be in the same block group as the first.
+    The results match `traccess.AccessComputer.cost_to_closest`.
+
+    Parameters
+    ----------
+    matrix : DenseMatrix
+        The travel time matrix
+    supply : pandas.DataFrame
+        The opportunities, indexed by block group
+    measures : dict
+        The supply columns to compute for each n, e.g. `{1: ["grocery"]}`
+    suffix : str, optional
+        A suffix for the column names, by default ""
+
+    Returns
+    -------
+    pandas.DataFrame
+        A `{supply column}_t{n}{suffix}` column for each measure, indexed by
+        from_id, which is NaN where fewer than n opportunities are reachable
+    """
+    size = len(matrix)
+    counts = {}
+    for n, columns in measures.items():
+        for c in columns:
+            counts.setdefault(c, []).append(n)
+    results = {(c, n): numpy.full(size, numpy.nan) for c in counts for n in counts[c]}
+    step = max(ACCESS_BLOCK_CELLS // max(size, 1), 1)
+    for c, ns in counts.items():
+        weights = supply[c].reindex(matrix.index).fillna(0).to_numpy()
+        destinations = numpy.flatnonzero(weights > 0)
+        weights = weights[destinations]
+        if destinations.size == 0:
+            continue
+        # With at least one opportunity per destination, the nth closest is
+        # among the n closest destinations
+        k = destinations.size
+        if (weights >= 1).all():
+            k = min(max(ns), k)
+        for first in range(0, size, step):
+            last = min(first + step, size)
+            times = matrix.values[first:last][:, destinations]
+            if k < destinations.size:
+                nearest = numpy.argpartition(times, k - 1, axis=1)[:, :k]
+            else:
+                nearest = numpy.broadcast_to(numpy.arange(k), times.shape)
+            times = numpy.take_along_axis(times, nearest, axis=1)
+            order = numpy.argsort(times, axis=1, kind="stable")
+            times = numpy.take_along_axis(times, order, axis=1)
+            reached = numpy.cumsum(
+                weights[numpy.take_along_axis(nearest, order, axis=1)], axis=1
+            )
+            rows = numpy.arange(last - first)
+            for n in ns:
+                position = numpy.argmax(reached >= n, axis=1)
+                found = reached[:, -1] >= n
+                cost = times[rows, position].astype(numpy.float64)
+                cost[~found | (cost == matrix.sentinel)] = numpy.nan
+                results[(c, n)][first:last] = cost
+    return pandas.DataFrame(
+        {
+            f"{c}_t{n}{suffix}": results[(c, n)]
+            for n, columns in measures.items()
+            for c in columns
+        },
+        index=matrix.index.rename("from_id"),
+    )
+
+
+class AccessContext:
+    """The matrices of one run, opened and aligned to the region's block groups once
+
+    Every measure of a run, including the fare-constrained ones of each fare
+    year, is computed against the same memory-mapped matrices and the same
+    aligned supply, so the access stage reads each matrix once per run.
+
+    Parameters
+    ----------
+    index : pandas.Index
+        The block group index of the region
+    supply : pandas.DataFrame
+        The opportunities, indexed by block group
+    matrices : dict
+        The travel time `DenseMatrix` of each network, e.g. "full" or "auto"
+    """
+
+    def __init__(self, index: pandas.Index, supply: pandas.DataFrame, matrices: dict):
+        self.index = index
+        self.supply = supply.reindex(index).fillna(0)
+        self.matrices = {
+            network: matrix.reindex(index) for network, matrix in matrices.items()
+        }
+
+    @classmethod
+    def open(
+        cls,
+        run_folder: str,
+        index: pandas.Index,
+        supply: pandas.DataFrame,
+        auto_parquet: str = None,
+    ) -> "AccessContext":
+        """Open the full and limited matrices of a run folder, and an auto matrix
+
+        Parameters
+        ----------
+        run_folder : str
+            The folder holding full_matrix.parquet and limited_matrix.parquet
+        index : pandas.Index
+            The block group index of the region
+        supply : pandas.DataFrame
+            The opportunities, indexed by block group
+        auto_parquet : str, optional
+            The auto travel time matrix of the run, by default None
+
+        Returns
+        -------
+        AccessContext
+            The context, with "full", "limited" and "auto" matrices
+        """
+        parquets = {
+            "full": os.path.join(run_folder, "full_matrix.parquet"),
+            "limited": os.path.join(run_folder, "limited_matrix.parquet"),
+            "auto": auto_parquet,
+        }
+        return cls(
+            index,
+            supply,
+            {
+                network: open_dense_matrix(parquet, index)
+                for network, parquet in parquets.items()
+                if parquet is not None and os.path.exists(parquet)
+            },
+        )
+
+    def cumulative(
+        self, network: str, measures: dict, suffix: str = "", mask=None
+    ) -> pandas.DataFrame:
+        """Compute `cumulative_access` over one network"""
+        return cumulative_access(
+            self.matrices[network], self.supply, measures, suffix, mask
+        )
+
+    def closest(
+        self, network: str, measures: dict, suffix: str = ""
+    ) -> pandas.DataFrame:
+        """Compute `closest_access` over one network"""
+        return closest_access(self.matrices[network], self.supply, measures, suffix)
+
+    def fare_constrained(
+        self, masks: dict, measures: dict, suffix: str = ""
+    ) -> pandas.DataFrame:
+        """Compute the best cumulative access of several networks under fare masks
+
+        Parameters
+        ----------
+        masks : dict
+            The fare mask of each network, e.g. `{"full": ..., "limited": ...}`
+        measures : dict
+            The supply columns to compute at each cutoff
+        suffix : str, optional
+            A suffix for the column names, by default ""
+
+        Returns
+        -------
+        pandas.DataFrame
+            The largest access of any of the networks for each measure
+        """
+        for mask in masks.values():
+            if not mask.index.equals(self.index):
+                raise ValueError("The fare masks must be on the region's index")
+        return functools.reduce(
+            numpy.maximum,
+            [
+                self.cumulative(network, measures, suffix, mask)
+                for network, mask in masks.items()
+            ],
+        )
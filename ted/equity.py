@@ -0,0 +1,100 @@
+"""Demographic equity summaries of access measures
+
+This module computes the demographic-weighted average of every access measure
+for several areas of a region at once. The demographic counts of each area are
+normalised into weights, and a single matrix product of the weights with the
+access table gives every group, measure and area in one step."""
+
+import numpy
+import pandas
+from pygris.helpers import validate_county
+
+
+def weighted_averages(
+    access: pandas.DataFrame, demographics: pandas.DataFrame, areas: dict
+) -> pandas.DataFrame:
+    """Compute the demographic-weighted average access of several areas
+
+    For each area, this matches `traccess.EquityComputer.weighted_average` run
+    on every access column over the block groups of the area: block groups
+    without demographic data carry no weight, and missing access values count
+    as zero.
+
+    Parameters
+    ----------
+    access : pandas.DataFrame
+        The access measures, indexed by block group
+    demographics : pandas.DataFrame
+        The population of each demographic group, indexed by block group
+    areas : dict
+        The block groups of each area, by area name, with None for all of them
+
+    Returns
+    -------
+    pandas.DataFrame
+        A row for each demographic group of each area, indexed by demographic,
+        with a column for each access measure and an area column
+    """
+    counts = demographics.reindex(access.index).fillna(0).to_numpy(dtype=numpy.float64)
+    values = numpy.nan_to_num(access.to_numpy(dtype=numpy.float64))
+    masks = numpy.stack(
+        [
+            (
+                numpy.ones(access.shape[0], dtype=bool)
+                if bgs is None
+                else access.index.isin(bgs)
+            )
+            for bgs in areas.values()
+        ]
+    )
+    # The share of each group living in each block group, by area
+    weights = masks[:, :, None] * counts[None, :, :]
+    totals = weights.sum(axis=1, keepdims=True)
+    weights = numpy.divide(
+        weights, totals, out=numpy.zeros_like(weights), where=totals > 0
+    )
+    averages = weights.transpose(0, 2, 1).reshape(-1, access.shape[0]) @ values
+
+    summary = pandas.DataFrame(
+        averages,
+        index=pandas.Index(
+            numpy.tile(demographics.columns, len(areas)), name="demographic"
+        ),
+        columns=access.columns,
+    )
+    summary["area"] = numpy.repeat(list(areas), demographics.shape[1])
+    return summary
+
+
+def county_areas(bg_ids, counties: list) -> dict:
+    """Find the block groups of each county of a region
+
+    Counties are matched by name in every state the block groups fall in, using
+    the state and county FIPS codes that lead each block group GEOID.
+
+    Parameters
+    ----------
+    bg_ids : list
+        The block group GEOIDs of the region
+    counties : list
+        The county names, e.g. `["King", "Pierce"]`
+
+    Returns
+    -------
+    dict
+        The block groups of each county, by county name
+    """
+    bg_ids = pandas.Index(bg_ids)
+    states = sorted(bg_ids.str[:2].unique())
+    areas = {}
+    for county in counties:
+        prefixes = []
+        for state in states:
+            try:
+                prefixes.append(state + validate_county(state, county, quiet=True))
+            except ValueError:
+                continue
+        if len(prefixes) == 0:
+            raise ValueError(f"No county named {county} in states {states}")
+        areas[county] = bg_ids[bg_ids.str[:5].isin(prefixes)]
+    return areas
@@ -1,16 +1,15 @@
+import collections
 import datetime
-import itertools
 import json
 import logging
 import multiprocessing
 import os
-import requests
-from pytz import timezone
-import time
 
 import geopandas
 import numpy
 import pandas
+import pyarrow
+import pyarrow.parquet
 from tqdm import tqdm
 import sqlite3
 import yaml
@@ -18,12 +17,34 @@ import yaml
 
 import r5py
 
-from .exception import NoExistingFareError
+from .exception import FareNotFoundError, NoExistingFareError
+from .matrix import DenseMatrix, read_region_index
+from .run import ACCESS_CUTOFFS
+from .otp import (
+    OTPQuery,
+    dechunkify,
+    run_otp_itineraries_from_pairs_list,
+    run_otp_itineraries_in_parallel,
+)
 
 logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.INFO)
 
 INFINITE_INT = 100000
 MAX_FARE_TRAVEL_TIME = 180
+#: The number of itinerary fares kept by the fare cache
+FARE_CACHE_SIZE = 250000
+#: The number of fare matrix rows buffered before they are flushed to disk
+FARE_FLUSH_ROWS = 500000
+#: The number of origin shards each fare worker gets, to even out the load
+FARE_SHARDS_PER_WORKER = 4
+#: The walking radius in meters within which stops serve a cluster
+FARE_CLASS_STOP_RADIUS = 800
+#: The width in minutes of the travel time bands that split fare classes
+FARE_CLASS_TIME_BAND = 30
+#: The share of reduced pairs still queried to validate the reduction
+FARE_CLASS_VALIDATION_SHARE = 0.01
+#: The minutes beyond the largest access cutoff within which pairs are kept
+FARE_PRUNE_SLACK = 30
 WALK_MODE = "WALK"
 
 TRANSFER_DISCOUNT = "transfer-discount"
@@ -204,7 +225,29 @@ def run_r5_on_clusters(
     osm_file: str,
     departure: datetime,
     output_file,
+    cutoffs=ACCESS_CUTOFFS,
+    slack=FARE_PRUNE_SLACK,
 ):
+    """Find the cluster pairs reachable by transit and write them to a CSV
+
+    Parameters
+    ----------
+    clusters : geopandas.GeoDataFrame
+        The clusters to route between
+    gtfs_folder : str
+        The folder holding the GTFS feeds
+    osm_file : str
+        The OSM extract of the region
+    departure : datetime
+        The start of the departure time window
+    output_file : str
+        The CSV the from_id, to_id and travel_time of the pairs are written to
+    cutoffs : list, optional
+        The access cutoffs the pairs are pruned to, by default `ACCESS_CUTOFFS`.
+        Pass None to keep every pair within the 180 minute routing limit.
+    slack : int, optional
+        The minutes kept beyond the largest cutoff, by default `FARE_PRUNE_SLACK`
+    """
     print("-> Running R5py on clusters <-")
     print("  GTFS Folder:", gtfs_folder)
     print("  OSM File:", osm_file)
@@ -232,21 +275,278 @@ def run_r5_on_clusters(
     # Actually compute the travel times
     mx = computer.compute_travel_times()
     mx = mx.dropna(subset="travel_time")
+    if cutoffs is not None:
+        mx = prune_fare_pairs(mx, cutoffs, slack)
     # Dump it into a folder
-    mx[["from_id", "to_id"]].to_csv(output_file, index=False)
+    mx[["from_id", "to_id", "travel_time"]].to_csv(output_file, index=False)
+
+
+def prune_fare_pairs(
+    pairs: pandas.DataFrame, cutoffs=ACCESS_CUTOFFS, slack=FARE_PRUNE_SLACK
+) -> pandas.DataFrame:
+    """Drop the pairs too far apart to count towards any fare-constrained measure
+
+    A pair only enters a cumulative access measure when its travel time is
+    within a cutoff, so pairs slower than the largest cutoff can never change a
+    fare-constrained output. The `slack` keeps pairs whose OTP itinerary may
+    still come in faster than the r5 travel time, and the limit never exceeds
+    `MAX_FARE_TRAVEL_TIME`, past which itineraries are dropped anyway.
+
+    Parameters
+    ----------
+    pairs : pandas.DataFrame
+        The pairs, with from_id, to_id and travel_time columns
+    cutoffs : list, optional
+        The access cutoffs in minutes, by default `ACCESS_CUTOFFS`
+    slack : int, optional
+        The minutes kept beyond the largest cutoff, by default `FARE_PRUNE_SLACK`
+
+    Returns
+    -------
+    pandas.DataFrame
+        The pairs within the limit
+    """
+    if "travel_time" not in pairs.columns:
+        logging.warning("No travel_time column, the pairs cannot be pruned")
+        return pairs
+    limit = min(max(cutoffs) + slack, MAX_FARE_TRAVEL_TIME)
+    kept = pairs[pairs["travel_time"] <= limit]
+    skipped = pairs.shape[0] - kept.shape[0]
+    print("  Pruning pairs beyond", limit, "minutes")
+    print(f"    Kept:    {kept.shape[0]:>12,}")
+    print(f"    Skipped: {skipped:>12,} ({skipped / max(pairs.shape[0], 1):.1%})")
+    return kept
+
+
+def cluster_fare_profiles(
+    clusters: pandas.DataFrame,
+    stops: geopandas.GeoDataFrame,
+    db,
+    radius=FARE_CLASS_STOP_RADIUS,
+) -> pandas.Series:
+    """Group clusters by the fare zones and feeds of the stops around them
+
+    Every stop within `radius` meters of a cluster's centre contributes its feed
+    and, for zone based feeds, its fare zone. Clusters reached by the same set
+    of feeds and zones can only board and alight in the same fare situations,
+    so they get the same profile.
+
+    Parameters
+    ----------
+    clusters : pandas.DataFrame
+        The clusters, with CLUSTER_ID, MEAN_X and MEAN_Y columns
+    stops : geopandas.GeoDataFrame
+        The stops, as returned by `ted.gtfs.get_all_stops`
+    db : str or FareRuleSet
+        The fare database or its loaded rule set
+    radius : float, optional
+        The walking radius in meters, by default `FARE_CLASS_STOP_RADIUS`
+
+    Returns
+    -------
+    pandas.Series
+        The integer fare profile of each cluster, indexed by CLUSTER_ID
+    """
+    rules = get_fare_rules(db)
+    points = geopandas.GeoDataFrame(
+        clusters[["CLUSTER_ID"]],
+        geometry=geopandas.points_from_xy(clusters.MEAN_X, clusters.MEAN_Y),
+        crs="EPSG:4326",
+    )
+    crs = points.estimate_utm_crs()
+    points = points.to_crs(crs)
+    points.geometry = points.geometry.buffer(radius)
+
+    stops = stops[["stop_id", "agency", "geometry"]].to_crs(crs)
+    stops["feed"] = stops["agency"].str.replace("^gtfs-", "", regex=True)
+    tokens = []
+    for feed, stop_id in zip(stops.feed, stops.stop_id):
+        fare_type = rules.fare_types.get(feed)
+        if fare_type is not None and fare_type[0] == "zone":
+            tokens.append(f"{feed}:{rules.zones.get((feed, stop_id), stop_id)}")
+        else:
+            tokens.append(feed)
+    stops["token"] = tokens
+
+    joined = points.sjoin(stops[["token", "geometry"]])
+    profiles = joined.groupby("CLUSTER_ID")["token"].agg(
+        lambda t: "|".join(sorted(set(t)))
+    )
+    profiles = profiles.reindex(clusters.CLUSTER_ID).fillna("")
+    codes, _ = pandas.factorize(profiles, sort=True)
+    return pandas.Series(codes, index=profiles.index, name="profile")
+
+
+class FarePairReduction:
+    """Reduce a list of pairs to one representative per fare-equivalence class
+
+    Pairs are grouped by the fare profiles of their origin and destination (see
+    `cluster_fare_profiles`) and, when the pairs carry an r5 `travel_time`, by
+    travel time band, since the time between boardings decides whether
+    transfers are still valid. Only one representative pair per class goes to
+    OTP, along with a random validation sample of the other pairs, and the
+    representatives' fares are then copied to the rest of their class.
+
+    Parameters
+    ----------
+    pairs : pandas.DataFrame
+        The pairs, with from_id and to_id and optionally travel_time columns
+    profiles : pandas.Series
+        The fare profile of each cluster, from `cluster_fare_profiles`
+    validation_share : float, optional
+        The share of non-representative pairs to query anyway, to measure the
+        error of the reduction, by default `FARE_CLASS_VALIDATION_SHARE`
+    time_band : float, optional
+        The width in minutes of the travel time bands, by default
+        `FARE_CLASS_TIME_BAND`
+    seed : int, optional
+        The seed of the validation sample, by default 0
+    """
+
+    def __init__(
+        self,
+        pairs: pandas.DataFrame,
+        profiles: pandas.Series,
+        validation_share=FARE_CLASS_VALIDATION_SHARE,
+        time_band=FARE_CLASS_TIME_BAND,
+        seed=0,
+    ):
+        df = pairs.sort_values(["from_id", "to_id"]).reset_index(drop=True)
+        df["from_profile"] = df["from_id"].map(profiles).fillna(-1)
+        df["to_profile"] = df["to_id"].map(profiles).fillna(-1)
+        keys = ["from_profile", "to_profile"]
+        if "travel_time" in df.columns:
+            df["time_band"] = (df["travel_time"] // time_band).fillna(-1)
+            keys.append("time_band")
+        df["class_id"] = df.groupby(keys, sort=False).ngroup()
+
+        first = ~df["class_id"].duplicated()
+        self.pairs = df[["from_id", "to_id", "class_id"]]
+        self.representatives = self.pairs[first]
+        others = self.pairs[~first]
+        self.validation = others.sample(
+            n=int(round(others.shape[0] * validation_share)), random_state=seed
+        ).sort_index()
+
+    def __repr__(self) -> str:
+        return f"<FarePairReduction {self.pairs.shape[0]} pairs | {self.representatives.shape[0]} classes | {self.query_pairs.shape[0]} to query>"
+
+    @property
+    def query_pairs(self) -> pandas.DataFrame:
+        """The representative and validation pairs to send to OTP"""
+        return pandas.concat([self.representatives, self.validation]).sort_index()[
+            ["from_id", "to_id"]
+        ]
+
+    def expand(self, fare_matrix: pandas.DataFrame) -> pandas.DataFrame:
+        """Spread the representatives' fares over every pair in their class
+
+        Pairs that were queried themselves keep their own fare.
+
+        Parameters
+        ----------
+        fare_matrix : pandas.DataFrame
+            The fares of the queried pairs, with from_id, to_id and fare_cost
+
+        Returns
+        -------
+        pandas.DataFrame
+            The fares of every pair the representatives found a fare for
+        """
+        fares = fare_matrix[["from_id", "to_id", "fare_cost"]]
+        class_fares = pandas.merge(self.representatives, fares, on=["from_id", "to_id"])
+        df = pandas.merge(
+            self.pairs,
+            class_fares[["class_id", "fare_cost"]],
+            on="class_id",
+            how="left",
+        )
+        df = pandas.merge(
+            df, fares, on=["from_id", "to_id"], how="left", suffixes=["", "_own"]
+        )
+        df["fare_cost"] = df["fare_cost_own"].combine_first(df["fare_cost"])
+        df = df[df["fare_cost"].notna()]
+        df["fare_cost"] = df["fare_cost"].astype(numpy.int64)
+        return df[["from_id", "to_id", "fare_cost"]].reset_index(drop=True)
+
+    def report(self, fare_matrix: pandas.DataFrame) -> pandas.Series:
+        """Measure the coverage and error of the reduction
+
+        Parameters
+        ----------
+        fare_matrix : pandas.DataFrame
+            The fares of the queried pairs, with from_id, to_id and fare_cost
+
+        Returns
+        -------
+        pandas.Series
+            The pair, class and query counts, the query reduction factor, the
+            share of pairs that get a fare, and the share of validation pairs
+            whose propagated fare matches their own along with the mean and
+            maximum absolute error in cents
+        """
+        fares = fare_matrix[["from_id", "to_id", "fare_cost"]]
+        class_fares = pandas.merge(self.representatives, fares, on=["from_id", "to_id"])
+        validation = pandas.merge(self.validation, fares, on=["from_id", "to_id"])
+        validation = pandas.merge(
+            validation,
+            class_fares[["class_id", "fare_cost"]],
+            on="class_id",
+            suffixes=["", "_class"],
+        )
+        error = (validation["fare_cost"] - validation["fare_cost_class"]).abs()
+        covered = self.pairs["class_id"].isin(class_fares["class_id"])
+        return pandas.Series(
+            {
+                "pairs": self.pairs.shape[0],
+                "classes": self.representatives.shape[0],
+                "queried": self.query_pairs.shape[0],
+                "reduction": self.pairs.shape[0] / max(self.query_pairs.shape[0], 1),
+                "coverage": covered.mean(),
+                "validated": validation.shape[0],
+                "exact": (error == 0).mean() if error.shape[0] > 0 else numpy.nan,
+                "mean_error": error.mean(),
+                "max_error": error.max(),
+            }
+        )
 
 
 class Itinerary:
     def __init__(
         self, itinerary_df: pandas.DataFrame, region: str, db, verbose: bool = False
     ):
-        self._df = itinerary_df.sort_values("segment")
+        self._df = None
+        if itinerary_df is not None:
+            self._df = itinerary_df.sort_values("segment")
+            self._df.departure_time = pandas.to_datetime(self._df.departure_time)
         self.region = region
-        self._df.departure_time = pandas.to_datetime(self._df.departure_time)
         self._legs = []
         self._fares = []
         self.verbose = verbose
         self.db = db
+        self.rules = get_fare_rules(db)
+
+    @classmethod
+    def from_legs(cls, legs: list, region: str, db, verbose: bool = False):
+        """Create an itinerary directly from a linked list of transit legs
+
+        Parameters
+        ----------
+        legs : list[TransitLeg]
+            The transit legs in travel order, already linked together
+        region : str
+            The region key string (e.g. WAS)
+        db : str or FareRuleSet
+            The fare database or its loaded rule set
+
+        Returns
+        -------
+        Itinerary
+            An itinerary ready for `compute_fare`
+        """
+        it = cls(None, region, db, verbose)
+        it._legs = list(legs)
+        return it
 
     def clean(self):
         # Check that the first row is "walking"
@@ -301,31 +601,12 @@ class Itinerary:
             self.update_fare_times(current_time)
 
             # Let's find out if the next leg is already covered by the existing fares
-            df = from_leg.transfers[from_leg.transfers.to_mdb_slug == to_leg.feed]
-
-            # Now we need to filter out rules specifically
-            # First we check for an __ANY__ condition as that covers all routes
-            from_df = df[df.from_route_id == "__ANY__"]
-            if from_df.shape[0] == 0:
-                # Next, we check for a specific route ID
-                from_df = df[df.from_route_id == from_leg.route_id]
-
-                if from_df.shape[0] == 0:
-                    # Finally, we check for an __ELSE__ key
-                    from_df = df[df.from_route_id == "__ELSE__"]
-
-            # Now we check for the route we are transferring to
-            to_df = from_df[from_df.to_route_id == "__ANY__"]
-            if to_df.shape[0] == 0:
-                # Next, we check for a specific route ID
-                to_df = from_df[from_df.from_route_id == from_leg.route_id]
-                if to_df.shape[0] == 0:
-                    # Finally, we check for an __ELSE__ key
-                    to_df = from_df[from_df.from_route_id == "__ELSE__"]
-
-            if to_df.shape[0] > 0:
-                # We have some kind of rule, let's apply the first one we find (should just be one)
-                tfr = to_df.iloc[0]
+            tfr = self.rules.transfer_rule(
+                from_leg.feed, to_leg.feed, from_leg.route_id
+            )
+
+            if tfr is not None:
+                # We have some kind of rule, let's apply it
                 # For a transfer discount, we want to apply it
                 if tfr.transfer_type == "transfer-discount":
                     # Let's apply a discount to the next route's fare
@@ -397,15 +678,12 @@ class Itinerary:
 
     def get_new_fare(self, leg):
         # Let's start by retrieving the fare
-        sql = f"""
-        SELECT fare_type.fare_type, fare_type.transfers_allowed, fare_type.fare_duration 
-        FROM fare_type
-        WHERE fare_type.mdb_slug = "{leg.feed}"
-        """
-        res = execute_sql(sql, self.db)[0]
+        fare_type, transfers_allowed, fare_duration = self.rules.fare_type(leg.feed)
 
-        if res[0] == "flat":
-            fare = FixedFare(leg.departure_time, res[1], res[2], leg.feed, self.db)
+        if fare_type == "flat":
+            fare = FixedFare(
+                leg.departure_time, transfers_allowed, fare_duration, leg.feed, self.db
+            )
             rf = self.get_route_fare_cost(leg)
             if rf is not None:
                 fare.cost = rf
@@ -418,8 +696,8 @@ class Itinerary:
             start_zone, end_zone = self.get_zones_from_leg(leg)
             fare = ZoneFare(
                 start_time=leg.departure_time,
-                max_transfers=res[1],
-                max_time=res[2],
+                max_transfers=transfers_allowed,
+                max_time=fare_duration,
                 feed=leg.feed,
                 db=self.db,
                 route_id=leg.route_id,
@@ -431,27 +709,8 @@ class Itinerary:
         return fare
 
     def get_zones_from_leg(self, leg):
-        sql = f"""
-        SELECT zone_id
-        FROM "zone"
-        where "zone".mdb_slug = '{leg.feed}'
-        and "zone".stop_id = '{leg.start_stop_id}'
-        """
-        try:
-            start_zone = execute_sql(sql, self.db)[0][0]
-        except IndexError:
-            raise IndexError(
-                f"{leg.feed} failed to find a zone for stop {leg.start_stop_id}"
-            )
-
-        sql = f"""
-        SELECT zone_id
-        FROM "zone"
-        where "zone".mdb_slug = '{leg.feed}'
-        and "zone".stop_id = '{leg.end_stop_id}'
-        """
-        end_zone = execute_sql(sql, self.db)[0][0]
-
+        start_zone = self.rules.zone(leg.feed, leg.start_stop_id)
+        end_zone = self.rules.zone(leg.feed, leg.end_stop_id)
         return start_zone, end_zone
 
     def get_route_fare_cost(self, leg) -> int:
@@ -467,17 +726,7 @@ class Itinerary:
         int
             The fare cost"""
 
-        sql = f"""
-        SELECT rf.fare_cost 
-        FROM route_fare rf
-        where rf.mdb_slug = '{leg.feed}'
-        AND rf.route_id = '{leg.route_id}'
-        """
-        res = execute_sql(sql, self.db)
-        if len(res) > 0:
-            return int(res[0][0])
-        else:
-            return None
+        return self.rules.route_fare_cost(leg.feed, leg.route_id)
 
     def get_flat_fare_cost(self, leg) -> int:
         """Get the flat fare cost for the leg
@@ -493,30 +742,237 @@ class Itinerary:
             The fare cost
         """
 
-        sql = f"""
-        SELECT ff.fare_cost
-        FROM flat_fare ff 
-        where ff.mdb_slug = "{leg.feed}"
-        """
-
-        return int(execute_sql(sql, self.db)[0][0])
+        return self.rules.flat_fare_cost(leg.feed)
 
 
 def execute_sql(sql, db) -> list:
     conn = sqlite3.connect(db)
-    cursor = conn.cursor()
-    cursor.execute(sql)
-    res = cursor.fetchall()
-    cursor.close()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(sql)
+        res = cursor.fetchall()
+        cursor.close()
+    finally:
+        conn.close()
     return res
 
 
 def execute_sql_to_df(sql, db) -> pandas.DataFrame:
     conn = sqlite3.connect(db)
-    df = pandas.read_sql_query(sql, conn)
+    try:
+        df = pandas.read_sql_query(sql, conn)
+    finally:
+        conn.close()
     return df
 
 
+class FareRuleSet:
+    """An in-memory index of all the fare rules in a fare database
+
+    The fare tables are read once when the rule set is created and hashed by
+    feed slug (and route, stop or zone where relevant), so that pricing an
+    itinerary never goes back to SQLite. Where a table holds more than one
+    matching row, the first row in table order wins, as with the queries this
+    replaces.
+
+    Parameters
+    ----------
+    db : str
+        The path to the SQLite fare database
+    """
+
+    def __init__(self, db: str):
+        self.db = db
+        conn = sqlite3.connect(db)
+        try:
+            cursor = conn.cursor()
+
+            #: mdb_slug -> (fare_type, transfers_allowed, fare_duration)
+            self.fare_types = {}
+            cursor.execute(
+                "SELECT mdb_slug, fare_type, transfers_allowed, fare_duration FROM fare_type"
+            )
+            for slug, fare_type, transfers_allowed, fare_duration in cursor.fetchall():
+                self.fare_types.setdefault(
+                    slug, (fare_type, transfers_allowed, fare_duration)
+                )
+
+            #: mdb_slug -> fare_cost
+            self.flat_fares = {}
+            cursor.execute("SELECT mdb_slug, fare_cost FROM flat_fare")
+            for slug, fare_cost in cursor.fetchall():
+                self.flat_fares.setdefault(slug, int(fare_cost))
+
+            #: (mdb_slug, route_id) -> fare_cost
+            self.route_fares = {}
+            cursor.execute("SELECT mdb_slug, route_id, fare_cost FROM route_fare")
+            for slug, route_id, fare_cost in cursor.fetchall():
+                self.route_fares.setdefault((slug, route_id), int(fare_cost))
+
+            #: (mdb_slug, stop_id) -> zone_id
+            self.zones = {}
+            cursor.execute('SELECT mdb_slug, stop_id, zone_id FROM "zone"')
+            for slug, stop_id, zone_id in cursor.fetchall():
+                self.zones.setdefault((slug, stop_id), zone_id)
+
+            #: (mdb_slug, from_zone, to_zone) -> [(route_id, fare_cost), ...]
+            self.zone_fares = {}
+            cursor.execute(
+                "SELECT mdb_slug, route_id, from_zone, to_zone, fare_cost FROM zone_fare"
+            )
+            for slug, route_id, from_zone, to_zone, fare_cost in cursor.fetchall():
+                self.zone_fares.setdefault((slug, from_zone, to_zone), []).append(
+                    (route_id, int(fare_cost))
+                )
+            cursor.close()
+
+            transfers = pandas.read_sql_query("SELECT * FROM transfer", conn)
+        finally:
+            conn.close()
+
+        self.transfer_index = TransferIndex(transfers)
+
+    def __repr__(self) -> str:
+        return f"<FareRuleSet {self.db} | {len(self.fare_types)} feeds>"
+
+    def fare_type(self, feed: str) -> tuple:
+        """Get the fare type, allowed transfers, and fare duration of a feed"""
+        try:
+            return self.fare_types[feed]
+        except KeyError:
+            raise FareNotFoundError(f"{feed} has no fare type in {self.db}")
+
+    def flat_fare_cost(self, feed: str) -> int:
+        """Get the flat fare cost of a feed"""
+        try:
+            return self.flat_fares[feed]
+        except KeyError:
+            raise FareNotFoundError(f"{feed} has no flat fare in {self.db}")
+
+    def route_fare_cost(self, feed: str, route_id: str) -> int:
+        """Get the route-specific fare cost, or None if there isn't one"""
+        return self.route_fares.get((feed, route_id))
+
+    def zone(self, feed: str, stop_id: str) -> str:
+        """Get the fare zone of a stop"""
+        try:
+            return self.zones[(feed, stop_id)]
+        except KeyError:
+            raise IndexError(f"{feed} failed to find a zone for stop {stop_id}")
+
+    def zone_fare_cost(self, feed: str, route_id: str, from_zone: str, to_zone: str):
+        """Get the zone fare cost for a route, or None if there isn't one
+
+        Rules specific to the route and ``__ANY__`` rules are both considered,
+        and the first one in table order is used. If no rule exists in the
+        direction of travel, the reverse direction is checked.
+        """
+        for key in [(feed, from_zone, to_zone), (feed, to_zone, from_zone)]:
+            for rule_route_id, fare_cost in self.zone_fares.get(key, []):
+                if rule_route_id == route_id or rule_route_id == "__ANY__":
+                    return fare_cost
+        return None
+
+    def transfer_rule(self, from_feed: str, to_feed: str, from_route_id: str):
+        """Get the transfer rule that applies between two legs, or None"""
+        return self.transfer_index.lookup(from_feed, to_feed, from_route_id)
+
+
+class TransferIndex:
+    """Transfer rules compiled into a direct lookup of the rule to apply
+
+    Rules are resolved with the precedence `Itinerary.compute_fare` has always
+    used. Rules from ``__ANY__`` route take precedence over rules from the
+    specific route, which take precedence over ``__ELSE__`` rules. Within that
+    group a rule to ``__ANY__`` route is preferred, and otherwise the first
+    rule in table order applies, except for the ``__ANY__`` group, which only
+    applies its rules to ``__ANY__`` route.
+
+    Parameters
+    ----------
+    transfers : pandas.DataFrame
+        The contents of the fare database ``transfer`` table
+    """
+
+    def __init__(self, transfers: pandas.DataFrame):
+        #: (from_mdb_slug, to_mdb_slug, from_route_id) -> rule
+        self._routes = {}
+        #: (from_mdb_slug, to_mdb_slug) -> rule for routes without their own
+        self._defaults = {}
+        for key, df in transfers.groupby(["from_mdb_slug", "to_mdb_slug"], sort=False):
+            rules = list(df.itertuples(index=False, name="TransferRule"))
+            any_rules = [r for r in rules if r.from_route_id == "__ANY__"]
+            if len(any_rules) > 0:
+                self._defaults[key] = _pick_transfer_rule(any_rules, fallback=False)
+                continue
+            else_rules = [r for r in rules if r.from_route_id == "__ELSE__"]
+            if len(else_rules) > 0:
+                self._defaults[key] = _pick_transfer_rule(else_rules, fallback=True)
+            for route_id in df.from_route_id.unique():
+                if route_id == "__ELSE__":
+                    continue
+                route_rules = [r for r in rules if r.from_route_id == route_id]
+                self._routes[key + (route_id,)] = _pick_transfer_rule(
+                    route_rules, fallback=True
+                )
+
+    def lookup(self, from_feed: str, to_feed: str, from_route_id: str):
+        """Get the rule for a transfer, or None if no rule applies
+
+        Parameters
+        ----------
+        from_feed : str
+            The feed slug of the leg being transferred from
+        to_feed : str
+            The feed slug of the leg being transferred to
+        from_route_id : str
+            The route ID of the leg being transferred from
+
+        Returns
+        -------
+        TransferRule or None
+            The matching row of the ``transfer`` table
+        """
+        rule = self._routes.get((from_feed, to_feed, from_route_id))
+        if rule is None:
+            rule = self._defaults.get((from_feed, to_feed))
+        return rule
+
+
+def _pick_transfer_rule(rules: list, fallback: bool):
+    """Pick the rule to use from a group sharing the same from route"""
+    for rule in rules:
+        if rule.to_route_id == "__ANY__":
+            return rule
+    if fallback:
+        return rules[0]
+    return None
+
+
+#: Rule sets that have already been loaded, keyed by database path
+_fare_rule_sets = {}
+
+
+def get_fare_rules(db) -> FareRuleSet:
+    """Get the rule set for a fare database, loading it on first use
+
+    Parameters
+    ----------
+    db : str or FareRuleSet
+        The path to the SQLite fare database, or an already loaded rule set
+
+    Returns
+    -------
+    FareRuleSet
+        The rule set for the database
+    """
+    if isinstance(db, FareRuleSet):
+        return db
+    if db not in _fare_rule_sets:
+        _fare_rule_sets[db] = FareRuleSet(db)
+    return _fare_rule_sets[db]
+
+
 class TransitLeg:
     def __init__(
         self,
@@ -542,13 +998,6 @@ class TransitLeg:
         self.next_leg = next_leg
         self.db = db
 
-        # Let's get the transfers
-        sql = f"""
-        SELECT * from transfer
-        where transfer.from_mdb_slug = '{self.feed}'
-        """
-        self.transfers = execute_sql_to_df(sql, self.db)
-
     def __repr__(self) -> str:
         return f"<TransitLeg {self.transport_mode} {self.departure_time} | {self.route_id}:{self.start_stop_id}->{self.end_stop_id}>"
 
@@ -635,167 +1084,76 @@ class ZoneFare(BaseFare):
 
     def update_fare(self):
         """Update the fare based on start and end zones"""
-        sql = f"""
-        SELECT zf.fare_cost
-        FROM zone_fare zf 
-        WHERE mdb_slug = '{self.feed}' 
-        AND (route_id = '{self.route_id}' OR route_id = '__ANY__')
-        AND from_zone = '{self.from_zone}'
-        AND to_zone = '{self.to_zone}'"""
-        res = execute_sql(sql, self.db)
-        if len(res) == 0:
-            # Try the reverse
-            sql = f"""
-                    SELECT zf.fare_cost
-                    FROM zone_fare zf 
-                    WHERE mdb_slug = '{self.feed}' 
-                    AND (route_id = '{self.route_id}' OR route_id = '__ANY__')
-                    AND from_zone = '{self.to_zone}'
-                    AND to_zone = '{self.from_zone}'"""
-            res = execute_sql(sql, self.db)
-        if len(res) > 0:
-            self.cost = int(res[0][0])
+        cost = get_fare_rules(self.db).zone_fare_cost(
+            self.feed, self.route_id, self.from_zone, self.to_zone
+        )
+        if cost is not None:
+            self.cost = cost
         else:
             self.cost = 500
 
 
-class OTPQuery:
-    OTP_ENDPOINT = "http://localhost:8080/otp/routers/default/index/graphql"
+def dense_bg_fare_matrix(
+    fmx: pandas.DataFrame,
+    c2bg: pandas.DataFrame,
+    all_bgs: list,
+    infinite_fare=9999,
+) -> numpy.ndarray:
+    """Gather a cluster fare matrix into a dense block group fare matrix
 
-    def __init__(self, feeds):
-        self.feeds = feeds
+    Clusters and block groups are replaced by integer codes, the cluster fares
+    are laid out in a square array with an extra row and column of
+    `infinite_fare` for block groups without a cluster, and the block group
+    matrix is gathered from it with a single fancy index.
 
-    def query_route(
-        self,
-        from_id: str,
-        to_id: str,
-        from_lat: float,
-        from_lon: float,
-        to_lat: float,
-        to_lon: float,
-        start_datetime: datetime.datetime,
-    ) -> pandas.DataFrame:
-        q = f"""
-            {{
-                plan(
-                    from: {{ lat: {from_lat}, lon: {from_lon} }},
-                    to: {{ lat: {to_lat}, lon: {to_lon} }},
-                    date: "{start_datetime.strftime("%Y-%m-%d")}",
-                    time: "{start_datetime.strftime("%H:%M")}",
-                    transportModes: [
-                        {{
-                            mode: WALK
-                        }},
-                        {{
-                            mode: TRANSIT
-                        }},
-                    ]) {{
-                    itineraries {{
-                        startTime
-                        endTime
-                        legs {{
-                            mode
-                            startTime
-                            endTime
-                            from {{
-                                stop{{
-                                gtfsId
-                                }}
-                                departureTime
-                            }}
-                            to {{
-                                stop{{
-                                gtfsId
-                                }}
-                                departureTime
-                            }}
-                            route {{
-                                gtfsId
-                                agency{{
-                                    gtfsId
-                                    name
-                                }}
-                            }}
-                        }}
-                    }}
-                }}
-            }}
-            """
-        r = requests.post(self.OTP_ENDPOINT, json={"query": q})
-        itineraries = json.loads(r.text)["data"]["plan"]["itineraries"]
-        leg_data = {
-            "from_id": [],
-            "to_id": [],
-            "option": [],
-            "segment": [],
-            "mode": [],
-            "departure_time": [],
-            "feed": [],
-            "agency_id": [],
-            "route_id": [],
-            "start_stop_id": [],
-            "end_stop_id": [],
-        }
-        option_data = {"option": [], "startTime": [], "endTime": []}
-        for idx, itinerary in enumerate(itineraries):
-            option_data["option"].append(idx)
-            option_data["startTime"].append(itinerary["startTime"])
-            option_data["endTime"].append(itinerary["endTime"])
-            for lidx, leg in enumerate(itinerary["legs"]):
-                leg_data["from_id"].append(from_id)
-                leg_data["to_id"].append(to_id)
-                leg_data["option"].append(idx)
-                leg_data["segment"].append(lidx)
-                leg_data["mode"].append(leg["mode"])
-                departure_time = datetime.datetime.fromtimestamp(
-                    leg["from"]["departureTime"] / 1000, timezone("America/New_York")
-                )
-                leg_data["departure_time"].append(departure_time)
-                if leg["from"]["stop"] != None:
-                    leg_data["start_stop_id"].append(
-                        leg["from"]["stop"]["gtfsId"].split(":")[1]
-                    )
-                else:
-                    leg_data["start_stop_id"].append(None)
-                if leg["to"]["stop"] != None:
-                    leg_data["end_stop_id"].append(
-                        leg["to"]["stop"]["gtfsId"].split(":")[1]
-                    )
-                else:
-                    leg_data["end_stop_id"].append(None)
-                if leg["route"] != None:
-                    leg_data["route_id"].append(leg["route"]["gtfsId"].split(":")[1])
-                    leg_data["agency_id"].append(
-                        leg["route"]["agency"]["gtfsId"].split(":")[1]
-                    )
-                    leg_data["feed"].append(
-                        self.feeds[str(leg["route"]["agency"]["gtfsId"].split(":")[0])]
-                    )
-                else:
-                    leg_data["route_id"].append(None)
-                    leg_data["agency_id"].append(None)
-                    leg_data["feed"].append(None)
-        leg_df = pandas.DataFrame(leg_data)
-        options_df = pandas.DataFrame(option_data)
-        options_df["delta"] = (options_df.endTime - options_df.startTime) / 60000
-        try:
-            option = options_df.sort_values("delta").iloc[0].option.astype(int)
-            return leg_df[leg_df["option"] == option].drop(columns=["option"])
-        except IndexError:
-            return leg_df
-
-
-def _route_query(param_list):
-    otp = param_list[0]
-    return otp.query_route(
-        from_id=param_list[1],
-        to_id=param_list[2],
-        from_lat=param_list[3],
-        from_lon=param_list[4],
-        to_lat=param_list[5],
-        to_lon=param_list[6],
-        start_datetime=param_list[7],
+    Parameters
+    ----------
+    fmx : pandas.DataFrame
+        The cluster fare matrix, with from_id, to_id and fare_cost columns
+    c2bg : pandas.DataFrame
+        The cluster of each block group, with CLUSTER_ID and BG20 columns. A
+        block group may only belong to one cluster.
+    all_bgs : list
+        The block groups, in the order of the matrix rows and columns
+    infinite_fare : int, optional
+        The fare of pairs without a fare, by default 9999
+
+    Returns
+    -------
+    numpy.ndarray
+        The `uint16` fare from each block group (rows) to each block group
+        (columns)
+
+    Raises
+    ------
+    ValueError
+        If a fare doesn't fit a `uint16` or a block group is in more than one
+        cluster
+    """
+    fares = fmx["fare_cost"].to_numpy()
+    limit = numpy.iinfo(numpy.uint16).max
+    if infinite_fare > limit or (fares.size > 0 and fares.max() > limit):
+        raise ValueError(f"Fares above {limit} do not fit the block group matrix")
+
+    clusters = pandas.Index(c2bg["CLUSTER_ID"].unique())
+    from_codes = clusters.get_indexer(fmx["from_id"])
+    to_codes = clusters.get_indexer(fmx["to_id"])
+    found = (from_codes >= 0) & (to_codes >= 0)
+    cluster_mx = numpy.full(
+        (clusters.size + 1, clusters.size + 1), infinite_fare, dtype=numpy.uint16
     )
+    cluster_mx[from_codes[found], to_codes[found]] = fares[found]
+
+    bg_clusters = c2bg.drop_duplicates(["BG20", "CLUSTER_ID"])
+    if bg_clusters["BG20"].duplicated().any():
+        repeated = bg_clusters.loc[bg_clusters["BG20"].duplicated(), "BG20"].unique()
+        raise ValueError(
+            f"Block groups in more than one cluster: {', '.join(map(str, repeated[:5]))}"
+        )
+    bg_clusters = bg_clusters.set_index("BG20")["CLUSTER_ID"]
+    bg_codes = clusters.get_indexer(bg_clusters.reindex(all_bgs))
+    bg_codes[bg_codes < 0] = clusters.size
+    return cluster_mx[numpy.ix_(bg_codes, bg_codes)]
 
 
 def map_fare_matrix_to_bg(
@@ -804,240 +1162,647 @@ def map_fare_matrix_to_bg(
     gpkg: str,
     output_parquet: str,
     infinite_fare=9999,
+    flush_rows=FARE_FLUSH_ROWS,
 ):
+    """Map a cluster fare matrix to every pair of block groups
+
+    The long format parquet has a BG20_from, BG20_to and fare_cost row for each
+    pair of block groups and is written in blocks of origins. An output path
+    ending in .npy instead saves the dense `uint16` matrix, to be opened with
+    `ted.matrix.DenseMatrix.load`, with the infinite fare as its sentinel.
+
+    Parameters
+    ----------
+    fare_matrix_filepath : str
+        The cluster fare matrix, as a CSV or parquet file
+    cluster_to_bg : str
+        The CSV of the cluster of each block group
+    gpkg : str
+        The region geopackage, with a bg_centroids layer
+    output_parquet : str
+        The output parquet (or .npy) file
+    infinite_fare : int, optional
+        The fare of pairs without a fare, by default 9999
+    flush_rows : int, optional
+        The number of rows written at a time, by default `FARE_FLUSH_ROWS`
+    """
     print("Mapping fare matrix to block groups")
-    all_bgs = geopandas.read_file(gpkg, layer="bg_centroids")
-    all_bgs = all_bgs["BG20"].tolist()
-    all_bgs = list(itertools.product(all_bgs, all_bgs))
-    all_bgs = pandas.DataFrame(
-        all_bgs,
-        columns=["BG20_from", "BG20_to"],
-    )
+    index = read_region_index(gpkg)
 
+    columns = ["from_id", "to_id", "fare_cost"]
     if fare_matrix_filepath.endswith(".csv"):
-        fmx = pandas.read_csv(fare_matrix_filepath)
+        fmx = pandas.read_csv(fare_matrix_filepath, usecols=columns)
     else:
-        fmx = pandas.read_parquet(fare_matrix_filepath)
+        fmx = pandas.read_parquet(fare_matrix_filepath, columns=columns)
     c2bg = pandas.read_csv(cluster_to_bg, dtype={"BG20": str})
-    df = pandas.merge(fmx, c2bg, left_on="from_id", right_on="CLUSTER_ID", how="left")
-    df = pandas.merge(
-        df,
-        c2bg,
-        left_on="to_id",
-        right_on="CLUSTER_ID",
-        how="left",
-        suffixes=["_from", "_to"],
+    matrix = DenseMatrix(
+        index,
+        dense_bg_fare_matrix(fmx, c2bg, index, infinite_fare),
+        column="fare_cost",
+        sentinel=infinite_fare,
     )
-    df = df[["BG20_from", "BG20_to", "fare_cost"]]
-    df = pandas.merge(all_bgs, df, on=["BG20_from", "BG20_to"], how="left")
-    df["fare_cost"] = df["fare_cost"].fillna(infinite_fare)
+    del fmx
 
-    df.to_parquet(output_parquet)
+    if output_parquet.endswith(".npy"):
+        matrix.save(output_parquet)
+    else:
+        matrix.to_parquet(
+            output_parquet,
+            from_column="BG20_from",
+            to_column="BG20_to",
+            fill=infinite_fare,
+            batch_rows=flush_rows,
+        )
 
 
 def make_fare_matrix_from_itineraries(
-    itineraries_parquet, matrix_parquet, fares_db, region_key
+    itineraries_parquet,
+    matrix_parquet,
+    fares_db,
+    region_key,
+    flush_rows=FARE_FLUSH_ROWS,
+    workers=1,
 ):
-    df = pandas.read_parquet(itineraries_parquet).rename(
-        columns={"mode": "transport_mode"}
-    )
-    pairs = df.drop_duplicates(subset=["from_id", "to_id"])
-    fares = {"from_id": [], "to_id": [], "fare_cost": []}
-    for idx, pair in tqdm(pairs.iterrows(), total=pairs.shape[0]):
-        sub_df = df[
-            (df.from_id == pair["from_id"]) & (df.to_id == pair["to_id"])
-        ].copy()
-        if sub_df.shape[0] > 1:
-            it = Itinerary(
-                sub_df,
-                region_key,
-                fares_db,
-            )
-            it.clean()
-            it.make_legs()
-            fares["from_id"].append(pair["from_id"])
-            fares["to_id"].append(pair["to_id"])
-            fares["fare_cost"].append(it.compute_fare())
+    """Compute the fare matrix of an itineraries file and stream it to parquet
 
-        fare_df = pandas.DataFrame(fares)
-        fare_df.to_parquet(matrix_parquet)
+    Fares are written one origin at a time through a `FareMatrixWriter`, so an
+    interrupted run picks up after the last origin that was flushed to disk.
+    With more than one worker, the origins are split into `from_id` ranges that
+    each worker reads straight from the parquet file and prices on its own.
 
+    Parameters
+    ----------
+    itineraries_parquet : str
+        The itineraries parquet file
+    matrix_parquet : str
+        The output fare matrix parquet file
+    fares_db : str
+        The fare database
+    region_key : str
+        The region key string (e.g. WAS)
+    flush_rows : int, optional
+        The number of rows buffered between flushes, by default `FARE_FLUSH_ROWS`
+    workers : int, optional
+        The number of worker processes, by default 1
+    """
+    writer = FareMatrixWriter(matrix_parquet, flush_rows=flush_rows)
+    if writer.completed_origin is not None:
+        print(f"  Resuming after origin {writer.completed_origin}")
+
+    if workers > 1:
+        for last_origin, fare_df in compute_fares_in_parallel(
+            itineraries_parquet,
+            fares_db,
+            region_key,
+            workers,
+            after=writer.completed_origin,
+        ):
+            writer.write(last_origin, fare_df)
+    else:
+        df = pandas.read_parquet(itineraries_parquet).rename(
+            columns={"mode": "transport_mode"}
+        )
+        evaluator = ItineraryFareEvaluator(df, fares_db, region_key)
+        del df
+        print(f"  Computing fares for {evaluator.size} pairs")
+        for from_id, fare_df in evaluator.compute_origins(
+            after=writer.completed_origin
+        ):
+            writer.write(from_id, fare_df)
+    writer.close()
+
+
+def compute_fares_in_parallel(itineraries, fares_db, region_key, workers, after=None):
+    """Compute fares in worker processes, one range of origins at a time
+
+    The origins are split into contiguous `from_id` ranges holding roughly the
+    same number of itinerary rows. Each worker loads the fare rules once and
+    prices whole ranges, reading them from the parquet file itself when given a
+    path. Only the path of the fare database is sent to the workers, which
+    load its rules themselves. Ranges are yielded in origin order, so the
+    output is the same as a single process run no matter how many workers are
+    used. The fare cache hit rate of all the workers is printed once every
+    range is done.
 
-def _chunkify(l: list, n: int):
-    """Divide a list into chunks of size n
     Parameters
     ----------
-    l : list
-        The list to chunkify
-    n : int
-        The maximum chunk size
+    itineraries : str or pandas.DataFrame
+        The itineraries parquet file, or the itineraries themselves
+    fares_db : str or FareRuleSet
+        The fare database or its loaded rule set
+    region_key : str
+        The region key string (e.g. WAS)
+    workers : int
+        The number of worker processes
+    after : optional
+        Skip every origin up to and including this one, by default None
+
+    Yields
+    ------
+    tuple
+        The last origin of the range and the range's fare matrix rows, with
+        the columns from_id, to_id and fare_cost
     """
-    for i in range(0, len(l), n):
-        yield l[i : i + n]
-
-
-def dechunkify(chunk_folder: str, parquet_output: str):
-    print("Dechunkifying")
-    dfs = []
-    for f in os.listdir(chunk_folder):
-        dfs.append(
-            pandas.read_csv(
-                os.path.join(chunk_folder, f),
-                dtype={
-                    "from_id": int,
-                    "to_id": int,
-                    "route_id": str,
-                    "stop_id": str,
-                    "feed": str,
-                    "start_stop_id": str,
-                    "end_stop_id": str,
-                },
-            )
+    if isinstance(itineraries, str):
+        from_ids = pyarrow.parquet.read_table(itineraries, columns=["from_id"])
+        from_ids = from_ids.column("from_id").to_pandas()
+    else:
+        from_ids = itineraries["from_id"]
+    shards = _fare_shard_bounds(from_ids, workers * FARE_SHARDS_PER_WORKER, after)
+    print(f"  Computing fares in {len(shards)} shards on {workers} workers")
+
+    tasks = []
+    for first, last in shards:
+        if isinstance(itineraries, str):
+            shard = itineraries
+        else:
+            shard = itineraries[
+                (itineraries["from_id"] >= first) & (itineraries["from_id"] <= last)
+            ]
+        tasks.append((shard, region_key, first, last, after))
+
+    if isinstance(fares_db, FareRuleSet):
+        fares_db = fares_db.db
+    hits = misses = 0
+    with multiprocessing.Pool(
+        workers, initializer=_init_fare_worker, initargs=(fares_db,)
+    ) as p:
+        for last, fare_df, shard_hits, shard_misses in tqdm(
+            p.imap(_compute_fare_shard, tasks), total=len(tasks)
+        ):
+            hits += shard_hits
+            misses += shard_misses
+            yield last, fare_df
+    lookups = max(hits + misses, 1)
+    print(f"  Fare cache: {hits} hits | {misses} misses | {hits / lookups:.1%}")
+
+
+def _fare_shard_bounds(from_ids: pandas.Series, n: int, after=None) -> list:
+    """Split origins into at most n contiguous ranges of similar row counts"""
+    counts = from_ids.value_counts().sort_index()
+    if after is not None:
+        counts = counts[counts.index > after]
+    if counts.shape[0] == 0:
+        return []
+    # Cut wherever the running row count crosses a multiple of the target size
+    target = counts.sum() / min(n, counts.shape[0])
+    shard_of_origin = numpy.minimum(
+        ((counts.cumsum().to_numpy() - counts.to_numpy()) // target).astype(int),
+        n - 1,
+    )
+    bounds = []
+    for shard in numpy.unique(shard_of_origin):
+        origins = counts.index[shard_of_origin == shard]
+        bounds.append((_json_scalar(origins[0]), _json_scalar(origins[-1])))
+    return bounds
+
+
+_worker_fare_rules = None
+
+
+def _init_fare_worker(fares_db: str):
+    """Load the fare rules of a database once in each worker process"""
+    global _worker_fare_rules
+    _worker_fare_rules = get_fare_rules(fares_db)
+
+
+def _compute_fare_shard(task):
+    """Compute the fares of one range of origins in a worker process"""
+    itineraries, region_key, first, last, after = task
+    if isinstance(itineraries, str):
+        itineraries = pandas.read_parquet(
+            itineraries, filters=[("from_id", ">=", first), ("from_id", "<=", last)]
         )
+    evaluator = ItineraryFareEvaluator(
+        itineraries, _worker_fare_rules, region_key, verbose=False
+    )
+    fare_df = evaluator.compute(after=after)
+    return last, fare_df, evaluator.cache.hits, evaluator.cache.misses
 
-    df = pandas.concat(dfs, axis="index")
-    df["agency_id"] = df["agency_id"].astype(str)
-    df.to_parquet(parquet_output)
 
+class FareMatrixWriter:
+    """Stream fare matrix rows to a parquet file with resumable checkpoints
 
-def run_otp_itineraries_from_pairs_list(
-    fares_yaml: str,
-    pairs_df: pandas.DataFrame,
-    clusters: pandas.DataFrame,
-    departure: datetime.datetime,
-    output_folder: str,
-    region_key: str,
-    chunk_size=30,
-):
-    """Fetch a set of OTP itineraries based on a provided set of origin-destination pairs
+    Rows are buffered and flushed into numbered part files next to the output
+    once at least `flush_rows` are waiting. Flushes only happen between
+    origins, and after each one a JSON manifest records the last origin that is
+    safely on disk. Closing the writer concatenates the parts into the output
+    file one row group at a time and removes the parts and the manifest.
 
     Parameters
     ----------
-    fares_yaml : str
-        The file path of the fares configuration YAML file
-    pairs_df : pandas.DataFrame
-        The dataframe with the pairs to check
-    clusters : pandas.DataFrame
-        The set of clusters to create itineraries for
-    departure : datetime.datetime
-        The departure time and date to use
-    output_folder : str
-        The folder in which to put the chunks that are created
+    matrix_parquet : str
+        The output fare matrix parquet file
+    flush_rows : int, optional
+        The number of rows buffered between flushes, by default `FARE_FLUSH_ROWS`
+    """
+
+    def __init__(self, matrix_parquet: str, flush_rows: int = FARE_FLUSH_ROWS):
+        self.matrix_parquet = matrix_parquet
+        self.flush_rows = flush_rows
+        self.parts_folder = f"{matrix_parquet}.parts"
+        self.manifest_file = f"{matrix_parquet}.checkpoint.json"
+        self.completed_origin = None
+        self.parts = []
+        self._buffer = []
+        self._buffered_rows = 0
+        self._last_origin = None
+
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file) as f:
+                manifest = json.load(f)
+            self.completed_origin = manifest["completed_origin"]
+            self.parts = manifest["parts"]
+        os.makedirs(self.parts_folder, exist_ok=True)
+
+    def write(self, from_id, fare_df: pandas.DataFrame):
+        """Add the fares of one complete origin
+
+        Parameters
+        ----------
+        from_id
+            The origin the rows belong to
+        fare_df : pandas.DataFrame
+            The origin's rows, with the columns from_id, to_id and fare_cost
+        """
+        self._buffer.append(fare_df)
+        self._buffered_rows += fare_df.shape[0]
+        self._last_origin = from_id
+        if self._buffered_rows >= self.flush_rows:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered rows to a new part and checkpoint the last origin"""
+        if len(self._buffer) == 0:
+            return
+        table = pyarrow.Table.from_pandas(
+            pandas.concat(self._buffer, ignore_index=True), preserve_index=False
+        )
+        part = f"part-{len(self.parts):05d}.parquet"
+        pyarrow.parquet.write_table(table, os.path.join(self.parts_folder, part))
+        self.parts.append(part)
+        self.completed_origin = _json_scalar(self._last_origin)
+        self._buffer = []
+        self._buffered_rows = 0
+
+        # Swap the manifest in atomically so a crash never leaves half of one
+        tmp_file = f"{self.manifest_file}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(
+                {"completed_origin": self.completed_origin, "parts": self.parts}, f
+            )
+        os.replace(tmp_file, self.manifest_file)
+
+    def close(self):
+        """Flush the remaining rows and assemble the final parquet file"""
+        self.flush()
+        if len(self.parts) == 0:
+            pandas.DataFrame({"from_id": [], "to_id": [], "fare_cost": []}).to_parquet(
+                self.matrix_parquet
+            )
+        else:
+            part_files = [os.path.join(self.parts_folder, p) for p in self.parts]
+            schema = pyarrow.parquet.read_schema(part_files[0])
+            with pyarrow.parquet.ParquetWriter(self.matrix_parquet, schema) as writer:
+                for part_file in part_files:
+                    part = pyarrow.parquet.ParquetFile(part_file)
+                    for i in range(part.num_row_groups):
+                        writer.write_table(part.read_row_group(i).cast(schema))
+            for part_file in part_files:
+                os.remove(part_file)
+        os.rmdir(self.parts_folder)
+        if os.path.exists(self.manifest_file):
+            os.remove(self.manifest_file)
+
+
+def _json_scalar(value):
+    """Convert a numpy scalar into a plain Python value for JSON"""
+    if isinstance(value, numpy.generic):
+        return value.item()
+    return value
+
+
+class ItineraryFareEvaluator:
+    """Compute the fares of every pair in an itineraries table at once
+
+    The itineraries are sorted once by pair and segment and the transit legs
+    are pulled out as columnar arrays, rather than filtering the whole table
+    for each pair. Pairs that ride a single transit leg are priced once per
+    distinct (feed, route, stops) combination, and the remaining pairs are
+    walked leg by leg with the same logic as `Itinerary.compute_fare`. Pairs
+    are produced one origin at a time so results can be streamed to disk.
+
+    Parameters
+    ----------
+    itineraries : pandas.DataFrame
+        The itineraries, one row per segment, as produced by the OTP runners
+    db : str or FareRuleSet
+        The fare database or its loaded rule set
     region_key : str
         The region key string (e.g. WAS)
-    chunk_size : int, optional
-        The size of chunk to use (number of pairs), by default 30
+    cache_size : int, optional
+        The number of multi-leg fares to memoize, by default `FARE_CACHE_SIZE`
+    verbose : bool, optional
+        Whether to print progress, by default True
     """
-    print("Running OTP Itineraries - Specified Pairs")
-    with open(fares_yaml) as infile:
-        config = yaml.safe_load(infile)
-
-    feeds = {
-        (str(key) if isinstance(key, int) else key): config["feeds"][key]
-        for key in config["feeds"]
-    }
-
-    otp = OTPQuery(feeds)
-    dfs = []
-    params_list = []
-    print("  Building job list")
-
-    # Remove diagnonals
-    pairs_df = pairs_df[pairs_df.from_id != pairs_df.to_id]
-    pairs_df = pandas.merge(
-        pairs_df,
-        clusters,
-        left_on="from_id",
-        right_on="CLUSTER_ID",
-        how="left",
-    )
-    pairs_df = pandas.merge(
-        pairs_df,
-        clusters,
-        left_on="to_id",
-        right_on="CLUSTER_ID",
-        how="left",
-        suffixes=["_o", "_d"],
-    )
-    for idx, pair in pairs_df.iterrows():
-        params_list.append(
-            [
-                otp,
-                pair.CLUSTER_ID_o,
-                pair.CLUSTER_ID_d,
-                pair.MEAN_Y_o,
-                pair.MEAN_X_o,
-                pair.MEAN_Y_d,
-                pair.MEAN_X_d,
-                departure,
-            ]
+
+    def __init__(
+        self,
+        itineraries: pandas.DataFrame,
+        db,
+        region_key: str,
+        cache_size: int = FARE_CACHE_SIZE,
+        verbose: bool = True,
+    ):
+        self.region_key = region_key
+        self.verbose = verbose
+        self.rules = get_fare_rules(db)
+        self.cache = FareCache(cache_size)
+
+        df = itineraries.rename(columns={"mode": "transport_mode"})
+        df = df.sort_values(["from_id", "to_id", "segment"], kind="stable")
+        from_ids = df["from_id"].to_numpy()
+        to_ids = df["to_id"].to_numpy()
+
+        # Find where each pair starts in the sorted table
+        new_pair = numpy.ones(df.shape[0], dtype=bool)
+        new_pair[1:] = (from_ids[1:] != from_ids[:-1]) | (to_ids[1:] != to_ids[:-1])
+        pair_starts = numpy.flatnonzero(new_pair)
+        pair_sizes = numpy.diff(numpy.append(pair_starts, df.shape[0]))
+        pair_of_row = numpy.repeat(numpy.arange(pair_starts.shape[0]), pair_sizes)
+        self.from_ids = from_ids[pair_starts]
+        self.to_ids = to_ids[pair_starts]
+
+        # Only itineraries with more than one segment get a fare, and only
+        # their transit segments make legs
+        is_leg = (pair_sizes[pair_of_row] > 1) & (
+            df["transport_mode"].to_numpy() != WALK_MODE
         )
-    print("  Generating", len(params_list), "itineraries")
-    chunk_list = list(_chunkify(params_list, chunk_size))
-    print(f"  Using chunks of size {chunk_size}")
-    cpus = multiprocessing.cpu_count() - 2
-    print(f"  Using {cpus} CPUs")
-
-    start = time.time()
-    with multiprocessing.Pool(cpus) as p:
-        for idx, chunk in tqdm(enumerate(chunk_list), total=len(chunk_list)):
-            df_list = p.map(_route_query, chunk)
-            df_list = [d for d in df_list if not d.empty]
-            if len(df_list) > 0:
-                pandas.concat(df_list, axis="index").to_csv(
-                    f"{output_folder}/{region_key}_{idx}.csv", index=False
-                )
-            else:
-                print("    Chunk", idx, "has no data")
-
-    end = time.time()
-    print("  Took", end - start, "seconds")
-
-
-def run_otp_itineraries_in_parallel(fares_yaml, points, output_folder, chunk_size=30):
-    with open(fares_yaml) as infile:
-        config = yaml.safe_load(infile)
-
-    feeds = {
-        (str(key) if isinstance(key, int) else key): config["feeds"][key]
-        for key in config["feeds"]
-    }
-
-    otp = OTPQuery(feeds)
-    dfs = []
-    params_list = []
-    for odx, origin in points.iterrows():
-        for ddx, dest in points.iterrows():
-            if origin.cluster_id != dest.cluster_id:
-                params_list.append(
-                    [
-                        otp,
-                        origin.cluster_id,
-                        dest.cluster_id,
-                        origin.MEAN_Y,
-                        origin.MEAN_X,
-                        dest.MEAN_Y,
-                        dest.MEAN_X,
-                        datetime.datetime(2023, 9, 27, 7, 11),
-                    ]
-                )
-    print("Generating", len(params_list), "itineraries")
-    chunk_list = list(_chunkify(params_list, chunk_size))
-    print(f"Using chunks of size {chunk_size}")
-    cpus = multiprocessing.cpu_count() - 2
-    print(f"Using {cpus} CPUs")
-
-    start = time.time()
-    with multiprocessing.Pool(cpus) as p:
-        for idx, chunk in tqdm(enumerate(chunk_list), total=len(chunk_list)):
-            df_list = p.map(_route_query, chunk)
-            df_list = [d for d in df_list if not d.empty]
-            if len(df_list) > 0:
-                pandas.concat(df_list, axis="index").to_csv(
-                    f"{output_folder}/WAS_{idx}.csv", index=False
+        legs = df[is_leg]
+        self._leg_pair = pair_of_row[is_leg]
+        self._transport_mode = legs["transport_mode"].to_numpy()
+        self._feed = legs["feed"].to_numpy()
+        self._agency_id = legs["agency_id"].to_numpy()
+        self._route_id = legs["route_id"].to_numpy()
+        self._start_stop_id = legs["start_stop_id"].to_numpy()
+        self._end_stop_id = legs["end_stop_id"].to_numpy()
+        self._departure_time = pandas.to_datetime(
+            legs["departure_time"], utc=True
+        ).dt.to_pydatetime()
+        self.leg_counts = numpy.bincount(self._leg_pair, minlength=pair_starts.shape[0])
+        self._leg_starts = numpy.cumsum(self.leg_counts) - self.leg_counts
+
+        no_legs = ((pair_sizes > 1) & (self.leg_counts == 0)).sum()
+        if no_legs > 0 and self.verbose:
+            print(f"  Skipping {no_legs} multi-segment itineraries without transit")
+
+    @property
+    def size(self) -> int:
+        """The number of pairs that will be priced"""
+        return int((self.leg_counts > 0).sum())
+
+    def make_legs(self, pair: int) -> list:
+        """Build the linked transit legs of a pair"""
+        legs = []
+        prev_leg = None
+        start = self._leg_starts[pair]
+        for i in range(start, start + self.leg_counts[pair]):
+            leg = TransitLeg(
+                self._transport_mode[i],
+                self._departure_time[i],
+                self._feed[i],
+                self._agency_id[i],
+                self._route_id[i],
+                self._start_stop_id[i],
+                self._end_stop_id[i],
+                prev_leg,
+                None,
+                self.rules,
+            )
+            if prev_leg is not None:
+                prev_leg.next_leg = leg
+            legs.append(leg)
+            prev_leg = leg
+        return legs
+
+    def price_pair(self, pair: int) -> int:
+        """Compute the fare of a single pair"""
+        it = Itinerary.from_legs(self.make_legs(pair), self.region_key, self.rules)
+        return it.compute_fare()
+
+    def signature(self, pair: int) -> tuple:
+        """Get the fare signature of a pair's chain of legs"""
+        legs = slice(
+            self._leg_starts[pair], self._leg_starts[pair] + self.leg_counts[pair]
+        )
+        return fare_signature(
+            self._feed[legs],
+            self._route_id[legs],
+            self._start_stop_id[legs],
+            self._end_stop_id[legs],
+            self._departure_time[legs],
+            self.rules,
+        )
+
+    def price_pair_cached(self, pair: int) -> int:
+        """Compute the fare of a single pair, reusing the fare of an equivalent chain"""
+        key = self.signature(pair)
+        fare = self.cache.get(key)
+        if fare is None:
+            fare = self.price_pair(pair)
+            self.cache.put(key, fare)
+        return fare
+
+    def compute(self, after=None) -> pandas.DataFrame:
+        """Compute the fare of every pair
+
+        Parameters
+        ----------
+        after : optional
+            Skip every origin up to and including this one, by default None
+
+        Returns
+        -------
+        pandas.DataFrame
+            A fare matrix with the columns from_id, to_id and fare_cost
+        """
+        origins = [fare_df for _, fare_df in self.compute_origins(after)]
+        if len(origins) == 0:
+            return pandas.DataFrame({"from_id": [], "to_id": [], "fare_cost": []})
+        return pandas.concat(origins, ignore_index=True)
+
+    def compute_origins(self, after=None):
+        """Compute fares one origin at a time
+
+        Parameters
+        ----------
+        after : optional
+            Skip every origin up to and including this one, by default None
+
+        Yields
+        ------
+        tuple
+            The origin id and its fare matrix rows as a DataFrame with the
+            columns from_id, to_id and fare_cost
+        """
+        # Single leg itineraries only depend on the leg's feed, route and stops,
+        # so each distinct combination is priced once, the first time it is seen
+        single = numpy.flatnonzero(self.leg_counts == 1)
+        first_legs = self._leg_starts[single]
+        combos = pandas.DataFrame(
+            {
+                "feed": self._feed[first_legs],
+                "route_id": self._route_id[first_legs],
+                "start_stop_id": self._start_stop_id[first_legs],
+                "end_stop_id": self._end_stop_id[first_legs],
+            }
+        )
+        combo_of_pair = numpy.full(self.from_ids.shape[0], -1, dtype=numpy.int64)
+        combo_of_pair[single] = combos.groupby(
+            list(combos.columns), sort=False, dropna=False
+        ).ngroup()
+        combo_fares = numpy.zeros(combo_of_pair.max(initial=-1) + 1, dtype=numpy.int64)
+        combo_priced = numpy.zeros(combo_fares.shape[0], dtype=bool)
+
+        # Pairs are sorted by origin, so each origin is a contiguous block
+        new_origin = numpy.ones(self.from_ids.shape[0], dtype=bool)
+        new_origin[1:] = self.from_ids[1:] != self.from_ids[:-1]
+        origin_starts = numpy.flatnonzero(new_origin)
+        origin_ends = numpy.append(origin_starts[1:], self.from_ids.shape[0])
+        if after is not None:
+            keep = self.from_ids[origin_starts] > after
+            origin_starts = origin_starts[keep]
+            origin_ends = origin_ends[keep]
+
+        for start, end in tqdm(
+            zip(origin_starts, origin_ends),
+            total=origin_starts.shape[0],
+            disable=not self.verbose,
+        ):
+            pairs = numpy.arange(start, end)
+            pairs = pairs[self.leg_counts[pairs] > 0]
+            if pairs.shape[0] == 0:
+                continue
+            fares = numpy.zeros(pairs.shape[0], dtype=numpy.int64)
+            for i, pair in enumerate(pairs):
+                combo = combo_of_pair[pair]
+                if combo < 0:
+                    fares[i] = self.price_pair_cached(pair)
+                else:
+                    if not combo_priced[combo]:
+                        combo_fares[combo] = self.price_pair(pair)
+                        combo_priced[combo] = True
+                    fares[i] = combo_fares[combo]
+            yield self.from_ids[start], pandas.DataFrame(
+                {
+                    "from_id": self.from_ids[pairs],
+                    "to_id": self.to_ids[pairs],
+                    "fare_cost": fares,
+                }
+            )
+        if self.verbose:
+            print(f"  {self.cache}")
+
+
+class FareCache:
+    """A bounded least-recently-used cache of itinerary fares
+
+    Parameters
+    ----------
+    maxsize : int, optional
+        The maximum number of fares to keep, by default `FARE_CACHE_SIZE`
+    """
+
+    def __init__(self, maxsize: int = FARE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._fares = collections.OrderedDict()
+
+    def __repr__(self) -> str:
+        return f"<FareCache {len(self._fares)}/{self.maxsize} | {self.hits} hits | {self.misses} misses | {self.hit_rate:.1%}>"
+
+    def __len__(self) -> int:
+        return len(self._fares)
+
+    @property
+    def hit_rate(self) -> float:
+        """The share of lookups that were answered from the cache"""
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return 0.0
+        return self.hits / lookups
+
+    def get(self, key):
+        """Get a cached fare, or None if it isn't cached"""
+        try:
+            fare = self._fares[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self._fares.move_to_end(key)
+        self.hits += 1
+        return fare
+
+    def put(self, key, fare):
+        """Cache a fare, evicting the least recently used one if full"""
+        self._fares[key] = fare
+        self._fares.move_to_end(key)
+        if len(self._fares) > self.maxsize:
+            self._fares.popitem(last=False)
+
+
+def fare_signature(
+    feeds, route_ids, start_stop_ids, end_stop_ids, departure_times, rules
+) -> tuple:
+    """Build a key that is equal for any two chains of legs with the same fare
+
+    Each leg contributes its feed and route, plus its boarding and alighting
+    zones for zone-based feeds (or the stops themselves, if they have no zone).
+    Stops are left out for flat fare feeds, as they don't change the price.
+    Times only matter through whether a fare has expired by the time a later
+    leg departs, so for every pair of legs the key records whether the gap
+    between them exceeds the maximum time of a fare bought on the earlier one.
+
+    Parameters
+    ----------
+    feeds, route_ids, start_stop_ids, end_stop_ids, departure_times : sequence
+        The attributes of each transit leg, in travel order
+    rules : FareRuleSet
+        The fare rules to price the legs with
+
+    Returns
+    -------
+    tuple
+        A hashable fare signature
+    """
+    legs = []
+    max_times = []
+    for feed, route_id, start_stop_id, end_stop_id in zip(
+        feeds, route_ids, start_stop_ids, end_stop_ids
+    ):
+        fare_type = rules.fare_types.get(feed)
+        if fare_type is None:
+            legs.append((feed, route_id, start_stop_id, end_stop_id))
+            max_times.append(INFINITE_INT)
+            continue
+        if fare_type[0] == "flat":
+            legs.append((feed, route_id, None, None))
+        else:
+            legs.append(
+                (
+                    feed,
+                    route_id,
+                    rules.zones.get((feed, start_stop_id), ("stop", start_stop_id)),
+                    rules.zones.get((feed, end_stop_id), ("stop", end_stop_id)),
                 )
-            else:
-                print("Chunk", idx, "has no data")
+            )
+        max_times.append(fare_type[2] if fare_type[2] > 0 else INFINITE_INT)
+
+    expired = []
+    for j in range(1, len(departure_times)):
+        for i in range(j):
+            elapsed = (departure_times[j] - departure_times[i]).total_seconds()
+            expired.append(elapsed > max_times[i])
 
-    end = time.time()
-    print("Took", end - start, "seconds")
+    return tuple(legs), tuple(expired)
@@ -5,6 +5,7 @@ and validating GTFS feeds."""
 
 import datetime
 import difflib
+import hashlib
 import json
 import os
 import requests
@@ -13,13 +14,236 @@ import shutil
 import zipfile
 
 import geopandas
+import numpy
 import pandas
+import pyarrow.compute
 from slugify import slugify
 import yaml
 
 from gtfslite.gtfs import GTFS
 
 MOBILITY_CATALOG_URL = "https://bit.ly/catalogs-csv"
+#: The folder derived feed data is cached in, by the SHA-256 digest of each
+#: zipfile. The TED_GTFS_CACHE environment variable moves it, and an empty
+#: TED_GTFS_CACHE turns the cache off.
+GTFS_CACHE_FOLDER = (
+    os.environ.get(
+        "TED_GTFS_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "ted", "gtfs")
+    )
+    or None
+)
+#: The feed tables kept in the cache, as named on `GTFS`
+GTFS_TABLES = [
+    "agency",
+    "stops",
+    "routes",
+    "trips",
+    "stop_times",
+    "calendar",
+    "calendar_dates",
+    "fare_attributes",
+    "fare_rules",
+    "shapes",
+    "frequencies",
+    "transfers",
+    "pathways",
+    "levels",
+    "translations",
+    "feed_info",
+    "attributions",
+]
+#: The time columns cached as seconds since midnight, by table
+GTFS_TIME_COLUMNS = {
+    "stop_times": ["arrival_time", "departure_time"],
+    "frequencies": ["start_time", "end_time"],
+}
+
+
+def feed_digest(gtfs_path: str) -> str:
+    """Get the SHA-256 hex digest of a GTFS zipfile's contents"""
+    digest = hashlib.sha256()
+    with open(gtfs_path, "rb") as infile:
+        for block in iter(lambda: infile.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def feed_cache_folder(gtfs_path: str, cache_folder: str = GTFS_CACHE_FOLDER) -> str:
+    """Get the cache folder of a GTFS zipfile, creating it if needed
+
+    The folder is named by the digest of the zipfile, so renamed or copied feeds
+    share their cache. A zipfile that changes in place gets a new digest, and so
+    a new, empty folder; the folder of its old contents is never read again and
+    is left for `prune_feed_cache` to remove.
+
+    Parameters
+    ----------
+    gtfs_path : str
+        The GTFS zipfile
+    cache_folder : str, optional
+        The folder of all feed caches, by default `GTFS_CACHE_FOLDER`
+
+    Returns
+    -------
+    str
+        The path of the feed's cache folder
+    """
+    if not zipfile.is_zipfile(gtfs_path):
+        raise zipfile.BadZipFile(f"{gtfs_path} is not a zipfile")
+    folder = os.path.join(cache_folder, feed_digest(gtfs_path))
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+
+def prune_feed_cache(gtfs_folders: list, cache_folder: str = GTFS_CACHE_FOLDER) -> list:
+    """Remove the cached data of every feed not in a set of GTFS folders
+
+    Parameters
+    ----------
+    gtfs_folders : list
+        The folders of the feeds to keep, searched recursively for zipfiles. An
+        empty list clears the whole cache.
+    cache_folder : str, optional
+        The folder of all feed caches, by default `GTFS_CACHE_FOLDER`
+
+    Returns
+    -------
+    list
+        The digests of the removed feeds
+    """
+    if cache_folder is None or not os.path.isdir(cache_folder):
+        return []
+    keep = set()
+    for gtfs_folder in gtfs_folders:
+        for root, _, filenames in os.walk(gtfs_folder):
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                if zipfile.is_zipfile(path):
+                    keep.add(feed_digest(path))
+    removed = sorted(set(os.listdir(cache_folder)) - keep)
+    for digest in removed:
+        shutil.rmtree(os.path.join(cache_folder, digest))
+    print(f"Removed {len(removed)} cached feeds from {cache_folder}")
+    return removed
+
+
+def _table_to_seconds(df: pandas.DataFrame, table: str) -> pandas.DataFrame:
+    """Convert the `GTFS_TIME_COLUMNS` of a feed table to nullable seconds
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        The table, with HH:MM:SS times
+    table : str
+        The name of the table on `GTFS`
+
+    Returns
+    -------
+    pandas.DataFrame
+        A copy of the table, with `Int32` seconds since midnight
+    """
+    df = df.copy()
+    for column in GTFS_TIME_COLUMNS.get(table, []):
+        if column not in df.columns:
+            continue
+        times = df[column]
+        seconds = pandas.Series(pandas.NA, index=df.index, dtype="Int32")
+        seconds[times.notna()] = time_to_seconds(times.dropna())
+        df[column] = seconds
+    return df
+
+
+def cache_feed(gtfs_path: str, cache_folder: str = GTFS_CACHE_FOLDER) -> str:
+    """Convert the tables of a GTFS zipfile to typed parquet files, once
+
+    Each table is parsed with the dtypes of `GTFS.load_zip` and saved as its own
+    parquet file. The times of `GTFS_TIME_COLUMNS` are stored as nullable
+    integer seconds since midnight, and the id columns are dictionary-encoded.
+    A feed.json file listing the tables marks a finished cache.
+
+    Parameters
+    ----------
+    gtfs_path : str
+        The GTFS zipfile
+    cache_folder : str, optional
+        The folder of all feed caches, by default `GTFS_CACHE_FOLDER`
+
+    Returns
+    -------
+    str
+        The path of the feed's cache folder
+    """
+    folder = feed_cache_folder(gtfs_path, cache_folder)
+    if os.path.exists(os.path.join(folder, "feed.json")):
+        return folder
+    print("  Caching", gtfs_path)
+    gtfs = GTFS.load_zip(gtfs_path)
+    tables = []
+    for table in GTFS_TABLES:
+        df = getattr(gtfs, table)
+        if df is None:
+            continue
+        df = _table_to_seconds(df, table)
+        for column in df.columns:
+            if column.endswith("_id") and df[column].dtype == object:
+                df[column] = df[column].astype("category")
+        df.to_parquet(os.path.join(folder, f"{table}.parquet"), index=False)
+        tables.append(table)
+    with open(os.path.join(folder, "feed.json"), "w") as outfile:
+        json.dump({"file": os.path.basename(gtfs_path), "tables": tables}, outfile)
+    return folder
+
+
+def load_gtfs(
+    gtfs_path: str, seconds: bool = False, cache_folder: str = GTFS_CACHE_FOLDER
+) -> GTFS:
+    """Load a GTFS zipfile through the feed cache
+
+    The first load of a feed parses its CSV files into the cache with
+    `cache_feed`, and later loads of the same feed, under any name, read the
+    parquet files instead. The cache is keyed by the digest of the zipfile, so
+    a feed that changes is parsed again. Cached feeds are for reading only:
+    writing one back out re-renders its times.
+
+    Parameters
+    ----------
+    gtfs_path : str
+        The GTFS zipfile
+    seconds : bool, optional
+        Whether to leave the times of `GTFS_TIME_COLUMNS` as integer seconds
+        since midnight rather than HH:MM:SS strings, by default False. The
+        `GTFS` methods that read times need strings.
+    cache_folder : str, optional
+        The folder of all feed caches, by default `GTFS_CACHE_FOLDER`. None
+        parses the zipfile without caching it.
+
+    Returns
+    -------
+    GTFS
+        The feed
+    """
+    if cache_folder is None:
+        gtfs = GTFS.load_zip(gtfs_path)
+        if seconds:
+            for table in GTFS_TIME_COLUMNS:
+                if getattr(gtfs, table) is not None:
+                    setattr(gtfs, table, _table_to_seconds(getattr(gtfs, table), table))
+        return gtfs
+    folder = cache_feed(gtfs_path, cache_folder)
+    with open(os.path.join(folder, "feed.json")) as infile:
+        tables = json.load(infile)["tables"]
+    data = {}
+    for table in tables:
+        df = pandas.read_parquet(os.path.join(folder, f"{table}.parquet"))
+        for column in df.columns:
+            if isinstance(df[column].dtype, pandas.CategoricalDtype):
+                df[column] = df[column].astype(object)
+        if not seconds:
+            for column in GTFS_TIME_COLUMNS.get(table, []):
+                if column in df.columns:
+                    df[column] = seconds_to_time(df[column])
+        data[table] = df
+    return GTFS(**data)
 
 
 def download_gtfs_using_yaml(
@@ -158,6 +382,7 @@ def remove_routes_from_gtfs(gtfs_path: str, output_folder: str, route_ids: list[
     # Make the output folder if it doesn't exist
     # Write the GTFS file
     zipfile_name = os.path.basename(gtfs_path)
+    # Not through the feed cache, which would re-render the written times
     gtfs = GTFS.load_zip(gtfs_path)
     gtfs.delete_routes(route_ids)
     if not os.path.exists(output_folder):
@@ -179,7 +404,7 @@ def get_all_stops(gtfs_folder) -> geopandas.GeoDataFrame:
         # Load the zipfile
         print(" ", filename)
         try:
-            gtfs = GTFS.load_zip(os.path.join(gtfs_folder, filename))
+            gtfs = load_gtfs(os.path.join(gtfs_folder, filename))
             # Get the stops
             stops = gtfs.stops[["stop_id", "stop_name", "stop_lat", "stop_lon"]].copy()
             stops["agency"] = filename[:-4]
@@ -200,6 +425,7 @@ def remove_routes_from_gtfs(gtfs_path: str, output_folder: str, route_ids: list[
     # Make the output folder if it doesn't exist
     # Write the GTFS file
     zipfile_name = os.path.basename(gtfs_path)
+    # Not through the feed cache, which would re-render the written times
     gtfs = GTFS.load_zip(gtfs_path)
     gtfs.delete_routes(route_ids)
     if not os.path.exists(output_folder):
@@ -302,7 +528,7 @@ def check_valid_dates(gtfs_folder: str, week_of_deltas: list[int]):
             print("-->", date, agency_feed, "<--")
             agency_name = agency_feed.removesuffix(".zip")
             feed_zip = os.path.join(dated_folder, agency_feed)
-            feed_df = GTFS.load_zip(feed_zip)
+            feed_df = load_gtfs(feed_zip)
             days_to_check = []
             dates_not_covered[agency_name] = []
             trips_not_covered[agency_name] = []
@@ -424,7 +650,7 @@ def stops_in_block_groups(
     for filename in os.listdir(gtfs_folder):
         print(filename)
         try:
-            gtfs = GTFS.load_zip(os.path.join(gtfs_folder, filename))
+            gtfs = load_gtfs(os.path.join(gtfs_folder, filename))
             column_name = os.path.splitext(filename)[0]
             columns.append(column_name)
             stops = geopandas.GeoDataFrame(
@@ -476,7 +702,7 @@ def summarize_gtfs_data(gtfs_folder, date: datetime.date) -> pandas.DataFrame:
     for filename in os.listdir(gtfs_folder):
         print("Summarizing", filename)
         try:
-            gtfs = GTFS.load_zip(os.path.join(gtfs_folder, filename))
+            gtfs = load_gtfs(os.path.join(gtfs_folder, filename))
             summary = gtfs.summary()
             summary["service_hours"] = gtfs.service_hours(date=date)
             summary["file"] = os.path.splitext(filename)[0]
@@ -547,7 +773,7 @@ def match_with_mobility_database(
         else:
             try:
                 print("  Loading", filename)
-                gtfs = GTFS.load_zip(os.path.join(gtfs_folder, filename))
+                gtfs = load_gtfs(os.path.join(gtfs_folder, filename))
                 if gtfs.feed_info is not None:
                     name_to_check = gtfs.feed_info.iloc[0].feed_publisher_name.lower()
                     name_to_check = slugify(name_to_check)
@@ -605,18 +831,205 @@ def match_with_mobility_database(
     return pandas.DataFrame(new_mapping)
 
 
+def time_to_seconds(times: pandas.Series) -> numpy.ndarray:
+    """Convert GTFS times (HH:MM:SS) to seconds since midnight
+
+    Parameters
+    ----------
+    times : pandas.Series
+        The GTFS times, which may be greater than 24:00:00 and must not be
+        missing. Times already in seconds are returned as they are.
+
+    Returns
+    -------
+    numpy.ndarray
+        The seconds since midnight of each time
+    """
+    if pandas.api.types.is_numeric_dtype(times):
+        return times.to_numpy(dtype=numpy.int64)
+    parts = times.str.split(":", expand=True).astype(numpy.int64)
+    return (parts[0] * 3600 + parts[1] * 60 + parts[2]).to_numpy()
+
+
+def seconds_to_time(seconds: pandas.Series) -> pandas.Series:
+    """Convert seconds since midnight to GTFS times (HH:MM:SS)
+
+    Parameters
+    ----------
+    seconds : pandas.Series
+        The seconds since midnight, which may be missing
+
+    Returns
+    -------
+    pandas.Series
+        The GTFS time strings, with NaN where the seconds are missing
+    """
+    times = pandas.Series(numpy.nan, index=seconds.index, dtype=object)
+    found = seconds.notna()
+    values = seconds[found].to_numpy(dtype=numpy.int64)
+    digits = numpy.array([f"{value:02d}" for value in range(100)], dtype=object)
+    times[found] = pyarrow.compute.binary_join_element_wise(
+        digits[values // 3600],
+        digits[values // 60 % 60],
+        digits[values % 60],
+        ":",
+    ).to_numpy(zero_copy_only=False)
+    return times
+
+
+def trip_stop_times(gtfs: GTFS, time_field: str = "arrival_time") -> pandas.DataFrame:
+    """Get the time every trip instance of a feed visits each of its stops
+
+    Trips in frequencies.txt are expanded into one instance per headway, each
+    visiting its stops at the same offsets from its start as the trip's stop
+    times. Stop times without a time are dropped.
+
+    Parameters
+    ----------
+    gtfs : GTFS
+        The feed
+    time_field : str, optional
+        The time column of `stop_times` to use, by default "arrival_time"
+
+    Returns
+    -------
+    pandas.DataFrame
+        The trip_id, instance, stop_id and time (seconds since midnight) of
+        each visit, where instance is the start time of a frequency-based trip
+        and 0 for scheduled trips
+    """
+    stop_times = gtfs.stop_times[~gtfs.stop_times[time_field].isna()]
+    visits = pandas.DataFrame(
+        {
+            "trip_id": stop_times.trip_id.to_numpy(),
+            "instance": 0,
+            "stop_id": stop_times.stop_id.to_numpy(),
+            "time": time_to_seconds(stop_times[time_field]),
+        }
+    )
+    if gtfs.frequencies is None or gtfs.frequencies.empty:
+        return visits
+
+    frequencies = gtfs.frequencies
+    headway = frequencies.headway_secs.to_numpy(dtype=numpy.int64)
+    start = time_to_seconds(frequencies.start_time)
+    end = time_to_seconds(frequencies.end_time)
+    # A trip starts every headway from the start time, up to the end time
+    repeats = numpy.maximum(-((start - end) // headway), 0)
+    first = numpy.repeat(numpy.cumsum(repeats) - repeats, repeats)
+    instances = pandas.DataFrame(
+        {
+            "trip_id": numpy.repeat(frequencies.trip_id.to_numpy(), repeats),
+            "instance": numpy.repeat(start, repeats)
+            + (numpy.arange(repeats.sum()) - first) * numpy.repeat(headway, repeats),
+        }
+    )
+
+    frequent = visits.trip_id.isin(frequencies.trip_id)
+    templates = visits[frequent].drop(columns="instance")
+    templates["time"] -= templates.groupby("trip_id").time.transform("min")
+    expanded = pandas.merge(templates, instances, on="trip_id")
+    expanded["time"] += expanded.instance
+    return pandas.concat(
+        [visits[~frequent], expanded[visits.columns]], ignore_index=True
+    )
+
+
 def compute_transit_service_intensity(
-    gtfs_folder, date: datetime.date
+    gtfs_folder,
+    areas: geopandas.GeoDataFrame,
+    runs: dict,
+    window: datetime.timedelta = datetime.timedelta(hours=2),
+    id_column: str = "BG20",
+    cache_folder: str = GTFS_CACHE_FOLDER,
 ) -> pandas.DataFrame:
-    for filename in os.listdir(gtfs_folder):
+    """Count the unique trips serving each area in the window of every run
+
+    Each feed is read once, through the feed cache. Its stops are matched to
+    the areas with a single spatial join, and every visit of a trip to a stop in an area is checked
+    against all the run windows at once. A trip counts once per area and window
+    no matter how many of the area's stops it visits, which matches summing
+    `GTFS.unique_trip_count_at_stops` over the feeds for the stops of each
+    area. Frequency-based trips count once per scheduled instance.
+
+    Parameters
+    ----------
+    gtfs_folder : str
+        The folder of GTFS zipfiles
+    areas : geopandas.GeoDataFrame
+        The areas, in a projected CRS, already buffered to take in nearby stops
+    runs : dict
+        The start time of each run, by run key
+    window : datetime.timedelta, optional
+        The length of the window after each start time, by default 2 hours
+    id_column : str, optional
+        The area id column, by default "BG20"
+    cache_folder : str, optional
+        The folder of all feed caches, by default `GTFS_CACHE_FOLDER`, or None
+        to parse the zipfiles without caching them
+
+    Returns
+    -------
+    pandas.DataFrame
+        The trip count of each run key, indexed by area id
+    """
+    ids = pandas.Index(areas[id_column].unique(), name=id_column)
+    counts = numpy.zeros((len(ids), len(runs)), dtype=numpy.int64)
+    dates = sorted({start.date() for start in runs.values()})
+    day = numpy.array([dates.index(start.date()) for start in runs.values()])
+    starts = numpy.array(
+        [
+            (start - datetime.datetime.combine(start.date(), datetime.time()))
+            // datetime.timedelta(seconds=1)
+            for start in runs.values()
+        ]
+    )
+    ends = starts + window // datetime.timedelta(seconds=1)
+    for filename in sorted(os.listdir(gtfs_folder)):
+        print("  Computing for", filename)
         try:
-            gtfs = GTFS.load_zip(os.path.join(gtfs_folder, filename))
-            # Let's now load the block goups
-            # Get a set of stops we need to "batch"
-            # Get unique trips for each stop
-            # Somehow handle frequency-level information
+            gtfs = load_gtfs(
+                os.path.join(gtfs_folder, filename),
+                seconds=True,
+                cache_folder=cache_folder,
+            )
         except zipfile.BadZipFile:
             print(filename, "is not a valid zipfile, skipping...")
+            continue
+
+        stops = geopandas.GeoDataFrame(
+            gtfs.stops[["stop_id"]],
+            geometry=geopandas.points_from_xy(gtfs.stops.stop_lon, gtfs.stops.stop_lat),
+            crs="EPSG:4326",
+        ).to_crs(areas.crs)
+        stop_areas = geopandas.sjoin(stops, areas[[id_column, "geometry"]])
+        visits = pandas.merge(
+            trip_stop_times(gtfs),
+            stop_areas[["stop_id", id_column]].drop_duplicates(),
+            on="stop_id",
+        )
+        if visits.empty:
+            continue
+
+        # Which visits fall in which run windows, for all windows at once
+        active = numpy.column_stack(
+            [visits.trip_id.isin(gtfs.date_trips(date).trip_id) for date in dates]
+        )
+        time = visits.time.to_numpy()[:, None]
+        inside = active[:, day] & (time >= starts) & (time <= ends)
+        rows, windows = numpy.nonzero(inside)
+        served = pandas.DataFrame(
+            {
+                "area": ids.get_indexer(visits[id_column])[rows],
+                "trip": visits.groupby(["trip_id", "instance"])
+                .ngroup()
+                .to_numpy()[rows],
+                "window": windows,
+            }
+        ).drop_duplicates()
+        numpy.add.at(counts, (served.area.to_numpy(), served.window.to_numpy()), 1)
+
+    return pandas.DataFrame(counts, index=ids, columns=list(runs))
 
 
 def rename_ted1_gtfs_folders(gtfs_folder: str):
@@ -712,7 +1125,7 @@ class TransitLand:
         urllib.request.urlretrieve(url, output_filename)
 
     def search_using_gtfs_agency(self, gtfs_file) -> pandas.DataFrame:
-        gtfs = GTFS.load_zip(gtfs_file)
+        gtfs = load_gtfs(gtfs_file)
         agency_name = gtfs.agency.iloc[0].agency_name
         agency_data = {
             "id": [],
@@ -0,0 +1,468 @@
+"""Dense origin-destination matrices over a region's block groups
+
+This module stores travel time, fare and auto matrices as square `uint16`
+arrays in the order of one canonical block group index per region, so that
+matrices of the same region line up cell for cell instead of being merged on
+their from_id and to_id strings. Matrices are saved as memory-mappable .npy
+files with a JSON sidecar holding the index, the cost column and the sentinel
+of missing cells."""
+
+import json
+import os
+
+import geopandas
+import numpy
+import pandas
+import pyarrow
+import pyarrow.parquet
+
+#: The dtype matrices are stored in
+MATRIX_DTYPE = numpy.uint16
+#: The value of unreachable pairs
+UNREACHABLE = numpy.iinfo(MATRIX_DTYPE).max
+#: The number of long format rows read or written at a time
+MATRIX_BATCH_ROWS = 1000000
+#: The name of the block group id column
+BGNAME = "BG20"
+
+
+def read_region_index(gpkg: str, layer: str = "bg_centroids") -> pandas.Index:
+    """Read the canonical block group index of a region
+
+    Parameters
+    ----------
+    gpkg : str
+        The region geopackage
+    layer : str, optional
+        The block group layer, by default "bg_centroids"
+
+    Returns
+    -------
+    pandas.Index
+        The block group ids, in the order of the matrix rows and columns
+    """
+    ids = geopandas.read_file(gpkg, layer=layer, ignore_geometry=True)[BGNAME]
+    return make_index(ids)
+
+
+def make_index(ids) -> pandas.Index:
+    """Build a matrix index from block group ids, which must be unique"""
+    index = pandas.Index(numpy.asarray(ids, dtype=object), name=BGNAME)
+    if not index.is_unique:
+        raise ValueError("The block group ids of a matrix index must be unique")
+    return index
+
+
+class DenseMatrix:
+    """A square cost matrix over a block group index
+
+    Costs are held as whole `uint16` units, with `sentinel` in the cells of
+    pairs without a cost. Matrices loaded from disk are memory-mapped, and the
+    origin and destination readers return views rather than copies.
+
+    Parameters
+    ----------
+    index : pandas.Index
+        The block group ids of the rows and columns
+    values : numpy.ndarray
+        The square `uint16` cost array
+    column : str, optional
+        The name of the cost, by default "travel_time"
+    sentinel : int, optional
+        The value of missing cells, by default `UNREACHABLE`
+    """
+
+    def __init__(
+        self,
+        index: pandas.Index,
+        values: numpy.ndarray,
+        column: str = "travel_time",
+        sentinel: int = UNREACHABLE,
+    ):
+        if values.shape != (len(index), len(index)):
+            raise ValueError(
+                f"A {values.shape} matrix does not fit an index of {len(index)}"
+            )
+        self.index = index
+        self.values = values
+        self.column = column
+        self.sentinel = sentinel
+
+    def __len__(self):
+        return len(self.index)
+
+    def aligned(self, other: "DenseMatrix") -> bool:
+        """Whether the cells of two matrices refer to the same pairs"""
+        return self.index is other.index or self.index.equals(other.index)
+
+    def reindex(self, index: pandas.Index) -> "DenseMatrix":
+        """Lay the matrix out over another index
+
+        Matrices already on `index` are returned as they are. Otherwise the
+        costs are gathered into a new array, with the sentinel for the block
+        groups the matrix does not have.
+        """
+        if self.index.equals(index):
+            return DenseMatrix(index, self.values, self.column, self.sentinel)
+        codes = self.index.get_indexer(index)
+        padded = numpy.full((len(self) + 1, len(self) + 1), self.sentinel, MATRIX_DTYPE)
+        padded[:-1, :-1] = self.values
+        return DenseMatrix(
+            index, padded[numpy.ix_(codes, codes)], self.column, self.sentinel
+        )
+
+    def origin(self, bg: str) -> numpy.ndarray:
+        """The costs from one block group to every block group"""
+        return self.values[self.index.get_loc(bg)]
+
+    def destination(self, bg: str) -> numpy.ndarray:
+        """The costs from every block group to one block group"""
+        return self.values[:, self.index.get_loc(bg)]
+
+    def reachable(self) -> numpy.ndarray:
+        """The boolean mask of the pairs with a cost"""
+        return self.values != self.sentinel
+
+    def save(self, npy_file: str):
+        """Save the matrix to a .npy file and its .npy.json sidecar"""
+        numpy.save(npy_file, numpy.asarray(self.values))
+        write_sidecar(npy_file, self.index, self.column, self.sentinel)
+
+    @classmethod
+    def load(cls, npy_file: str, mmap_mode="r") -> "DenseMatrix":
+        """Open a matrix saved by `DenseMatrix.save`, memory-mapped by default
+
+        Parameters
+        ----------
+        npy_file : str
+            The .npy file, next to its .npy.json sidecar
+        mmap_mode : str, optional
+            The numpy memory-map mode, by default "r". None reads the whole
+            matrix into memory.
+
+        Returns
+        -------
+        DenseMatrix
+            The matrix
+        """
+        with open(npy_file + ".json") as infile:
+            meta = json.load(infile)
+        return cls(
+            make_index(meta[BGNAME]),
+            numpy.load(npy_file, mmap_mode=mmap_mode),
+            meta["column"],
+            meta["sentinel"],
+        )
+
+    @classmethod
+    def from_long(
+        cls,
+        df: pandas.DataFrame,
+        index: pandas.Index,
+        column: str = "travel_time",
+        from_column: str = "from_id",
+        to_column: str = "to_id",
+        sentinel: int = UNREACHABLE,
+        out: str = None,
+    ) -> "DenseMatrix":
+        """Build a matrix from a long format DataFrame
+
+        See `DenseMatrix.from_parquet`, which this reads a single batch with.
+        """
+        values = _empty_values(len(index), sentinel, out)
+        _fill_values(values, index, df, column, from_column, to_column, sentinel)
+        return _finish(cls(index, values, column, sentinel), out)
+
+    @classmethod
+    def from_parquet(
+        cls,
+        parquet: str,
+        index: pandas.Index,
+        column: str = "travel_time",
+        from_column: str = "from_id",
+        to_column: str = "to_id",
+        sentinel: int = UNREACHABLE,
+        out: str = None,
+    ) -> "DenseMatrix":
+        """Convert a long format parquet matrix, one batch of rows at a time
+
+        Fractional costs are rounded up, so a cost is within a whole cutoff
+        exactly when it was before. Missing costs and block groups outside of
+        `index` are left as the sentinel.
+
+        Parameters
+        ----------
+        parquet : str
+            The long format parquet file
+        index : pandas.Index
+            The block group index of the matrix
+        column : str, optional
+            The cost column, by default "travel_time"
+        from_column : str, optional
+            The origin column, by default "from_id"
+        to_column : str, optional
+            The destination column, by default "to_id"
+        sentinel : int, optional
+            The value of missing cells, by default `UNREACHABLE`
+        out : str, optional
+            A .npy file to build the matrix in and save it to, by default None
+            (in memory)
+
+        Returns
+        -------
+        DenseMatrix
+            The matrix
+        """
+        values = _empty_values(len(index), sentinel, out)
+        pf = pyarrow.parquet.ParquetFile(parquet)
+        for batch in pf.iter_batches(
+            batch_size=MATRIX_BATCH_ROWS, columns=[from_column, to_column, column]
+        ):
+            _fill_values(
+                values,
+                index,
+                batch.to_pandas(),
+                column,
+                from_column,
+                to_column,
+                sentinel,
+            )
+        return _finish(cls(index, values, column, sentinel), out)
+
+    def to_parquet(
+        self,
+        parquet: str,
+        from_column: str = "from_id",
+        to_column: str = "to_id",
+        fill=numpy.nan,
+        batch_rows=MATRIX_BATCH_ROWS,
+    ):
+        """Write the matrix as a long format parquet, one block of origins at a time
+
+        Parameters
+        ----------
+        parquet : str
+            The output parquet file
+        from_column : str, optional
+            The origin column, by default "from_id"
+        to_column : str, optional
+            The destination column, by default "to_id"
+        fill : float, optional
+            The cost written for missing cells, by default NaN
+        batch_rows : int, optional
+            The number of rows written at a time, by default `MATRIX_BATCH_ROWS`
+        """
+        ids = self.index.to_numpy()
+        schema = pyarrow.schema(
+            [
+                (from_column, pyarrow.string()),
+                (to_column, pyarrow.string()),
+                (self.column, pyarrow.float64()),
+            ]
+        )
+        step = max(batch_rows // max(len(self), 1), 1)
+        with pyarrow.parquet.ParquetWriter(parquet, schema) as writer:
+            for first in range(0, len(self), step):
+                block = numpy.asarray(self.values[first : first + step])
+                costs = block.ravel().astype(numpy.float64)
+                costs[block.ravel() == self.sentinel] = fill
+                writer.write_table(
+                    pyarrow.table(
+                        {
+                            from_column: numpy.repeat(
+                                ids[first : first + step], len(self)
+                            ),
+                            to_column: numpy.tile(ids, block.shape[0]),
+                            self.column: costs,
+                        },
+                        schema=schema,
+                    )
+                )
+
+
+class PackedMask:
+    """A boolean block group matrix packed eight pairs to a byte
+
+    Rows are only unpacked when they are indexed, so a mask can be passed as
+    the `mask` of the `ted.access` engines without being expanded in memory.
+
+    Parameters
+    ----------
+    index : pandas.Index
+        The block group ids of the rows and columns
+    bits : numpy.ndarray
+        The `uint8` rows packed by `numpy.packbits`
+    """
+
+    def __init__(self, index: pandas.Index, bits: numpy.ndarray):
+        if bits.shape != (len(index), (len(index) + 7) // 8):
+            raise ValueError(
+                f"A {bits.shape} mask does not fit an index of {len(index)}"
+            )
+        self.index = index
+        self.bits = bits
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, rows) -> numpy.ndarray:
+        return numpy.unpackbits(self.bits[rows], axis=-1, count=len(self.index)).astype(
+            bool
+        )
+
+    def count(self) -> int:
+        """The number of pairs in the mask"""
+        return int(numpy.unpackbits(self.bits).sum())
+
+    @classmethod
+    def from_parquet(
+        cls,
+        parquet: str,
+        index: pandas.Index,
+        threshold: float,
+        column: str = "fare_cost",
+        from_column: str = "from_id",
+        to_column: str = "to_id",
+    ) -> "PackedMask":
+        """Mask the pairs of a long format parquet at or below a threshold
+
+        Pairs missing from the parquet, or with a missing cost, are left out.
+        """
+        mask = numpy.zeros((len(index), len(index)), dtype=bool)
+        pf = pyarrow.parquet.ParquetFile(parquet)
+        for batch in pf.iter_batches(
+            batch_size=MATRIX_BATCH_ROWS, columns=[from_column, to_column, column]
+        ):
+            df = batch.to_pandas()
+            from_codes = index.get_indexer(df[from_column])
+            to_codes = index.get_indexer(df[to_column])
+            keep = (from_codes >= 0) & (to_codes >= 0)
+            mask[from_codes[keep], to_codes[keep]] = (
+                df[column].to_numpy()[keep] <= threshold
+            )
+        return cls(index, numpy.packbits(mask, axis=1))
+
+
+def open_fare_mask(parquet: str, index: pandas.Index, threshold: float) -> PackedMask:
+    """Open the mask of the pairs of a fare matrix at or below a fare threshold
+
+    The mask only depends on the fare matrix and the threshold, so it is cached
+    next to the fare matrix and shared by every week and run that uses it. The
+    fare matrix's first three columns are taken as the origin, destination and
+    fare, as in the block group fare matrices from `map_fare_matrix_to_bg`.
+
+    Parameters
+    ----------
+    parquet : str
+        The long format block group fare matrix
+    index : pandas.Index
+        The block group index of the region
+    threshold : float
+        The highest fare of the pairs in the mask
+
+    Returns
+    -------
+    PackedMask
+        The memory-mapped mask
+    """
+    npy_file = f"{os.path.splitext(parquet)[0]}_le{threshold:g}.npy"
+    if os.path.exists(npy_file + ".json") and os.path.getmtime(
+        npy_file + ".json"
+    ) >= os.path.getmtime(parquet):
+        with open(npy_file + ".json") as infile:
+            meta = json.load(infile)
+        if meta["threshold"] == threshold and index.equals(make_index(meta[BGNAME])):
+            return PackedMask(index, numpy.load(npy_file, mmap_mode="r"))
+    print("  Building the fare mask of", parquet)
+    from_column, to_column, column = pyarrow.parquet.read_schema(parquet).names[:3]
+    mask = PackedMask.from_parquet(
+        parquet, index, threshold, column, from_column, to_column
+    )
+    numpy.save(npy_file, mask.bits)
+    with open(npy_file + ".json", "w") as outfile:
+        json.dump({BGNAME: index.tolist(), "threshold": threshold}, outfile)
+    return mask
+
+
+def open_dense_matrix(
+    parquet: str,
+    index: pandas.Index,
+    column: str = "travel_time",
+    from_column: str = "from_id",
+    to_column: str = "to_id",
+    sentinel: int = UNREACHABLE,
+) -> DenseMatrix:
+    """Open the dense version of a long format parquet matrix
+
+    The matrix is converted to a .npy file next to the parquet the first time it
+    is opened, and read back memory-mapped afterwards as long as it is newer
+    than the parquet and on the same index.
+
+    Parameters
+    ----------
+    parquet : str
+        The long format parquet file
+    index : pandas.Index
+        The block group index of the region
+    column : str, optional
+        The cost column, by default "travel_time"
+    from_column : str, optional
+        The origin column, by default "from_id"
+    to_column : str, optional
+        The destination column, by default "to_id"
+    sentinel : int, optional
+        The value of missing cells, by default `UNREACHABLE`
+
+    Returns
+    -------
+    DenseMatrix
+        The memory-mapped matrix
+    """
+    npy_file = os.path.splitext(parquet)[0] + ".npy"
+    if os.path.exists(npy_file + ".json") and os.path.getmtime(
+        npy_file + ".json"
+    ) >= os.path.getmtime(parquet):
+        matrix = DenseMatrix.load(npy_file)
+        if matrix.column == column and matrix.index.equals(index):
+            return matrix
+    print("  Converting", parquet, "to a dense matrix")
+    return DenseMatrix.from_parquet(
+        parquet, index, column, from_column, to_column, sentinel, out=npy_file
+    )
+
+
+def write_sidecar(npy_file: str, index: pandas.Index, column: str, sentinel: int):
+    """Write the index, cost column and sentinel of a saved matrix"""
+    with open(npy_file + ".json", "w") as outfile:
+        json.dump(
+            {BGNAME: index.tolist(), "column": column, "sentinel": int(sentinel)},
+            outfile,
+        )
+
+
+def _empty_values(size: int, sentinel: int, out: str = None) -> numpy.ndarray:
+    if out is None:
+        return numpy.full((size, size), sentinel, dtype=MATRIX_DTYPE)
+    values = numpy.lib.format.open_memmap(
+        out, mode="w+", dtype=MATRIX_DTYPE, shape=(size, size)
+    )
+    values[:] = sentinel
+    return values
+
+
+def _fill_values(values, index, df, column, from_column, to_column, sentinel):
+    from_codes = index.get_indexer(df[from_column])
+    to_codes = index.get_indexer(df[to_column])
+    costs = numpy.ceil(df[column].to_numpy(dtype=numpy.float64, na_value=numpy.nan))
+    found = (from_codes >= 0) & (to_codes >= 0) & ~numpy.isnan(costs)
+    if (costs[found] >= sentinel).any() or (costs[found] < 0).any():
+        raise ValueError(f"{column} values must lie between 0 and {sentinel - 1}")
+    values[from_codes[found], to_codes[found]] = costs[found]
+
+
+def _finish(matrix: DenseMatrix, out: str = None) -> DenseMatrix:
+    if out is None:
+        return matrix
+    matrix.values.flush()
+    write_sidecar(out, matrix.index, matrix.column, matrix.sentinel)
+    return DenseMatrix.load(out)
@@ -0,0 +1,1288 @@
+"""OpenTripPlanner itinerary queries
+
+This module contains the client code used to fetch transit itineraries from an
+OpenTripPlanner (OTP) GraphQL endpoint, along with the runners that generate
+itinerary chunks for a whole region."""
+
+import asyncio
+import bisect
+import collections
+import datetime
+import hashlib
+import itertools
+import json
+import logging
+import os
+import random
+import sqlite3
+import time
+
+import aiohttp
+import numpy
+import pandas
+import pyarrow
+import pyarrow.dataset
+import pyarrow.parquet
+from pytz import timezone
+import requests
+from tqdm import tqdm
+import yaml
+
+#: The default OTP GraphQL endpoint
+OTP_ENDPOINT = "http://localhost:8080/otp/routers/default/index/graphql"
+#: The number of OTP requests kept in flight at once
+OTP_CONCURRENCY = 16
+#: The number of times a failed OTP request is retried
+OTP_RETRIES = 4
+#: The base delay in seconds between retries, doubled on each attempt
+OTP_BACKOFF = 0.5
+#: The number of seconds to wait for a single OTP response
+OTP_TIMEOUT = 120
+#: The seconds between health checks of pooled OTP endpoints
+OTP_HEALTH_INTERVAL = 10
+#: The seconds a health check waits for an OTP endpoint to answer
+OTP_HEALTH_TIMEOUT = 5
+#: How many times slower than the fastest endpoint a pooled endpoint may get
+OTP_SLOW_FACTOR = 3
+#: The number of recent requests an endpoint's median latency is taken over
+OTP_SLOW_SAMPLES = 20
+#: The seconds a slow endpoint is left out of the pool
+OTP_EJECT_SECONDS = 60
+#: The upper bounds in seconds of the endpoint latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+#: The number of trip plans packed into one OTP request
+OTP_BATCH_SIZE = 20
+#: The number of OD pairs generated at a time when building job lists
+OTP_JOB_BLOCK = 100000
+#: The name of the OTP response cache file kept in the graph folder
+OTP_CACHE_FILE = "otp_cache.db"
+#: The name of the job manifest kept in an OTP run's chunk folder
+OTP_MANIFEST_FILE = "_manifest.db"
+
+#: The itinerary fields requested for every trip plan
+PLAN_FRAGMENT = """
+fragment PlanFields on Plan {
+    itineraries {
+        startTime
+        endTime
+        legs {
+            mode
+            startTime
+            endTime
+            from { stop { gtfsId } departureTime }
+            to { stop { gtfsId } departureTime }
+            route { gtfsId agency { gtfsId name } }
+        }
+    }
+}
+"""
+#: The arguments of one aliased trip plan, filled in with `str.format`
+PLAN_TEMPLATE = (
+    "{alias}: plan("
+    "from: {{ lat: {from_lat}, lon: {from_lon} }}, "
+    "to: {{ lat: {to_lat}, lon: {to_lon} }}, "
+    'date: "{date}", time: "{time}", '
+    "transportModes: [{{ mode: WALK }}, {{ mode: TRANSIT }}]"
+    ") {{ ...PlanFields }}"
+)
+
+#: The time zone itinerary departure times are given in
+OTP_TIMEZONE = "America/New_York"
+
+_dictionary = pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+#: The column types of itinerary fragments, with repetitive strings dictionary encoded
+ITINERARY_SCHEMA = pyarrow.schema(
+    [
+        ("from_id", pyarrow.int64()),
+        ("to_id", pyarrow.int64()),
+        ("segment", pyarrow.int32()),
+        ("mode", _dictionary),
+        ("departure_time", pyarrow.timestamp("ms", tz=OTP_TIMEZONE)),
+        ("feed", _dictionary),
+        ("agency_id", _dictionary),
+        ("route_id", _dictionary),
+        ("start_stop_id", _dictionary),
+        ("end_stop_id", _dictionary),
+    ]
+)
+
+
+class OTPQuery:
+    OTP_ENDPOINT = OTP_ENDPOINT
+
+    def __init__(self, feeds):
+        self.feeds = feeds
+
+    def query_route(
+        self,
+        from_id: str,
+        to_id: str,
+        from_lat: float,
+        from_lon: float,
+        to_lat: float,
+        to_lon: float,
+        start_datetime: datetime.datetime,
+    ) -> pandas.DataFrame:
+        q = self.build_query(from_lat, from_lon, to_lat, to_lon, start_datetime)
+        r = requests.post(self.OTP_ENDPOINT, json={"query": q})
+        plan = json.loads(r.text)["data"]["plan"]
+        return self.parse_plan(from_id, to_id, plan)
+
+    def build_query(
+        self,
+        from_lat: float,
+        from_lon: float,
+        to_lat: float,
+        to_lon: float,
+        start_datetime: datetime.datetime,
+    ) -> str:
+        """Build the GraphQL query for a single trip plan"""
+        plan = _plan_selection(
+            "plan", from_lat, from_lon, to_lat, to_lon, start_datetime
+        )
+        return "{ " + plan + " }" + PLAN_FRAGMENT
+
+    def build_batch_query(self, jobs: list) -> str:
+        """Build one GraphQL document that plans every job
+
+        Each job gets its own aliased `plan` field (`p0`, `p1`, ...) and all of
+        them share a single fragment, so the server parses the itinerary
+        selection once however many plans are packed in.
+
+        Parameters
+        ----------
+        jobs : list
+            The jobs to plan, as (from ID, to ID, from lat, from lon, to lat,
+            to lon, departure datetime) tuples
+
+        Returns
+        -------
+        str
+            The GraphQL document
+        """
+        plans = [_plan_selection(f"p{idx}", *job[2:]) for idx, job in enumerate(jobs)]
+        return "{ " + " ".join(plans) + " }" + PLAN_FRAGMENT
+
+    def parse_batch(self, jobs: list, data: dict) -> list:
+        """Split a batch response back into the legs of each job
+
+        Parameters
+        ----------
+        jobs : list
+            The jobs the batch query was built from
+        data : dict
+            The `data` object of the GraphQL response
+
+        Returns
+        -------
+        list
+            The legs DataFrame of each job, or None where its plan is missing
+        """
+        results = []
+        for idx, job in enumerate(jobs):
+            plan = data.get(f"p{idx}")
+            if plan is None:
+                results.append(None)
+            else:
+                results.append(self.parse_plan(job[0], job[1], plan))
+        return results
+
+    def parse_plan(self, from_id: str, to_id: str, plan: dict) -> pandas.DataFrame:
+        """Turn a trip plan response into the legs of its fastest itinerary
+
+        Parameters
+        ----------
+        from_id : str
+            The origin ID
+        to_id : str
+            The destination ID
+        plan : dict
+            The `plan` object of the GraphQL response
+
+        Returns
+        -------
+        pandas.DataFrame
+            One row per leg of the fastest itinerary
+        """
+        itineraries = plan["itineraries"]
+        leg_data = {
+            "from_id": [],
+            "to_id": [],
+            "option": [],
+            "segment": [],
+            "mode": [],
+            "departure_time": [],
+            "feed": [],
+            "agency_id": [],
+            "route_id": [],
+            "start_stop_id": [],
+            "end_stop_id": [],
+        }
+        option_data = {"option": [], "startTime": [], "endTime": []}
+        for idx, itinerary in enumerate(itineraries):
+            option_data["option"].append(idx)
+            option_data["startTime"].append(itinerary["startTime"])
+            option_data["endTime"].append(itinerary["endTime"])
+            for lidx, leg in enumerate(itinerary["legs"]):
+                leg_data["from_id"].append(from_id)
+                leg_data["to_id"].append(to_id)
+                leg_data["option"].append(idx)
+                leg_data["segment"].append(lidx)
+                leg_data["mode"].append(leg["mode"])
+                departure_time = datetime.datetime.fromtimestamp(
+                    leg["from"]["departureTime"] / 1000, timezone(OTP_TIMEZONE)
+                )
+                leg_data["departure_time"].append(departure_time)
+                if leg["from"]["stop"] != None:
+                    leg_data["start_stop_id"].append(
+                        leg["from"]["stop"]["gtfsId"].split(":")[1]
+                    )
+                else:
+                    leg_data["start_stop_id"].append(None)
+                if leg["to"]["stop"] != None:
+                    leg_data["end_stop_id"].append(
+                        leg["to"]["stop"]["gtfsId"].split(":")[1]
+                    )
+                else:
+                    leg_data["end_stop_id"].append(None)
+                if leg["route"] != None:
+                    leg_data["route_id"].append(leg["route"]["gtfsId"].split(":")[1])
+                    leg_data["agency_id"].append(
+                        leg["route"]["agency"]["gtfsId"].split(":")[1]
+                    )
+                    leg_data["feed"].append(
+                        self.feeds[str(leg["route"]["agency"]["gtfsId"].split(":")[0])]
+                    )
+                else:
+                    leg_data["route_id"].append(None)
+                    leg_data["agency_id"].append(None)
+                    leg_data["feed"].append(None)
+        leg_df = pandas.DataFrame(leg_data)
+        options_df = pandas.DataFrame(option_data)
+        options_df["delta"] = (options_df.endTime - options_df.startTime) / 60000
+        try:
+            option = options_df.sort_values("delta").iloc[0].option.astype(int)
+            return leg_df[leg_df["option"] == option].drop(columns=["option"])
+        except IndexError:
+            return leg_df
+
+
+def _plan_selection(alias, from_lat, from_lon, to_lat, to_lon, start_datetime):
+    """Fill in the plan template for one trip"""
+    return PLAN_TEMPLATE.format(
+        alias=alias,
+        from_lat=from_lat,
+        from_lon=from_lon,
+        to_lat=to_lat,
+        to_lon=to_lon,
+        date=start_datetime.strftime("%Y-%m-%d"),
+        time=start_datetime.strftime("%H:%M"),
+    )
+
+
+class OTPRequestError(Exception):
+    """Raised when OTP answers with an error that is worth retrying"""
+
+
+class OTPEndpoint:
+    """One OTP instance in an `EndpointPool`, with its load and latency record
+
+    Parameters
+    ----------
+    url : str
+        The instance's GraphQL endpoint
+    """
+
+    def __init__(self, url: str):
+        self.url = url
+        self.outstanding = 0
+        self.requests = 0
+        self.errors = 0
+        self.healthy = True
+        self.ejected_until = 0.0
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.recent = collections.deque(maxlen=OTP_SLOW_SAMPLES)
+
+    def __repr__(self) -> str:
+        return f"<OTPEndpoint {self.url} | {self.outstanding} outstanding | {self.requests} requests | {self.errors} errors>"
+
+    @property
+    def median_latency(self) -> float:
+        """The median latency of the recent requests, in seconds"""
+        if len(self.recent) == 0:
+            return 0.0
+        return float(numpy.median(self.recent))
+
+    def record(self, latency: float):
+        """Record the latency of a successful request"""
+        self.histogram[bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+        self.recent.append(latency)
+
+
+class EndpointPool:
+    """Spread OTP requests over several instances of the same graph
+
+    Each request goes to the available endpoint with the fewest requests
+    outstanding. An endpoint that fails a request is taken out of the pool until
+    a health check gets an answer from it again, unless it is the only one. An
+    endpoint whose recent median latency is more than `slow_factor` times that
+    of the fastest endpoint is taken out for `eject_seconds`. If every endpoint
+    is out, requests are spread over all of them rather than stopping
+    altogether.
+
+    Parameters
+    ----------
+    urls : list
+        The GraphQL endpoints of the OTP instances
+    slow_factor : float, optional
+        How many times slower than the fastest endpoint an endpoint may get,
+        by default `OTP_SLOW_FACTOR`
+    eject_seconds : float, optional
+        How long slow endpoints are left out, by default `OTP_EJECT_SECONDS`
+    health_interval : float, optional
+        The seconds between health checks, by default `OTP_HEALTH_INTERVAL`
+    """
+
+    def __init__(
+        self,
+        urls: list,
+        slow_factor: float = OTP_SLOW_FACTOR,
+        eject_seconds: float = OTP_EJECT_SECONDS,
+        health_interval: float = OTP_HEALTH_INTERVAL,
+    ):
+        self.endpoints = [OTPEndpoint(url) for url in urls]
+        self.slow_factor = slow_factor
+        self.eject_seconds = eject_seconds
+        self.health_interval = health_interval
+
+    def __len__(self) -> int:
+        return len(self.endpoints)
+
+    def available(self) -> list:
+        """Get the endpoints currently in the pool"""
+        now = time.monotonic()
+        endpoints = [e for e in self.endpoints if e.healthy and e.ejected_until <= now]
+        if len(endpoints) == 0:
+            return self.endpoints
+        return endpoints
+
+    def acquire(self) -> OTPEndpoint:
+        """Pick the endpoint for a new request"""
+        endpoint = min(self.available(), key=lambda e: (e.outstanding, e.requests))
+        endpoint.outstanding += 1
+        endpoint.requests += 1
+        return endpoint
+
+    def release(self, endpoint: OTPEndpoint, latency):
+        """Record the end of a request, with a latency of None if it failed"""
+        endpoint.outstanding -= 1
+        if latency is None:
+            endpoint.errors += 1
+            # There are no health checks to put an only endpoint back
+            if len(self.endpoints) > 1:
+                if endpoint.healthy:
+                    logging.warning(
+                        f"Taking {endpoint.url} out of the pool after an error"
+                    )
+                endpoint.healthy = False
+            return
+        endpoint.record(latency)
+        self._check_slow(endpoint)
+
+    def _check_slow(self, endpoint: OTPEndpoint):
+        """Eject an endpoint that has become much slower than the fastest one"""
+        if len(self.endpoints) < 2 or len(endpoint.recent) < OTP_SLOW_SAMPLES:
+            return
+        others = [
+            e.median_latency
+            for e in self.available()
+            if e is not endpoint and len(e.recent) >= OTP_SLOW_SAMPLES
+        ]
+        if len(others) == 0:
+            return
+        if endpoint.median_latency > self.slow_factor * min(others):
+            logging.warning(
+                f"Taking {endpoint.url} out of the pool for {self.eject_seconds}s, "
+                f"its median latency is {endpoint.median_latency:.2f}s"
+            )
+            endpoint.ejected_until = time.monotonic() + self.eject_seconds
+            endpoint.recent.clear()
+
+    async def check_health(self, session: aiohttp.ClientSession):
+        """Ping every endpoint, putting back the ones that answer with a 2xx"""
+
+        async def ping(endpoint):
+            try:
+                async with session.post(
+                    endpoint.url,
+                    json={"query": "{ __typename }"},
+                    timeout=aiohttp.ClientTimeout(total=OTP_HEALTH_TIMEOUT),
+                ) as r:
+                    healthy = 200 <= r.status < 300
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                healthy = False
+            if healthy and not endpoint.healthy:
+                logging.info(f"Putting {endpoint.url} back in the pool")
+            endpoint.healthy = healthy
+
+        await asyncio.gather(*[ping(e) for e in self.endpoints])
+
+    async def monitor(self, session: aiohttp.ClientSession):
+        """Run health checks until cancelled, if there's more than one endpoint"""
+        if len(self.endpoints) < 2:
+            return
+        while True:
+            await asyncio.sleep(self.health_interval)
+            await self.check_health(session)
+
+    def report(self) -> str:
+        """Summarize the requests, errors and latency histogram of each endpoint"""
+        labels = [f"<{b}s" for b in LATENCY_BUCKETS] + [f">{LATENCY_BUCKETS[-1]}s"]
+        lines = []
+        for e in self.endpoints:
+            lines.append(f"  {e.url}: {e.requests} requests, {e.errors} errors")
+            counts = [f"{l} {c}" for l, c in zip(labels, e.histogram) if c > 0]
+            if len(counts) > 0:
+                lines.append("    " + " | ".join(counts))
+        return "\n".join(lines)
+
+
+class AsyncOTPClient:
+    """Query OTP concurrently over a pool of keep-alive connections
+
+    A fixed number of worker coroutines pull batches of jobs from a shared
+    iterator, so there are never more than `concurrency` requests in flight
+    and a slow request only holds up its own worker. Each request packs
+    `batch_size` trip plans into one GraphQL document. Jobs found in the
+    response cache, if one is given, are answered without a request. Failed
+    requests are retried with exponential backoff, and results are handed back
+    as soon as they complete rather than in submission order.
+
+    Requests are spread over one or more OTP instances by an `EndpointPool`,
+    which sends each one to the healthy instance with the fewest requests
+    outstanding.
+
+    Parameters
+    ----------
+    feeds : dict
+        The mapping of OTP feed IDs to feed names
+    endpoint : str, list or EndpointPool, optional
+        The OTP GraphQL endpoint, a list of endpoints of identical OTP
+        instances, or a pool of them, by default `OTP_ENDPOINT`
+    concurrency : int, optional
+        The number of requests in flight at once, by default `OTP_CONCURRENCY`
+    retries : int, optional
+        The number of retries for a failed request, by default `OTP_RETRIES`
+    backoff : float, optional
+        The base retry delay in seconds, by default `OTP_BACKOFF`
+    timeout : float, optional
+        The timeout of a single request in seconds, by default `OTP_TIMEOUT`
+    batch_size : int, optional
+        The number of plans packed into each request, by default `OTP_BATCH_SIZE`
+    cache : OTPResponseCache, optional
+        A cache of earlier responses to answer jobs from, by default None
+    """
+
+    def __init__(
+        self,
+        feeds: dict,
+        endpoint=OTP_ENDPOINT,
+        concurrency: int = OTP_CONCURRENCY,
+        retries: int = OTP_RETRIES,
+        backoff: float = OTP_BACKOFF,
+        timeout: float = OTP_TIMEOUT,
+        batch_size: int = OTP_BATCH_SIZE,
+        cache=None,
+    ):
+        self.otp = OTPQuery(feeds)
+        if isinstance(endpoint, EndpointPool):
+            self.pool = endpoint
+        elif isinstance(endpoint, str):
+            self.pool = EndpointPool([endpoint])
+        else:
+            self.pool = EndpointPool(endpoint)
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.cache = cache
+        self.failed = []
+
+    async def query_batch(self, session: aiohttp.ClientSession, jobs: list):
+        """Fetch the legs of a batch of jobs in one request, retrying failures
+
+        Only the jobs whose plans failed are sent again on a retry.
+
+        Parameters
+        ----------
+        session : aiohttp.ClientSession
+            The session to send the request through
+        jobs : list
+            The jobs, as from ID, to ID, from lat/lon, to lat/lon and departure
+            datetime tuples
+
+        Returns
+        -------
+        list
+            The legs of each job's fastest itinerary, empty where it failed
+        """
+        results = [None] * len(jobs)
+        pending = list(range(len(jobs)))
+        for attempt in range(self.retries + 1):
+            batch = [jobs[i] for i in pending]
+            query = self.otp.build_batch_query(batch)
+            endpoint = self.pool.acquire()
+            start = time.monotonic()
+            try:
+                async with session.post(endpoint.url, json={"query": query}) as r:
+                    if not 200 <= r.status < 300:
+                        raise OTPRequestError(f"HTTP {r.status}")
+                    try:
+                        response = await r.json(content_type=None)
+                    except ValueError as e:
+                        raise OTPRequestError(f"Invalid JSON response: {e}") from e
+            except (aiohttp.ClientError, asyncio.TimeoutError, OTPRequestError) as e:
+                self.pool.release(endpoint, None)
+                error = e
+            else:
+                self.pool.release(endpoint, time.monotonic() - start)
+                data = response.get("data") or {}
+                if self.cache is not None:
+                    self.cache.put_many(
+                        batch, [data.get(f"p{idx}") for idx in range(len(batch))]
+                    )
+                legs = self.otp.parse_batch(batch, data)
+                for i, leg_df in zip(pending, legs):
+                    results[i] = leg_df
+                pending = [i for i, leg_df in zip(pending, legs) if leg_df is None]
+                if len(pending) == 0:
+                    return results
+                errors = response.get("errors") or [{}]
+                error = OTPRequestError(errors[0].get("message", "Missing plans"))
+            if attempt < self.retries:
+                delay = self.backoff * 2**attempt
+                await asyncio.sleep(delay * (1 + random.random()))
+
+        for i in pending:
+            logging.warning(f"Giving up on {jobs[i][0]} -> {jobs[i][1]}: {error!r}")
+            self.failed.append(jobs[i])
+            results[i] = pandas.DataFrame(columns=ITINERARY_SCHEMA.names)
+            results[i].attrs["failed"] = True
+        return results
+
+    async def run(self, jobs, on_result):
+        """Query every job, calling `on_result(job, legs)` as each completes
+
+        Parameters
+        ----------
+        jobs : iterable
+            The jobs to run, consumed lazily
+        on_result : callable
+            Called with each job and its legs DataFrame
+        """
+        jobs = iter(jobs)
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        async with aiohttp.ClientSession(
+            connector=connector, timeout=timeout
+        ) as session:
+
+            async def worker():
+                while True:
+                    batch = list(itertools.islice(jobs, self.batch_size))
+                    if len(batch) == 0:
+                        return
+                    if self.cache is not None:
+                        plans = self.cache.get_many(batch)
+                        for job, plan in zip(batch, plans):
+                            if plan is not None:
+                                on_result(
+                                    job, self.otp.parse_plan(job[0], job[1], plan)
+                                )
+                        batch = [job for job, plan in zip(batch, plans) if plan is None]
+                        if len(batch) == 0:
+                            continue
+                    for job, legs in zip(batch, await self.query_batch(session, batch)):
+                        on_result(job, legs)
+
+            monitor = asyncio.create_task(self.pool.monitor(session))
+            try:
+                await asyncio.gather(*[worker() for _ in range(self.concurrency)])
+            finally:
+                monitor.cancel()
+
+    def run_to_chunks(
+        self,
+        jobs,
+        output_folder: str,
+        prefix: str,
+        chunk_size: int,
+        total=None,
+        manifest=None,
+    ) -> int:
+        """Query every job, writing completed results to disk in chunks
+
+        Results are buffered in completion order and written as soon as
+        `chunk_size` of them have come back, so a chunk never waits on a
+        request that belongs to another chunk.
+
+        Parameters
+        ----------
+        jobs : iterable
+            The jobs to run, consumed lazily
+        output_folder : str
+            The folder to write the chunks into
+        prefix : str
+            The chunk file name prefix, usually the region key
+        chunk_size : int
+            The number of pairs per chunk
+        total : int, optional
+            The number of jobs, for progress reporting, by default None
+        manifest : JobManifest, optional
+            The manifest to record every written chunk in, by default None
+
+        Returns
+        -------
+        int
+            The number of chunks written
+        """
+        buffer = []
+        first_chunk = 0 if manifest is None else manifest.next_chunk
+        chunks = first_chunk
+        progress = tqdm(total=total)
+
+        def write_chunk():
+            nonlocal chunks
+            df_list = [legs for _, legs in buffer if not legs.empty]
+            path = None
+            if len(df_list) > 0:
+                path = os.path.join(output_folder, f"{prefix}_{chunks}.parquet")
+                write_itinerary_fragment(pandas.concat(df_list, axis="index"), path)
+            else:
+                print("    Chunk", chunks, "has no data")
+            if manifest is not None:
+                manifest.record_chunk(chunks, path, buffer)
+            chunks += 1
+            buffer.clear()
+
+        def on_result(job, legs):
+            buffer.append((job, legs))
+            progress.update(1)
+            if len(buffer) >= chunk_size:
+                write_chunk()
+
+        asyncio.run(self.run(jobs, on_result))
+        if len(buffer) > 0:
+            write_chunk()
+        progress.close()
+        print(self.pool.report())
+        if self.cache is not None:
+            print(f"  {self.cache}")
+        if len(self.failed) > 0:
+            print(f"  {len(self.failed)} pairs failed after {self.retries} retries")
+        return chunks - first_chunk
+
+
+class JobManifest:
+    """Track the OD pairs an OTP run has written, so it can be resumed
+
+    The manifest is a SQLite file in the chunk folder. For every chunk it keeps
+    the file name and a sha256 checksum of its contents. For every pair it
+    keeps the chunk it went into and whether it came back with an itinerary
+    (`ok`), without one (`empty`), or failed after all retries (`failed`).
+    Opening the manifest drops any chunk whose file is missing or no longer
+    matches its checksum, so the pairs in it are queued again.
+
+    Pairs are identified by packing the origin and destination IDs into one
+    64-bit key, so both must be non-negative integers below 2**31.
+
+    Parameters
+    ----------
+    output_folder : str
+        The chunk folder of the run
+    """
+
+    def __init__(self, output_folder: str):
+        self.output_folder = output_folder
+        self.conn = sqlite3.connect(os.path.join(output_folder, OTP_MANIFEST_FILE))
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS chunk (idx INTEGER PRIMARY KEY, file TEXT, checksum TEXT)"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS pair (key INTEGER PRIMARY KEY, chunk INTEGER, status TEXT)"
+        )
+        self.conn.commit()
+        self.verify()
+
+    def __repr__(self) -> str:
+        counts = dict(
+            self.conn.execute("SELECT status, COUNT(*) FROM pair GROUP BY status")
+        )
+        return f"<JobManifest {counts.get('ok', 0)} ok | {counts.get('empty', 0)} empty | {counts.get('failed', 0)} failed>"
+
+    @property
+    def next_chunk(self) -> int:
+        """The index to give the next chunk written"""
+        idx = self.conn.execute("SELECT MAX(idx) FROM chunk").fetchone()[0]
+        return 0 if idx is None else idx + 1
+
+    def verify(self):
+        """Forget every chunk whose file is missing or has changed"""
+        bad = []
+        for idx, f, checksum in self.conn.execute("SELECT * FROM chunk").fetchall():
+            if f is None:
+                continue
+            path = os.path.join(self.output_folder, f)
+            if not os.path.exists(path) or _file_checksum(path) != checksum:
+                bad.append(idx)
+                if os.path.exists(path):
+                    os.remove(path)
+        if len(bad) > 0:
+            print(f"  Requeuing {len(bad)} missing or damaged chunks")
+            rows = [(idx,) for idx in bad]
+            self.conn.executemany("DELETE FROM pair WHERE chunk = ?", rows)
+            self.conn.executemany("DELETE FROM chunk WHERE idx = ?", rows)
+            self.conn.commit()
+
+    def count(self, *statuses) -> int:
+        """Count the pairs recorded with any of the given statuses"""
+        return self.conn.execute(
+            f"SELECT COUNT(*) FROM pair WHERE status IN ({','.join('?' * len(statuses))})",
+            statuses,
+        ).fetchone()[0]
+
+    def keys(self, *statuses) -> numpy.ndarray:
+        """Get the sorted keys of the pairs with any of the given statuses"""
+        rows = self.conn.execute(
+            f"SELECT key FROM pair WHERE status IN ({','.join('?' * len(statuses))}) ORDER BY key",
+            statuses,
+        )
+        return numpy.fromiter((row[0] for row in rows), dtype=numpy.int64)
+
+    def filter_blocks(self, blocks, retry_failed: bool = False):
+        """Drop the pairs that don't need to be queried from blocks of jobs
+
+        Parameters
+        ----------
+        blocks : iterable
+            Blocks from `cross_join_job_blocks` or `pair_job_blocks`
+        retry_failed : bool, optional
+            Keep only the pairs that came back empty or failed, instead of the
+            ones not yet written, by default False
+
+        Yields
+        ------
+        dict
+            The blocks with the pairs to query
+        """
+        if retry_failed:
+            keys = self.keys("empty", "failed")
+        else:
+            keys = self.keys("ok", "empty")
+        for block in blocks:
+            # Pair lists may repeat pairs, so the keys of a block aren't unique
+            found = numpy.isin(_pair_keys(block["from_id"], block["to_id"]), keys)
+            keep = found if retry_failed else ~found
+            yield {column: values[keep] for column, values in block.items()}
+
+    def record_chunk(self, idx: int, path, results: list):
+        """Record a written chunk and the status of every pair in it
+
+        Parameters
+        ----------
+        idx : int
+            The chunk index
+        path : str or None
+            The chunk file, or None if no pair in it had an itinerary
+        results : list
+            The (job, legs) results that went into the chunk
+        """
+        statuses = []
+        for job, legs in results:
+            if legs.attrs.get("failed", False):
+                status = "failed"
+            elif legs.empty:
+                status = "empty"
+            else:
+                status = "ok"
+            statuses.append(status)
+        from_ids = numpy.array([job[0] for job, _ in results], dtype=numpy.int64)
+        to_ids = numpy.array([job[1] for job, _ in results], dtype=numpy.int64)
+        keys = _pair_keys(from_ids, to_ids).tolist()
+
+        if path is None:
+            self.conn.execute("INSERT INTO chunk VALUES (?, NULL, NULL)", (idx,))
+        else:
+            self.conn.execute(
+                "INSERT INTO chunk VALUES (?, ?, ?)",
+                (idx, os.path.basename(path), _file_checksum(path)),
+            )
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO pair VALUES (?, ?, ?)",
+            [(key, idx, status) for key, status in zip(keys, statuses)],
+        )
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+def _pair_keys(from_ids, to_ids) -> numpy.ndarray:
+    """Pack origin and destination IDs into single 64-bit pair keys"""
+    return from_ids.astype(numpy.int64) * 2**32 + to_ids.astype(numpy.int64)
+
+
+def _file_checksum(path: str) -> str:
+    """Get the sha256 hex digest of a file's contents"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as infile:
+        for block in iter(lambda: infile.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class OTPResponseCache:
+    """A persistent cache of OTP trip plan responses in a SQLite file
+
+    Responses are stored under a hash of the trip's coordinates, departure time
+    and the hash of the graph's GTFS inputs, so they are only ever reused for
+    the same query against the same graph. Opening the cache with a different
+    graph hash than the one it was filled with clears it.
+
+    Parameters
+    ----------
+    path : str
+        The SQLite file to keep the responses in
+    graph_hash : str
+        The hash of the OTP graph's inputs, see `graph_inputs_hash`
+    """
+
+    def __init__(self, path: str, graph_hash: str):
+        self.path = path
+        self.graph_hash = graph_hash
+        self.hits = 0
+        self.misses = 0
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS response (key TEXT PRIMARY KEY, plan TEXT)"
+        )
+        row = self.conn.execute(
+            "SELECT value FROM meta WHERE key = 'graph_hash'"
+        ).fetchone()
+        if row is None or row[0] != graph_hash:
+            if row is not None:
+                print("  OTP graph inputs changed, clearing the response cache")
+            self.conn.execute("DELETE FROM response")
+            self.conn.execute(
+                "INSERT OR REPLACE INTO meta VALUES ('graph_hash', ?)", (graph_hash,)
+            )
+        self.conn.commit()
+
+    def __repr__(self) -> str:
+        lookups = self.hits + self.misses
+        rate = self.hits / lookups if lookups > 0 else 0.0
+        return f"<OTPResponseCache {len(self)} plans | {self.hits} hits | {self.misses} misses | {rate:.1%}>"
+
+    def __len__(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM response").fetchone()[0]
+
+    def key(self, job: tuple) -> str:
+        """Get the cache key of a job"""
+        _, _, from_lat, from_lon, to_lat, to_lon, departure = job
+        raw = f"{from_lat:.6f},{from_lon:.6f},{to_lat:.6f},{to_lon:.6f},{departure.isoformat()},{self.graph_hash}"
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def get_many(self, jobs: list) -> list:
+        """Get the cached plans of some jobs, with None for the ones not cached"""
+        keys = [self.key(job) for job in jobs]
+        rows = self.conn.execute(
+            f"SELECT key, plan FROM response WHERE key IN ({','.join('?' * len(keys))})",
+            keys,
+        ).fetchall()
+        found = {key: json.loads(plan) for key, plan in rows}
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return [found.get(key) for key in keys]
+
+    def put_many(self, jobs: list, plans: list):
+        """Cache the plans of some jobs
+
+        Missing plans and plans without itineraries are skipped, so pairs sent
+        again with `retry_failed` really do reach OTP.
+        """
+        rows = [
+            (self.key(job), json.dumps(plan))
+            for job, plan in zip(jobs, plans)
+            if plan is not None and len(plan["itineraries"]) > 0
+        ]
+        self.conn.executemany("INSERT OR REPLACE INTO response VALUES (?, ?)", rows)
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+def graph_inputs_hash(otp_folder: str) -> str:
+    """Hash the contents of the GTFS zip files an OTP graph is built from
+
+    Parameters
+    ----------
+    otp_folder : str
+        The OTP graph folder
+
+    Returns
+    -------
+    str
+        The hex digest of the sorted GTFS files' names and contents
+    """
+    digest = hashlib.sha256()
+    for f in sorted(os.listdir(otp_folder)):
+        if not f.endswith(".zip"):
+            continue
+        digest.update(f.encode())
+        digest.update(_file_checksum(os.path.join(otp_folder, f)).encode())
+    return digest.hexdigest()
+
+
+def _read_feeds(fares_yaml: str) -> dict:
+    """Read the OTP feed ID to feed name mapping from a fares config file"""
+    with open(fares_yaml) as infile:
+        config = yaml.safe_load(infile)
+
+    return {
+        (str(key) if isinstance(key, int) else key): config["feeds"][key]
+        for key in config["feeds"]
+    }
+
+
+def _open_response_cache(fares_yaml: str, cache_file=None) -> OTPResponseCache:
+    """Open the response cache for the OTP graph a fares config belongs to"""
+    otp_folder = os.path.dirname(os.path.abspath(fares_yaml))
+    if cache_file is None:
+        cache_file = os.path.join(otp_folder, OTP_CACHE_FILE)
+    return OTPResponseCache(cache_file, graph_inputs_hash(otp_folder))
+
+
+def write_itinerary_fragment(legs: pandas.DataFrame, path: str):
+    """Write a chunk of itinerary legs as a typed parquet fragment
+
+    Parameters
+    ----------
+    legs : pandas.DataFrame
+        The legs, as returned by `OTPQuery.parse_plan`
+    path : str
+        The parquet file to write
+    """
+    table = pyarrow.Table.from_pandas(
+        legs[ITINERARY_SCHEMA.names], schema=ITINERARY_SCHEMA, preserve_index=False
+    )
+    pyarrow.parquet.write_table(table, path)
+
+
+def dechunkify(chunk_folder: str, parquet_output: str):
+    """Combine a folder of itinerary chunks into a single parquet file
+
+    The chunk folder is opened as a parquet dataset and copied over one record
+    batch at a time, so the itineraries are never all held in memory at once.
+    Folders of CSV chunks from older runs are still read the old way.
+
+    Parameters
+    ----------
+    chunk_folder : str
+        The folder of chunks written by the OTP runners
+    parquet_output : str
+        The output parquet file
+    """
+    print("Dechunkifying")
+    fragments = sorted(f for f in os.listdir(chunk_folder) if f.endswith(".parquet"))
+    if len(fragments) == 0:
+        _dechunkify_csv(chunk_folder, parquet_output)
+        return
+
+    dataset = pyarrow.dataset.dataset(
+        [os.path.join(chunk_folder, f) for f in fragments],
+        schema=ITINERARY_SCHEMA,
+        format="parquet",
+    )
+    with pyarrow.parquet.ParquetWriter(parquet_output, ITINERARY_SCHEMA) as writer:
+        for batch in dataset.to_batches():
+            writer.write_batch(batch)
+
+
+def _dechunkify_csv(chunk_folder: str, parquet_output: str):
+    """Combine a folder of CSV itinerary chunks into a single parquet file"""
+    dfs = []
+    for f in os.listdir(chunk_folder):
+        dfs.append(
+            pandas.read_csv(
+                os.path.join(chunk_folder, f),
+                dtype={
+                    "from_id": int,
+                    "to_id": int,
+                    "route_id": str,
+                    "stop_id": str,
+                    "feed": str,
+                    "start_stop_id": str,
+                    "end_stop_id": str,
+                },
+            )
+        )
+
+    df = pandas.concat(dfs, axis="index")
+    df["agency_id"] = df["agency_id"].astype(str)
+    df.to_parquet(parquet_output)
+
+
+def cross_join_job_blocks(ids, lats, lons, block_size=OTP_JOB_BLOCK):
+    """Yield every pair of distinct points as blocks of coordinate arrays
+
+    The cross join is built a few origins at a time with NumPy, so only one
+    block of pairs exists at any moment however many points there are.
+
+    Parameters
+    ----------
+    ids : numpy.ndarray
+        The point IDs
+    lats, lons : numpy.ndarray
+        The point coordinates
+    block_size : int, optional
+        The approximate number of pairs per block, by default `OTP_JOB_BLOCK`
+
+    Yields
+    ------
+    dict
+        Arrays of from_id, to_id, from_lat, from_lon, to_lat and to_lon
+    """
+    n = ids.shape[0]
+    step = max(1, block_size // max(n, 1))
+    destinations = numpy.arange(n)
+    for start in range(0, n, step):
+        origins = numpy.arange(start, min(n, start + step))
+        o = numpy.repeat(origins, n)
+        d = numpy.tile(destinations, origins.shape[0])
+        keep = ids[o] != ids[d]
+        o = o[keep]
+        d = d[keep]
+        yield {
+            "from_id": ids[o],
+            "to_id": ids[d],
+            "from_lat": lats[o],
+            "from_lon": lons[o],
+            "to_lat": lats[d],
+            "to_lon": lons[d],
+        }
+
+
+def pair_job_blocks(from_ids, to_ids, ids, lats, lons, block_size=OTP_JOB_BLOCK):
+    """Yield a list of pairs as blocks of coordinate arrays
+
+    Parameters
+    ----------
+    from_ids, to_ids : numpy.ndarray
+        The origin and destination IDs of each pair
+    ids : numpy.ndarray
+        The point IDs, which every origin and destination must be among
+    lats, lons : numpy.ndarray
+        The point coordinates
+    block_size : int, optional
+        The number of pairs per block, by default `OTP_JOB_BLOCK`
+
+    Yields
+    ------
+    dict
+        Arrays of from_id, to_id, from_lat, from_lon, to_lat and to_lon
+    """
+    index = pandas.Index(ids)
+    for start in range(0, from_ids.shape[0], block_size):
+        o = index.get_indexer(from_ids[start : start + block_size])
+        d = index.get_indexer(to_ids[start : start + block_size])
+        yield {
+            "from_id": ids[o],
+            "to_id": ids[d],
+            "from_lat": lats[o],
+            "from_lon": lons[o],
+            "to_lat": lats[d],
+            "to_lon": lons[d],
+        }
+
+
+def iter_jobs(blocks, departure: datetime.datetime):
+    """Turn blocks of coordinate arrays into OTP client jobs, one at a time
+
+    Parameters
+    ----------
+    blocks : iterable
+        Blocks from `cross_join_job_blocks` or `pair_job_blocks`
+    departure : datetime.datetime
+        The departure time and date of every job
+
+    Yields
+    ------
+    tuple
+        The from ID, to ID, from lat/lon, to lat/lon and departure datetime
+    """
+    for block in blocks:
+        for row in zip(
+            block["from_id"].tolist(),
+            block["to_id"].tolist(),
+            block["from_lat"].tolist(),
+            block["from_lon"].tolist(),
+            block["to_lat"].tolist(),
+            block["to_lon"].tolist(),
+        ):
+            yield (*row, departure)
+
+
+def run_otp_itineraries_from_pairs_list(
+    fares_yaml: str,
+    pairs_df: pandas.DataFrame,
+    clusters: pandas.DataFrame,
+    departure: datetime.datetime,
+    output_folder: str,
+    region_key: str,
+    chunk_size=30,
+    endpoint=OTP_ENDPOINT,
+    concurrency=OTP_CONCURRENCY,
+    batch_size=OTP_BATCH_SIZE,
+    cache_file=None,
+    retry_failed=False,
+):
+    """Fetch a set of OTP itineraries based on a provided set of origin-destination pairs
+
+    Parameters
+    ----------
+    fares_yaml : str
+        The file path of the fares configuration YAML file
+    pairs_df : pandas.DataFrame
+        The dataframe with the pairs to check
+    clusters : pandas.DataFrame
+        The set of clusters to create itineraries for
+    departure : datetime.datetime
+        The departure time and date to use
+    output_folder : str
+        The folder in which to put the chunks that are created
+    region_key : str
+        The region key string (e.g. WAS)
+    chunk_size : int, optional
+        The size of chunk to use (number of pairs), by default 30
+    endpoint : str or list, optional
+        The OTP GraphQL endpoint, or a list of endpoints of identical OTP
+        instances, by default `OTP_ENDPOINT`
+    concurrency : int, optional
+        The number of requests in flight at once, by default `OTP_CONCURRENCY`
+    batch_size : int, optional
+        The number of plans packed into each request, by default `OTP_BATCH_SIZE`
+    cache_file : str, optional
+        The OTP response cache file, by default `OTP_CACHE_FILE` next to the
+        fares configuration file
+    retry_failed : bool, optional
+        Only query the pairs that came back empty or failed in earlier runs
+        into the same output folder, by default False
+    """
+    print("Running OTP Itineraries - Specified Pairs")
+    cache = _open_response_cache(fares_yaml, cache_file)
+    client = AsyncOTPClient(
+        _read_feeds(fares_yaml),
+        endpoint=endpoint,
+        concurrency=concurrency,
+        batch_size=batch_size,
+        cache=cache,
+    )
+    print("  Building job list")
+
+    # Remove diagnonals
+    pairs_df = pairs_df[pairs_df.from_id != pairs_df.to_id]
+    known = pairs_df.from_id.isin(clusters.CLUSTER_ID) & pairs_df.to_id.isin(
+        clusters.CLUSTER_ID
+    )
+    if not known.all():
+        print(f"  Skipping {(~known).sum()} pairs with unknown clusters")
+        pairs_df = pairs_df[known]
+    blocks = pair_job_blocks(
+        pairs_df.from_id.to_numpy(),
+        pairs_df.to_id.to_numpy(),
+        clusters.CLUSTER_ID.to_numpy(),
+        clusters.MEAN_Y.to_numpy(),
+        clusters.MEAN_X.to_numpy(),
+    )
+    manifest = JobManifest(output_folder)
+    blocks = manifest.filter_blocks(blocks, retry_failed)
+    if retry_failed:
+        total = manifest.count("empty", "failed")
+    else:
+        total = pairs_df.shape[0] - manifest.count("ok", "empty")
+    print(f"  {manifest}")
+    print("  Generating", total, "itineraries")
+    print(f"  Using chunks of size {chunk_size}")
+    print(f"  Using {concurrency} concurrent requests of {batch_size} plans")
+
+    start = time.time()
+    client.run_to_chunks(
+        iter_jobs(blocks, departure),
+        output_folder,
+        region_key,
+        chunk_size,
+        total,
+        manifest=manifest,
+    )
+    print(f"  {manifest}")
+    manifest.close()
+    cache.close()
+    end = time.time()
+    print("  Took", end - start, "seconds")
+
+
+def run_otp_itineraries_in_parallel(
+    fares_yaml,
+    points,
+    output_folder,
+    chunk_size=30,
+    endpoint=OTP_ENDPOINT,
+    concurrency=OTP_CONCURRENCY,
+    batch_size=OTP_BATCH_SIZE,
+    cache_file=None,
+    retry_failed=False,
+):
+    cache = _open_response_cache(fares_yaml, cache_file)
+    client = AsyncOTPClient(
+        _read_feeds(fares_yaml),
+        endpoint=endpoint,
+        concurrency=concurrency,
+        batch_size=batch_size,
+        cache=cache,
+    )
+    ids = points.cluster_id.to_numpy()
+    blocks = cross_join_job_blocks(
+        ids, points.MEAN_Y.to_numpy(), points.MEAN_X.to_numpy()
+    )
+    _, counts = numpy.unique(ids, return_counts=True)
+    total = ids.shape[0] ** 2 - int((counts**2).sum())
+    manifest = JobManifest(output_folder)
+    blocks = manifest.filter_blocks(blocks, retry_failed)
+    if retry_failed:
+        total = manifest.count("empty", "failed")
+    else:
+        total -= manifest.count("ok", "empty")
+    print(manifest)
+    print("Generating", total, "itineraries")
+    print(f"Using chunks of size {chunk_size}")
+    print(f"Using {concurrency} concurrent requests of {batch_size} plans")
+
+    start = time.time()
+    client.run_to_chunks(
+        iter_jobs(blocks, datetime.datetime(2023, 9, 27, 7, 11)),
+        output_folder,
+        "WAS",
+        chunk_size,
+        total,
+        manifest=manifest,
+    )
+    print(manifest)
+    manifest.close()
+    cache.close()
+    end = time.time()
+    print("Took", end - start, "seconds")
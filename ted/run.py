@@ -11,11 +11,13 @@ from pygris import block_groups
 from r5py import TravelTimeMatrixComputer, TransportNetwork
 import yaml
 
-from gtfslite import GTFS
 import traccess
 
+from .access import AccessContext
+from .equity import county_areas, weighted_averages
 from .exception import NotAMondayError
-from .gtfs import get_all_stops
+from .gtfs import GTFS_CACHE_FOLDER, compute_transit_service_intensity
+from .matrix import open_fare_mask, read_region_index
 
 #: The number of days since Monday to count as a weekend (Saturday = 5, Sunday = 6)
 WEEKEND_DELTA = 5
@@ -27,6 +29,34 @@ BGNAME = "BG20"
 LIMITED_TAG = "limited"
 #: Size of the Transit Service Intensity buffer to use (meters)
 TSI_BUFFER_SIZE = 402.336
+#: The supply columns of the cumulative access measures at each cutoff (minutes)
+ACCESS_MEASURES = {
+    15: ["acres"],
+    30: ["C000", "acres"],
+    45: ["C000"],
+    60: ["C000"],
+    90: ["C000"],
+}
+#: The travel time cutoffs (minutes) of the cumulative access measures
+ACCESS_CUTOFFS = list(ACCESS_MEASURES)
+#: The supply columns of the travel time to the nth closest opportunity measures
+CLOSEST_MEASURES = {
+    1: [
+        "education",
+        "grocery",
+        "hospitals",
+        "pharmacies",
+        "urgent_care_facilities",
+        "early_voting",
+    ],
+    3: [
+        "education",
+        "grocery",
+        "hospitals",
+        "pharmacies",
+        "urgent_care_facilities",
+    ],
+}
 
 
 class Run:
@@ -111,296 +141,73 @@ class Run:
                 )
             if region["tsi"]:
                 print("Computing Transit Service Intensity")
-                # Need to get the shapes
+                # Buffer the block groups to take in nearby stops
                 areas = gpd.read_file(
                     region_config["gpkg"], layer=region_config["areas_layer"]
                 )
-                print(areas.crs)
                 areas.geometry = areas.geometry.buffer(TSI_BUFFER_SIZE)
-                runs = []
-                for run_key, run in region["runs"].items():
-                    areas[run_key] = 0
-                    runs.append(run_key)
-                # Now we get the stops in the region
                 gtfs_folder = os.path.join(region_config["gtfs"], "full", self.week_of)
-                all_stops = get_all_stops(gtfs_folder).to_crs(areas.crs)
-                all_stops.to_file(
-                    f"{region_config['code']}-allstops.gpkg", layer="all_stops"
+                # A region's gtfs_cache moves the feed cache, and null turns it off
+                tsi = compute_transit_service_intensity(
+                    gtfs_folder,
+                    areas,
+                    region["runs"],
+                    id_column=BGNAME,
+                    cache_folder=region_config.get("gtfs_cache", GTFS_CACHE_FOLDER),
                 )
-                print("Wrote file")
-                print("Starting TSI computation")
-                for agency in all_stops.agency.unique():
-                    print("  Computing for", agency)
-                    # Load the zipfile
-                    agency_stops = all_stops[all_stops.agency == agency].copy()
-                    gtfs = GTFS.load_zip(os.path.join(gtfs_folder, f"{agency}.zip"))
-                    # Compute the spatial intersection
-                    joined = gpd.sjoin(
-                        left_df=agency_stops[["stop_id", "geometry"]],
-                        right_df=areas[[BGNAME, "geometry"]],
-                    )
-                    stops_per_bg = (
-                        joined[["BG20", "stop_id"]]
-                        .groupby("BG20", as_index=False)
-                        .count()
-                    )
-                    stops_per_bg.to_csv(f"{region_config['code']}-{agency}.csv")
-                    print("Wrote stops per bg for", agency)
-                    # Let's get the TSI
-                    for bg in joined.BG20.unique():
-                        # print("  Checking", bg)
-                        stops = joined[joined.BG20 == bg]["stop_id"].tolist()
-                        # print(f"  {bg}: Found", len(stops), "stops.")
-                        for run_key, run in region["runs"].items():
-                            # print("    Checking on", run_key)
-                            start_time = run
-                            end_time = start_time + datetime.timedelta(hours=2)
-                            tsi = gtfs.unique_trip_count_at_stops(
-                                stops,
-                                date=start_time.date(),
-                                start_time=start_time.strftime("%H:%M:%S"),
-                                end_time=end_time.strftime("%H:%M:%S"),
-                            )
-                            areas.loc[areas.BG20 == bg, run_key] += tsi
-                # Finish off by joining in items
-                runs.append(BGNAME)
-                out = areas[runs].set_index(BGNAME)
-                out.to_csv(os.path.join(region_folder, "tsi.csv"))
-                #     df.to_csv(os.path.join(run_folder, "tsi.csv"), index=False)
+                tsi.to_csv(os.path.join(region_folder, "tsi.csv"))
             if region["access"]:
                 print("Computing access metrics")
                 # Compute access metrics
                 supply = traccess.Supply.from_csv(
                     region_config["supply"], dtype={"BG20": str}, id_column="BG20"
                 )
+                bg_index = read_region_index(
+                    region_config["gpkg"], region_config["centroids_layer"]
+                )
+                # The pairs within the fare threshold only change with the fare
+                # year, so their masks are shared by every run and week
+                fare_masks = {
+                    year: {
+                        network: open_fare_mask(
+                            year_config[network],
+                            bg_index,
+                            region_config["fare_threshold"],
+                        )
+                        for network in ["full", "limited"]
+                    }
+                    for year, year_config in region_config["fare"].items()
+                }
                 for run_key, run in region["runs"].items():
                     run_folder = os.path.join(region_folder, run_key)
                     print(f"    {run_key}: Output folder is", run_folder)
-                    # Let's do full matrix first
-                    full_cost = traccess.Cost.from_parquet(
-                        os.path.join(run_folder, "full_matrix.parquet"),
-                        from_id="from_id",
-                        to_id="to_id",
+                    # Open and align the run's matrices once for every measure
+                    context = AccessContext.open(
+                        run_folder,
+                        bg_index,
+                        supply.data,
+                        auto_parquet=os.path.join(
+                            region_config["auto"], f"{run_key}.parquet"
+                        ),
                     )
-                    # Now let's compute some STUFF
-                    ac = traccess.AccessComputer(supply, full_cost)
-                    print(f"    {run_key}: Computing c15 measures")
-                    c15 = ac.cumulative_cutoff(
-                        cost_columns=["travel_time"],
-                        cutoffs=[15],
-                        supply_columns=["acres"],
-                    ).data
-                    c15.columns = ["acres_c15"]
-
-                    print(f"    {run_key}: Computing c30 measures")
-                    c30 = ac.cumulative_cutoff(
-                        cost_columns=["travel_time"],
-                        cutoffs=[30],
-                        supply_columns=["C000", "acres"],
-                    ).data
-                    c30.columns = ["C000_c30", "acres_c30"]
+                    print(f"    {run_key}: Computing cumulative measures")
+                    cumulative = context.cumulative("full", ACCESS_MEASURES)
 
-                    print(f"    {run_key}: Computing c45 measures")
-                    c45 = ac.cumulative_cutoff(
-                        cost_columns=["travel_time"],
-                        cutoffs=[45],
-                        supply_columns=["C000"],
-                    ).data
-                    c45.columns = ["C000_c45"]
+                    print(f"    {run_key}: Computing t1 and t3 measures")
+                    closest = context.closest("full", CLOSEST_MEASURES)
 
-                    print(f"    {run_key}: Computing c60 measures")
-                    c60 = ac.cumulative_cutoff(
-                        cost_columns=["travel_time"],
-                        cutoffs=[60],
-                        supply_columns=["C000"],
-                    ).data
-                    c60.columns = ["C000_c60"]
-
-                    print(f"    {run_key}: Computing c90 measures")
-                    c90 = ac.cumulative_cutoff(
-                        cost_columns=["travel_time"],
-                        cutoffs=[90],
-                        supply_columns=["C000"],
-                    ).data
-                    c90.columns = ["C000_c90"]
-
-                    print(f"    {run_key}: Computing t1 measures")
-                    t1 = ac.cost_to_closest(
-                        "travel_time",
-                        supply_columns=[
-                            "education",
-                            "grocery",
-                            "hospitals",
-                            "pharmacies",
-                            "urgent_care_facilities",
-                            "early_voting",
-                        ],
-                        n=1,
-                    ).data
-                    t1.columns = [f"{c}_t1" for c in t1.columns]
-
-                    print(f"    {run_key}: Computing t3 measures")
-                    t3 = ac.cost_to_closest(
-                        "travel_time",
-                        [
-                            "education",
-                            "grocery",
-                            "hospitals",
-                            "pharmacies",
-                            "urgent_care_facilities",
-                        ],
-                        n=3,
-                    ).data
-                    t3.columns = [f"{c}_t3" for c in t3.columns]
-
-                    # Now we need fare constrained
-                    # Fare constrained analysis
-                    # Need to load in some fare matrices
-                    fare_threshold = region_config["fare_threshold"]
-                    fare_config = region_config["fare"]
+                    # Fare constrained analysis, under each fare year's masks
                     print(f"    {run_key}: Computing fare measures")
                     years_dfs = []
-                    for year in fare_config:
-                        year_config = fare_config[year]
-                        # Read in the matrices
-                        full_fmx = pandas.read_parquet(year_config["full"])
-                        lim_fmx = pandas.read_parquet(year_config["limited"])
-                        full_fmx.columns = ["from_id", "to_id", "fare_cost"]
-                        lim_fmx.columns = ["from_id", "to_id", "fare_cost"]
-
-                        full_mx = pandas.read_parquet(
-                            os.path.join(run_folder, "full_matrix.parquet")
-                        )
-                        lim_mx = pandas.read_parquet(
-                            os.path.join(run_folder, "limited_matrix.parquet")
-                        )
-
-                        # Merge the fare matrix and the travel time matrices
-                        full_mx = pandas.merge(
-                            full_mx, full_fmx, on=["from_id", "to_id"]
-                        )
-                        lim_mx = pandas.merge(lim_mx, lim_fmx, on=["from_id", "to_id"])
-
-                        full_fare_cost = traccess.Cost(full_mx)
-                        lim_fare_cost = traccess.Cost(lim_mx)
-
-                        full_ac = traccess.AccessComputer(supply, full_fare_cost)
-                        lim_ac = traccess.AccessComputer(supply, lim_fare_cost)
-
-                        print(f"      {run_key} ({year}): Computing c15f measures")
-                        c15f_full = full_ac.cumulative_cutoff(
-                            ["travel_time", "fare_cost"],
-                            [15, fare_threshold],
-                            supply_columns=["acres"],
-                        ).data
-                        c15f_lim = lim_ac.cumulative_cutoff(
-                            ["travel_time", "fare_cost"],
-                            [15, fare_threshold],
-                            supply_columns=["acres"],
-                        ).data
-
-                        c15f = c15f_full.join(c15f_lim, lsuffix="_full", rsuffix="_lim")
-                        c15f[f"acres_c15f_{year}"] = c15f[
-                            ["acres_full", "acres_lim"]
-                        ].max(axis=1)
-                        c15f = c15f[[f"acres_c15f_{year}"]]
-
-                        years_dfs.append(c15f)
-
-                        print(f"      {run_key} ({year}): Computing c30f measures")
-                        c30f_full = full_ac.cumulative_cutoff(
-                            ["travel_time", "fare_cost"],
-                            [30, fare_threshold],
-                            supply_columns=["C000", "acres"],
-                        ).data
-                        c30f_lim = lim_ac.cumulative_cutoff(
-                            ["travel_time", "fare_cost"],
-                            [30, fare_threshold],
-                            supply_columns=["C000", "acres"],
-                        ).data
-
-                        c30f = c30f_full.join(c30f_lim, lsuffix="_full", rsuffix="_lim")
-                        c30f[f"C000_c30f_{year}"] = c30f[["C000_full", "C000_lim"]].max(
-                            axis=1
-                        )
-                        c30f[f"acres_c30f_{year}"] = c30f[
-                            ["acres_full", "acres_lim"]
-                        ].max(axis=1)
-                        c30f = c30f[[f"C000_c30f_{year}", f"acres_c30f_{year}"]]
-
-                        years_dfs.append(c30f)
-
-                        print(f"      {run_key} ({year}): Computing c45f measures")
-                        c45f_full = full_ac.cumulative_cutoff(
-                            ["travel_time", "fare_cost"],
-                            [45, fare_threshold],
-                            supply_columns=["C000"],
-                        ).data
-                        c45f_lim = lim_ac.cumulative_cutoff(
-                            ["travel_time", "fare_cost"],
-                            [45, fare_threshold],
-                            supply_columns=["C000"],
-                        ).data
-
-                        c45f = c45f_full.join(c45f_lim, lsuffix="_full", rsuffix="_lim")
-                        c45f[f"C000_c45f_{year}"] = c45f[["C000_full", "C000_lim"]].max(
-                            axis=1
-                        )
-                        c45f = c45f[[f"C000_c45f_{year}"]]
-
-                        years_dfs.append(c45f)
-
-                        print(f"      {run_key} ({year}): Computing c60f measures")
-                        c60f_full = full_ac.cumulative_cutoff(
-                            ["travel_time", "fare_cost"],
-                            [60, fare_threshold],
-                            supply_columns=["C000"],
-                        ).data
-                        c60f_lim = lim_ac.cumulative_cutoff(
-                            ["travel_time", "fare_cost"],
-                            [60, fare_threshold],
-                            supply_columns=["C000"],
-                        ).data
-
-                        c60f = c60f_full.join(c60f_lim, lsuffix="_full", rsuffix="_lim")
-                        c60f[f"C000_c60f_{year}"] = c60f[["C000_full", "C000_lim"]].max(
-                            axis=1
-                        )
-                        c60f = c60f[[f"C000_c60f_{year}"]]
-
-                        years_dfs.append(c60f)
-
-                        print(f"      {run_key} ({year}): Computing c90f measures")
-                        c90f_full = full_ac.cumulative_cutoff(
-                            ["travel_time", "fare_cost"],
-                            [90, fare_threshold],
-                            supply_columns=["C000"],
-                        ).data
-                        c90f_lim = lim_ac.cumulative_cutoff(
-                            ["travel_time", "fare_cost"],
-                            [90, fare_threshold],
-                            supply_columns=["C000"],
-                        ).data
-
-                        c90f = c90f_full.join(c90f_lim, lsuffix="_full", rsuffix="_lim")
-                        c90f[f"C000_c90f_{year}"] = c90f[["C000_full", "C000_lim"]].max(
-                            axis=1
+                    for year, masks in fare_masks.items():
+                        print(f"      {run_key} ({year}): Computing cf measures")
+                        years_dfs.append(
+                            context.fare_constrained(
+                                masks, ACCESS_MEASURES, suffix=f"f_{year}"
+                            )
                         )
-                        c90f = c90f[[f"C000_c90f_{year}"]]
-
-                        years_dfs.append(c90f)
 
-                        del full_mx
-                        del lim_mx
-                        del full_fare_cost
-                        del lim_fare_cost
-
-                    df = c15.join(c30)
-                    df = df.join(c45)
-                    df = df.join(c60)
-                    df = df.join(c90)
-                    df = df.join(t1)
-                    df = df.join(t3)
+                    df = cumulative.join(closest)
 
                     for frame in years_dfs:
                         df = df.join(frame)
@@ -411,12 +218,8 @@ class Run:
                         os.path.join(run_folder, "access_transit.csv"), index=False
                     )
 
-                    del c30
-                    del c45
-                    del c60
-                    del c90
-                    del t1
-                    del t3
+                    del cumulative
+                    del closest
                     del years_dfs
 
                     # Now auto matrices
@@ -426,83 +229,20 @@ class Run:
                     )
                     auto_ac = traccess.AccessComputer(supply, auto_cost)
 
-                    print(f"    {run_key}: Computing AUTO c15 measures")
-                    auto_c15 = auto_ac.cumulative_cutoff(
-                        cost_columns=["travel_time"],
-                        cutoffs=[15],
-                        supply_columns=["acres"],
-                    ).data
-                    auto_c15.columns = ["acres_c15_auto"]
-
-                    print(f"    {run_key}: Computing AUTO c30 measures")
-                    auto_c30 = auto_ac.cumulative_cutoff(
-                        cost_columns=["travel_time"],
-                        cutoffs=[30],
-                        supply_columns=["C000", "acres"],
-                    ).data
-                    auto_c30.columns = ["C000_c30_auto", "acres_c30_auto"]
-
-                    print(f"    {run_key}: Computing AUTO c45 measures")
-                    auto_c45 = auto_ac.cumulative_cutoff(
-                        cost_columns=["travel_time"],
-                        cutoffs=[45],
-                        supply_columns=["C000"],
-                    ).data
-                    auto_c45.columns = ["C000_c45_auto"]
-
-                    print(f"    {run_key}: Computing AUTO c60 measures")
-                    auto_c60 = auto_ac.cumulative_cutoff(
-                        cost_columns=["travel_time"],
-                        cutoffs=[60],
-                        supply_columns=["C000"],
-                    ).data
-                    auto_c60.columns = ["C000_c60_auto"]
-
-                    print(f"    {run_key}: Computing AUTO c90 measures")
-                    auto_c90 = auto_ac.cumulative_cutoff(
-                        cost_columns=["travel_time"],
-                        cutoffs=[90],
-                        supply_columns=["C000"],
-                    ).data
-                    auto_c90.columns = ["C000_c90_auto"]
-
-                    df = auto_c15.join(auto_c30)
-                    df = df.join(auto_c45)
-                    df = df.join(auto_c60)
-                    df = df.join(auto_c90)
-
-                    del auto_c15
-                    del auto_c30
-                    del auto_c45
-                    del auto_c60
-                    del auto_c90
+                    print(f"    {run_key}: Computing AUTO cumulative measures")
+                    df = context.cumulative("auto", ACCESS_MEASURES, suffix="_auto")
 
+                    # Auto skims carry fractional minutes, which the dense
+                    # matrices round up, so the closest measures stay on traccess
                     print(f"    {run_key}: Computing AUTO t1 measures")
                     auto_t1 = auto_ac.cost_to_closest(
-                        "travel_time",
-                        [
-                            "education",
-                            "grocery",
-                            "hospitals",
-                            "pharmacies",
-                            "urgent_care_facilities",
-                            "early_voting",
-                        ],
-                        n=1,
+                        "travel_time", CLOSEST_MEASURES[1], n=1
                     ).data
                     auto_t1.columns = [f"{c}_t1_auto" for c in auto_t1.columns]
 
                     print(f"    {run_key}: Computing AUTO t3 measures")
                     auto_t3 = auto_ac.cost_to_closest(
-                        "travel_time",
-                        [
-                            "education",
-                            "grocery",
-                            "hospitals",
-                            "pharmacies",
-                            "urgent_care_facilities",
-                        ],
-                        n=3,
+                        "travel_time", CLOSEST_MEASURES[3], n=3
                     ).data
                     auto_t3.columns = [f"{c}_t3_auto" for c in auto_t3.columns]
 
@@ -526,6 +266,7 @@ class Run:
                     transit.to_csv(os.path.join(run_folder, "access.csv"), index=False)
                     del transit
                     del auto
+                    del context
 
             if region["equity"]:
                 print("Computing equity summary metrics")
@@ -533,6 +274,19 @@ class Run:
                 tsi = pandas.read_csv(
                     os.path.join(region_folder, "tsi.csv"), dtype={"BG20": str}
                 )
+                demo_df = pandas.read_csv(
+                    region_config["demographics"], dtype={"BG20": str}
+                ).set_index("BG20")
+                # The whole region, the city and any counties listed in the
+                # region's sources file
+                city_bgs = pandas.read_csv(region_config["city"], dtype={"BG20": str})
+                areas = {"urban": None, "city": city_bgs["BG20"]}
+                if "sources" in region_config:
+                    with open(region_config["sources"]) as infile:
+                        sources = yaml.safe_load(infile)
+                    areas.update(
+                        county_areas(demo_df.index, sources.get("counties", []))
+                    )
                 for run_key, run in region["runs"].items():
                     run_folder = os.path.join(region_folder, run_key)
                     print(f"    {run_key}: Output folder is", run_folder)
@@ -544,49 +298,10 @@ class Run:
                     )
 
                     acs_df = pandas.merge(acs_df, this_tsi, on="BG20")
-                    demo_df = pandas.read_csv(
-                        region_config["demographics"],
-                        dtype={"BG20": str},
-                    )
-
-                    # First let's do it for the whole region
-                    access = traccess.Access(acs_df, id_column="BG20")
-                    demographics = traccess.Demographic(demo_df, id_column="BG20")
-                    ec = traccess.EquityComputer(
-                        access=access, demographic=demographics
-                    )
-                    all = []
-                    for c in access.columns:
-                        all.append(ec.weighted_average(c).to_frame())
-                    all = pandas.concat(all, axis="columns")
-                    all = all.rename_axis("demographic")
-                    all["area"] = "urban"
-
-                    # Next let's do the urban area
-                    city_bgs = pandas.read_csv(
-                        region_config["city"],
-                        dtype={"BG20": str},
-                    )
-                    access = traccess.Access(
-                        acs_df[acs_df["BG20"].isin(city_bgs["BG20"])], id_column="BG20"
-                    )
-                    demographics = traccess.Demographic(
-                        demo_df[demo_df["BG20"].isin(city_bgs["BG20"])],
-                        id_column="BG20",
+                    summary = weighted_averages(
+                        acs_df.set_index("BG20"), demo_df, areas
                     )
-                    ec = traccess.EquityComputer(
-                        access=access, demographic=demographics
-                    )
-                    city = []
-                    for c in access.columns:
-                        city.append(ec.weighted_average(c).to_frame())
-                    city = pandas.concat(city, axis="columns")
-                    city = city.rename_axis("demographic")
-                    city["area"] = "city"
-
-                    both = pandas.concat([all, city], axis="index")
-
-                    both.to_csv(os.path.join(run_folder, "summary.csv"))
+                    summary.to_csv(os.path.join(run_folder, "summary.csv"))
 
     def run_matrix(
         self, region, centroids, gtfs_folder, region_folder, runs, output_name
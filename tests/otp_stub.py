@@ -0,0 +1,192 @@
+"""A stand-in for an OTP GraphQL endpoint
+
+The stub answers trip plan queries with a synthetic walk-bus-walk itinerary
+derived from the query coordinates, so the OTP clients can be exercised and
+benchmarked without a real graph. It can be started on its own with
+
+    python tests/otp_stub.py --port 8080 --latency 0.05
+
+and pointed at with the `endpoint` option of the OTP runners."""
+
+import argparse
+import asyncio
+import contextlib
+import datetime
+import re
+import threading
+
+from aiohttp import web
+
+PLAN_PATTERN = re.compile(
+    r"(?:(?P<alias>\w+):\s*)?plan\(\s*from:\s*{\s*lat:\s*(?P<from_lat>[-\d.e]+),\s*lon:\s*(?P<from_lon>[-\d.e]+)\s*},"
+    r"\s*to:\s*{\s*lat:\s*(?P<to_lat>[-\d.e]+),\s*lon:\s*(?P<to_lon>[-\d.e]+)\s*},"
+    r"\s*date:\s*\"(?P<date>[\d-]+)\",\s*time:\s*\"(?P<time>[\d:]+)\""
+)
+
+
+def make_plan(from_lat, from_lon, to_lat, to_lon, date, time) -> dict:
+    """Build a deterministic walk-bus-walk plan between two points"""
+    start = datetime.datetime.strptime(f"{date} {time}", "%Y-%m-%d %H:%M")
+    start = int(start.replace(tzinfo=datetime.timezone.utc).timestamp() * 1000)
+    route = int(abs(from_lat * 1000 + to_lon * 1000)) % 10
+    board = f"1:S{round(from_lat, 3)}"
+    alight = f"1:S{round(to_lat, 3)}"
+
+    def leg(mode, minute, from_stop, to_stop, route_id):
+        return {
+            "mode": mode,
+            "startTime": start + minute * 60000,
+            "endTime": start + (minute + 5) * 60000,
+            "from": {
+                "stop": None if from_stop is None else {"gtfsId": from_stop},
+                "departureTime": start + minute * 60000,
+            },
+            "to": {
+                "stop": None if to_stop is None else {"gtfsId": to_stop},
+                "departureTime": start + (minute + 5) * 60000,
+            },
+            "route": (
+                None
+                if route_id is None
+                else {
+                    "gtfsId": route_id,
+                    "agency": {"gtfsId": "1:A", "name": "Stub Transit"},
+                }
+            ),
+        }
+
+    return {
+        "itineraries": [
+            {
+                "startTime": start,
+                "endTime": start + 15 * 60000,
+                "legs": [
+                    leg("WALK", 0, None, board, None),
+                    leg("BUS", 5, board, alight, f"1:R{route}"),
+                    leg("WALK", 10, alight, None, None),
+                ],
+            }
+        ]
+    }
+
+
+class OTPStub:
+    """An aiohttp application that answers OTP trip plan queries
+
+    Parameters
+    ----------
+    latency : float, optional
+        Seconds to wait before answering each request, by default 0
+    fail_every : int, optional
+        Answer every nth request with an HTTP error, by default 0 (never)
+    error_every : int, optional
+        Answer every nth plan with a GraphQL error, by default 0 (never)
+    empty_every : int, optional
+        Answer every nth plan without any itineraries, by default 0 (never)
+    fail_status : int, optional
+        The status of the failed requests, by default 503
+    garbage_every : int, optional
+        Answer every nth request with a body that is not JSON, by default 0
+        (never)
+    """
+
+    def __init__(
+        self,
+        latency: float = 0,
+        fail_every: int = 0,
+        error_every: int = 0,
+        empty_every: int = 0,
+        fail_status: int = 503,
+        garbage_every: int = 0,
+    ):
+        self.latency = latency
+        self.fail_every = fail_every
+        self.fail_status = fail_status
+        self.garbage_every = garbage_every
+        self.error_every = error_every
+        self.empty_every = empty_every
+        self.requests = 0
+        self.plans = 0
+        self.app = web.Application()
+        self.app.router.add_post("/otp/routers/default/index/graphql", self.handle)
+
+    async def handle(self, request):
+        self.requests += 1
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+        if self.fail_every > 0 and self.requests % self.fail_every == 0:
+            return web.Response(status=self.fail_status)
+        if self.garbage_every > 0 and self.requests % self.garbage_every == 0:
+            return web.Response(text="<html>Service busy</html>")
+        body = await request.json()
+        data = {}
+        errors = []
+        for m in PLAN_PATTERN.finditer(body["query"]):
+            alias = m["alias"] or "plan"
+            self.plans += 1
+            if self.error_every > 0 and self.plans % self.error_every == 0:
+                data[alias] = None
+                errors.append({"message": "Stub plan error", "path": [alias]})
+                continue
+            if self.empty_every > 0 and self.plans % self.empty_every == 0:
+                data[alias] = {"itineraries": []}
+                continue
+            data[alias] = make_plan(
+                float(m["from_lat"]),
+                float(m["from_lon"]),
+                float(m["to_lat"]),
+                float(m["to_lon"]),
+                m["date"],
+                m["time"],
+            )
+        response = {"data": data}
+        if len(errors) > 0:
+            response["errors"] = errors
+        return web.json_response(response)
+
+
+async def start_stub(port: int = 0, **kwargs):
+    """Start a stub on localhost, returning it with its runner and endpoint"""
+    stub = OTPStub(**kwargs)
+    runner = web.AppRunner(stub.app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", port)
+    await site.start()
+    port = runner.addresses[0][1]
+    return stub, runner, f"http://127.0.0.1:{port}/otp/routers/default/index/graphql"
+
+
+@contextlib.contextmanager
+def stub_in_thread(**kwargs):
+    """Serve a stub from a background thread for the length of a with block
+
+    Yields
+    ------
+    tuple
+        The stub and its endpoint URL
+    """
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    stub, runner, endpoint = asyncio.run_coroutine_threadsafe(
+        start_stub(**kwargs), loop
+    ).result()
+    try:
+        yield stub, endpoint
+    finally:
+        asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0)
+    parser.add_argument("--fail-every", type=int, default=0)
+    parser.add_argument("--error-every", type=int, default=0)
+    parser.add_argument("--empty-every", type=int, default=0)
+    args = parser.parse_args()
+    stub = OTPStub(args.latency, args.fail_every, args.error_every, args.empty_every)
+    web.run_app(stub.app, host="127.0.0.1", port=args.port)
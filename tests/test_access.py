@@ -0,0 +1,174 @@
+import numpy
+import pandas
+import pytest
+import traccess
+
+from ted.access import (
+    AccessContext,
+    access_curves,
+    closest_access,
+    cumulative_access,
+)
+from ted.matrix import DenseMatrix, PackedMask, make_index, open_fare_mask
+
+MEASURES = {15: ["acres"], 30: ["C000", "acres"], 45: ["C000"], 90: ["C000"]}
+
+
+@pytest.fixture
+def region():
+    rng = numpy.random.default_rng(0)
+    ids = [f"BG{idx:03d}" for idx in range(60)]
+    df = pandas.DataFrame(
+        [(o, d) for o in ids for d in ids], columns=["from_id", "to_id"]
+    )
+    df["travel_time"] = rng.integers(0, 150, df.shape[0]).astype(float)
+    df.loc[rng.random(df.shape[0]) < 0.2, "travel_time"] = numpy.nan
+    # A few destinations have no supply at all
+    supply = pandas.DataFrame(
+        {
+            "BG20": ids[:55],
+            "C000": rng.integers(0, 500, 55),
+            "acres": rng.random(55) * 100,
+        }
+    )
+    return df, supply
+
+
+def test_cumulative_access_matches_traccess(region):
+    df, supply = region
+    matrix = DenseMatrix.from_long(df, make_index(df.from_id.unique()))
+    result = cumulative_access(
+        matrix, supply.set_index("BG20"), MEASURES, suffix="_auto"
+    )
+
+    ac = traccess.AccessComputer(
+        traccess.Supply(supply, id_column="BG20"), traccess.Cost(df)
+    )
+    for cutoff, columns in MEASURES.items():
+        expected = ac.cumulative_cutoff(
+            cost_columns=["travel_time"], cutoffs=[cutoff], supply_columns=columns
+        ).data
+        for c in columns:
+            numpy.testing.assert_allclose(
+                result[f"{c}_c{cutoff}_auto"], expected[c].reindex(result.index)
+            )
+    assert (result["C000_c90_auto"] >= result["C000_c45_auto"]).all()
+
+
+def test_access_curves_respect_mask(region):
+    df, supply = region
+    matrix = DenseMatrix.from_long(df, make_index(df.from_id.unique()))
+    mask = numpy.random.default_rng(1).random((len(matrix), len(matrix))) < 0.5
+    curves = access_curves(matrix, supply.set_index("BG20"), ["C000"], mask=mask)
+    assert curves["C000"].shape == (len(matrix), 181)
+
+    jobs = supply.set_index("BG20")["C000"].reindex(matrix.index).fillna(0)
+    within = (matrix.values <= 60) & mask
+    numpy.testing.assert_array_equal(curves["C000"][:, 60], within @ jobs.to_numpy())
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_closest_access_matches_traccess(seed, monkeypatch):
+    # Sweep the origins a few at a time
+    monkeypatch.setattr("ted.access.ACCESS_BLOCK_CELLS", 300)
+    rng = numpy.random.default_rng(seed)
+    ids = [f"BG{idx:03d}" for idx in range(40)]
+    df = pandas.DataFrame(
+        [(o, d) for o in ids for d in ids], columns=["from_id", "to_id"]
+    )
+    df["travel_time"] = rng.integers(0, 60, df.shape[0]).astype(float)
+    df.loc[rng.random(df.shape[0]) < 0.3, "travel_time"] = numpy.nan
+    # Few block groups hold groceries, some of them several; hospital supply
+    # is fractional
+    supply = pandas.DataFrame(
+        {
+            "BG20": ids,
+            "grocery": rng.choice([0, 0, 0, 0, 1, 2, 3], len(ids)),
+            "hospitals": rng.choice([0, 0, 0.5, 1.5], len(ids)),
+            "early_voting": [1] + [0] * (len(ids) - 1),
+        }
+    )
+    measures = {
+        1: ["grocery", "hospitals", "early_voting"],
+        3: ["grocery", "hospitals"],
+    }
+    matrix = DenseMatrix.from_long(df, make_index(ids))
+    result = closest_access(matrix, supply.set_index("BG20"), measures)
+
+    ac = traccess.AccessComputer(
+        traccess.Supply(supply, id_column="BG20"), traccess.Cost(df)
+    )
+    for n, columns in measures.items():
+        expected = ac.cost_to_closest("travel_time", columns, n=n).data
+        for c in columns:
+            pandas.testing.assert_series_equal(
+                result[f"{c}_t{n}"],
+                expected[c].reindex(result.index),
+                check_names=False,
+            )
+
+
+def test_fare_masked_access_matches_merged_traccess(tmp_path, region, capsys):
+    df, supply = region
+    rng = numpy.random.default_rng(2)
+    # A block group fare matrix missing some pairs
+    fmx = df[["from_id", "to_id"]].sample(frac=0.9, random_state=0)
+    fmx.columns = ["BG20_from", "BG20_to"]
+    fmx["fare_cost"] = rng.choice([0.0, 250.0, 275.0, 500.0, 9999.0], fmx.shape[0])
+    parquet = str(tmp_path / "fare_matrix_2023_full_BG20.parquet")
+    fmx.to_parquet(parquet)
+
+    index = make_index(df.from_id.unique())
+    mask = open_fare_mask(parquet, index, 275)
+    assert "Building" in capsys.readouterr().out
+    assert mask.count() == (fmx.fare_cost <= 275).sum()
+    assert (open_fare_mask(parquet, index, 275).bits == mask.bits).all()
+    assert capsys.readouterr().out == ""
+
+    matrix = DenseMatrix.from_long(df, index)
+    result = cumulative_access(
+        matrix, supply.set_index("BG20"), MEASURES, suffix="f_2023", mask=mask
+    )
+
+    fmx.columns = ["from_id", "to_id", "fare_cost"]
+    ac = traccess.AccessComputer(
+        traccess.Supply(supply, id_column="BG20"),
+        traccess.Cost(pandas.merge(df, fmx, on=["from_id", "to_id"])),
+    )
+    for cutoff, columns in MEASURES.items():
+        expected = ac.cumulative_cutoff(
+            ["travel_time", "fare_cost"], [cutoff, 275], supply_columns=columns
+        ).data
+        for c in columns:
+            numpy.testing.assert_allclose(
+                result[f"{c}_c{cutoff}f_2023"], expected[c].reindex(result.index)
+            )
+
+
+def test_access_context_shares_matrices_across_fare_years(tmp_path, region):
+    df, supply = region
+    df.to_parquet(tmp_path / "full_matrix.parquet")
+    df.assign(travel_time=df.travel_time + 5).to_parquet(
+        tmp_path / "limited_matrix.parquet"
+    )
+    index = make_index(df.from_id.unique())
+    context = AccessContext.open(str(tmp_path), index, supply.set_index("BG20"))
+    assert sorted(context.matrices) == ["full", "limited"]
+
+    rng = numpy.random.default_rng(3)
+    masks = {
+        network: PackedMask(
+            index, numpy.packbits(rng.random((len(index), len(index))) < 0.5, axis=1)
+        )
+        for network in ["full", "limited"]
+    }
+    result = context.fare_constrained(masks, MEASURES, suffix="f_2023")
+    full = context.cumulative("full", MEASURES, "f_2023", masks["full"])
+    limited = context.cumulative("limited", MEASURES, "f_2023", masks["limited"])
+    pandas.testing.assert_frame_equal(result, numpy.maximum(full, limited))
+    assert (result >= full).all().all() and (result > full).any().any()
+
+    with pytest.raises(ValueError):
+        context.fare_constrained(
+            {"full": PackedMask(index[::-1], masks["full"].bits)}, MEASURES
+        )
@@ -0,0 +1,71 @@
+import numpy
+import pandas
+import pytest
+import traccess
+
+from ted.equity import county_areas, weighted_averages
+
+
+def summary_with_traccess(acs_df, demo_df, city):
+    """The per-column EquityComputer loop Run.run_regions used before"""
+    frames = []
+    for area, acs, demo in [
+        ("urban", acs_df, demo_df),
+        (
+            "city",
+            acs_df[acs_df["BG20"].isin(city)],
+            demo_df[demo_df["BG20"].isin(city)],
+        ),
+    ]:
+        access = traccess.Access(acs, id_column="BG20")
+        ec = traccess.EquityComputer(
+            access=access, demographic=traccess.Demographic(demo, id_column="BG20")
+        )
+        df = pandas.concat(
+            [ec.weighted_average(c).to_frame() for c in access.columns],
+            axis="columns",
+        )
+        df = df.rename_axis("demographic")
+        df["area"] = area
+        frames.append(df)
+    return pandas.concat(frames, axis="index")
+
+
+def test_weighted_averages_match_equity_computer():
+    rng = numpy.random.default_rng(0)
+    bgs = [f"53033{idx:07d}" for idx in range(50)]
+    acs_df = pandas.DataFrame(
+        {
+            "BG20": bgs,
+            "C000_c30": rng.integers(0, 10000, 50).astype(float),
+            "grocery_t1": rng.integers(1, 60, 50).astype(float),
+            "tsi": rng.random(50) * 20,
+        }
+    )
+    acs_df.loc[rng.random(50) < 0.2, "grocery_t1"] = numpy.nan
+    # Some block groups have no demographic data
+    demo_df = pandas.DataFrame(
+        {
+            "BG20": bgs[:45],
+            "total_pop": rng.integers(0, 3000, 45),
+            "poc": rng.integers(0, 1000, 45),
+        }
+    )
+    city = bgs[10:30]
+
+    expected = summary_with_traccess(acs_df, demo_df, city)
+    result = weighted_averages(
+        acs_df.set_index("BG20"),
+        demo_df.set_index("BG20"),
+        {"urban": None, "city": pandas.Series(city)},
+    )
+    pandas.testing.assert_frame_equal(result, expected)
+
+
+def test_county_areas_use_fips_prefixes():
+    bgs = ["530330001001", "530330002001", "530530001001", "530610001001"]
+    areas = county_areas(bgs, ["King", "Pierce"])
+    assert areas["King"].tolist() == bgs[:2]
+    assert areas["Pierce"].tolist() == [bgs[2]]
+    with pytest.raises(ValueError):
+        county_areas(bgs, ["Nowhere"])
@@ -0,0 +1,592 @@
+import itertools
+import os
+import random
+import sqlite3
+
+import geopandas
+import pandas
+import pytest
+
+from ted.exception import FareNotFoundError
+from ted.fare import (
+    FareCache,
+    FareMatrixWriter,
+    FarePairReduction,
+    FareRuleSet,
+    Itinerary,
+    ItineraryFareEvaluator,
+    TransferIndex,
+    _fare_shard_bounds,
+    cluster_fare_profiles,
+    compute_fares_in_parallel,
+    dense_bg_fare_matrix,
+    fare_signature,
+    make_fare_matrix_from_itineraries,
+    prune_fare_pairs,
+)
+
+TRANSFER_COLUMNS = [
+    "from_mdb_slug",
+    "to_mdb_slug",
+    "from_route_id",
+    "to_route_id",
+    "transfer_type",
+    "new_fare",
+    "fare_value",
+]
+FEEDS = ["feed-a", "feed-b", "feed-c"]
+ROUTES = ["1", "2", "3"]
+
+
+def make_fare_db(
+    path,
+    fare_types=(),
+    zones=(),
+    flat_fares=(),
+    route_fares=(),
+    zone_fares=(),
+    transfers=None,
+):
+    conn = sqlite3.connect(path)
+    for table, columns in [
+        ("fare_type", "mdb_slug, fare_type, transfers_allowed, fare_duration"),
+        ("flat_fare", "mdb_slug, fare_cost"),
+        ("route_fare", "mdb_slug, route_id, fare_cost"),
+        ("zone", "mdb_slug, stop_id, zone_id"),
+        ("zone_fare", "mdb_slug, route_id, from_zone, to_zone, fare_cost"),
+    ]:
+        conn.execute(f"CREATE TABLE {table} ({columns})")
+    conn.executemany("INSERT INTO fare_type VALUES (?, ?, ?, ?)", fare_types)
+    conn.executemany("INSERT INTO zone VALUES (?, ?, ?)", zones)
+    conn.executemany("INSERT INTO flat_fare VALUES (?, ?)", flat_fares)
+    conn.executemany("INSERT INTO route_fare VALUES (?, ?, ?)", route_fares)
+    conn.executemany("INSERT INTO zone_fare VALUES (?, ?, ?, ?, ?)", zone_fares)
+    if transfers is None:
+        transfers = pandas.DataFrame(columns=TRANSFER_COLUMNS)
+    transfers.to_sql("transfer", conn, index=False)
+    conn.commit()
+    conn.close()
+    return path
+
+
+def test_fare_rule_set_lookups_match_fare_tables(tmp_path):
+    db = make_fare_db(
+        str(tmp_path / "fares.db"),
+        fare_types=[("bus", "flat", 1, 7200), ("bus", "zone", 0, 0)],
+        zones=[("rail", "r1", "A"), ("rail", "r2", "B"), ("rail", "r3", "C")],
+        flat_fares=[("bus", 250), ("bus", 300)],
+        route_fares=[("bus", "X", 400)],
+        zone_fares=[
+            ("rail", "__ANY__", "A", "B", 300),
+            ("rail", "R", "A", "B", 350),
+            ("rail", "R", "A", "C", 450),
+            ("rail", "__ANY__", "A", "C", 400),
+        ],
+    )
+    rules = FareRuleSet(db)
+    # The first row in table order wins
+    assert rules.fare_type("bus") == ("flat", 1, 7200)
+    assert rules.flat_fare_cost("bus") == 250
+    assert rules.route_fare_cost("bus", "X") == 400
+    assert rules.route_fare_cost("bus", "Y") is None
+    assert rules.zone("rail", "r2") == "B"
+
+    assert rules.zone_fare_cost("rail", "R", "A", "B") == 300
+    assert rules.zone_fare_cost("rail", "R", "A", "C") == 450
+    # Routes without their own rule fall back to __ANY__
+    assert rules.zone_fare_cost("rail", "Q", "A", "C") == 400
+    # Trips against the direction of the rules use the reverse direction
+    assert rules.zone_fare_cost("rail", "R", "C", "A") == 450
+    assert rules.zone_fare_cost("rail", "Q", "B", "A") == 300
+    assert rules.zone_fare_cost("rail", "Q", "B", "C") is None
+
+    with pytest.raises(FareNotFoundError):
+        rules.fare_type("ferry")
+    with pytest.raises(FareNotFoundError):
+        rules.flat_fare_cost("rail")
+    with pytest.raises(IndexError):
+        rules.zone("rail", "r4")
+
+
+def resolve_with_dataframe(transfers, from_feed, to_feed, from_route_id):
+    """The DataFrame resolution Itinerary.compute_fare used before the index"""
+    df = transfers[transfers.from_mdb_slug == from_feed]
+    df = df[df.to_mdb_slug == to_feed]
+
+    from_df = df[df.from_route_id == "__ANY__"]
+    if from_df.shape[0] == 0:
+        from_df = df[df.from_route_id == from_route_id]
+        if from_df.shape[0] == 0:
+            from_df = df[df.from_route_id == "__ELSE__"]
+
+    to_df = from_df[from_df.to_route_id == "__ANY__"]
+    if to_df.shape[0] == 0:
+        to_df = from_df[from_df.from_route_id == from_route_id]
+        if to_df.shape[0] == 0:
+            to_df = from_df[from_df.from_route_id == "__ELSE__"]
+
+    if to_df.shape[0] > 0:
+        return to_df.iloc[0]
+    return None
+
+
+def random_transfers(seed):
+    rnd = random.Random(seed)
+    route_choices = ROUTES + ["__ANY__", "__ELSE__"]
+    rows = []
+    for idx in range(rnd.randint(1, 25)):
+        rows.append(
+            (
+                rnd.choice(FEEDS),
+                rnd.choice(FEEDS),
+                rnd.choice(route_choices),
+                rnd.choice(route_choices),
+                rnd.choice(["transfer-discount", "upgrade"]),
+                rnd.choice([0, 1]),
+                idx,
+            )
+        )
+    return pandas.DataFrame(rows, columns=TRANSFER_COLUMNS)
+
+
+@pytest.mark.parametrize("seed", range(50))
+def test_transfer_index_matches_dataframe_resolution(seed):
+    transfers = random_transfers(seed)
+    index = TransferIndex(transfers)
+    for from_feed, to_feed, route_id in itertools.product(FEEDS, FEEDS, ROUTES + ["4"]):
+        expected = resolve_with_dataframe(transfers, from_feed, to_feed, route_id)
+        rule = index.lookup(from_feed, to_feed, route_id)
+        if expected is None:
+            assert rule is None
+        else:
+            assert rule is not None
+            # fare_value is unique per row, so it identifies the rule
+            assert rule.fare_value == expected.fare_value
+
+
+def test_fare_rule_set_loads_transfer_index(tmp_path):
+    db = make_fare_db(str(tmp_path / "fares.db"), transfers=random_transfers(0))
+    rules = FareRuleSet(db)
+    transfers = random_transfers(0)
+    for from_feed, to_feed, route_id in itertools.product(FEEDS, FEEDS, ROUTES):
+        expected = resolve_with_dataframe(transfers, from_feed, to_feed, route_id)
+        rule = rules.transfer_rule(from_feed, to_feed, route_id)
+        assert (rule is None) == (expected is None)
+
+
+def test_fare_matrix_writer_resumes_after_checkpoint(tmp_path):
+    matrix = str(tmp_path / "matrix.parquet")
+    origins = {
+        from_id: pandas.DataFrame(
+            {"from_id": from_id, "to_id": [1, 2, 3], "fare_cost": [from_id] * 3}
+        )
+        for from_id in range(10)
+    }
+
+    # Interrupt a run partway through, leaving some rows unflushed
+    writer = FareMatrixWriter(matrix, flush_rows=6)
+    for from_id in range(5):
+        writer.write(from_id, origins[from_id])
+    assert writer.completed_origin == 3
+
+    writer = FareMatrixWriter(matrix, flush_rows=6)
+    assert writer.completed_origin == 3
+    for from_id in range(writer.completed_origin + 1, 10):
+        writer.write(from_id, origins[from_id])
+    writer.close()
+
+    df = pandas.read_parquet(matrix)
+    expected = pandas.concat(origins.values(), ignore_index=True)
+    pandas.testing.assert_frame_equal(df, expected)
+    assert sorted(os.listdir(tmp_path)) == ["matrix.parquet"]
+
+
+def test_fare_shard_bounds_cover_origins_in_order():
+    from_ids = pandas.Series([5, 1, 1, 2, 3, 3, 3, 4, 7, 7, 8, 9])
+    bounds = _fare_shard_bounds(from_ids, 4)
+    assert len(bounds) <= 4
+    covered = [
+        from_id
+        for first, last in bounds
+        for from_id in sorted(from_ids.unique())
+        if first <= from_id <= last
+    ]
+    assert covered == sorted(from_ids.unique())
+
+    bounds = _fare_shard_bounds(from_ids, 4, after=4)
+    assert bounds[0][0] == 5 and bounds[-1][1] == 9
+    assert _fare_shard_bounds(from_ids, 4, after=9) == []
+
+
+FARE_ROUTES = {"bus": ["1", "2"], "rail": ["R"], "ferry": ["F"]}
+FARE_MODES = {"bus": "BUS", "rail": "RAIL", "ferry": "FERRY"}
+
+
+def random_fare_db(path, seed):
+    """A flat fare bus, a zone fare rail line and a premium ferry"""
+    rnd = random.Random(seed)
+    route_choices = ["1", "2", "R", "F", "__ANY__", "__ELSE__"]
+    transfers = pandas.DataFrame(
+        [
+            (
+                rnd.choice(list(FARE_ROUTES)),
+                rnd.choice(list(FARE_ROUTES)),
+                rnd.choice(route_choices),
+                rnd.choice(route_choices),
+                rnd.choice(["transfer-discount", "upgrade"]),
+                rnd.choice([0, 1]),
+                rnd.choice([0, 50, 125, 250]),
+            )
+            for _ in range(rnd.randint(0, 8))
+        ],
+        columns=TRANSFER_COLUMNS,
+    )
+    return make_fare_db(
+        path,
+        fare_types=[
+            ("bus", "flat", rnd.choice([-1, 0, 1]), 3600),
+            ("rail", "zone", rnd.choice([-1, 1]), rnd.choice([0, 5400])),
+            ("ferry", "flat", 0, 0),
+        ],
+        zones=[("rail", f"rail-{idx}", "AB"[idx // 3]) for idx in range(6)],
+        flat_fares=[("bus", 250), ("ferry", 600)],
+        route_fares=[("ferry", "F", 700)],
+        zone_fares=[
+            ("rail", "__ANY__", "A", "A", 300),
+            ("rail", "R", "A", "B", 450),
+        ],
+        transfers=transfers,
+    )
+
+
+def random_itineraries(seed, pairs=150):
+    """Itineraries of walking and transit segments, as written by the OTP runners"""
+    rnd = random.Random(seed)
+    rows = []
+    for pair in range(pairs):
+        from_id, to_id = divmod(pair, 12)
+        time = pandas.Timestamp("2023-09-27 08:00", tz="America/New_York")
+        for segment in range(rnd.randint(1, 5)):
+            time += pandas.Timedelta(minutes=rnd.choice([0, 10, 45, 70]))
+            if rnd.random() < 0.35:
+                rows.append(
+                    (
+                        from_id,
+                        to_id,
+                        segment,
+                        "WALK",
+                        time,
+                        None,
+                        None,
+                        None,
+                        None,
+                        None,
+                    )
+                )
+                continue
+            feed = rnd.choice(list(FARE_ROUTES))
+            stops = [f"{feed}-{idx}" for idx in range(6)]
+            rows.append(
+                (
+                    from_id,
+                    to_id,
+                    segment,
+                    FARE_MODES[feed],
+                    time,
+                    feed,
+                    f"{feed}-agency",
+                    rnd.choice(FARE_ROUTES[feed]),
+                    rnd.choice(stops),
+                    rnd.choice(stops),
+                )
+            )
+    df = pandas.DataFrame(
+        rows,
+        columns=[
+            "from_id",
+            "to_id",
+            "segment",
+            "mode",
+            "departure_time",
+            "feed",
+            "agency_id",
+            "route_id",
+            "start_stop_id",
+            "end_stop_id",
+        ],
+    )
+    # The OTP runners do not write segments in order
+    return df.sample(frac=1, random_state=seed).reset_index(drop=True)
+
+
+def fares_pair_by_pair(df, region_key, db):
+    """The per-pair loop run_itineraries.py used before the evaluator"""
+    df = df.rename(columns={"mode": "transport_mode"})
+    pairs = df.drop_duplicates(subset=["from_id", "to_id"])
+    fares = {"from_id": [], "to_id": [], "fare_cost": []}
+    for idx, pair in pairs.iterrows():
+        sub_df = df[
+            (df.from_id == pair["from_id"]) & (df.to_id == pair["to_id"])
+        ].copy()
+        if sub_df.shape[0] > 1:
+            it = Itinerary(sub_df, region_key, db)
+            it.clean()
+            it.make_legs()
+            # The loop failed on walking-only itineraries, which get no fare
+            if len(it._legs) == 0:
+                continue
+            fares["from_id"].append(pair["from_id"])
+            fares["to_id"].append(pair["to_id"])
+            fares["fare_cost"].append(it.compute_fare())
+    return (
+        pandas.DataFrame(fares).sort_values(["from_id", "to_id"]).reset_index(drop=True)
+    )
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_itinerary_fare_evaluator_matches_pair_by_pair_fares(tmp_path, seed):
+    db = random_fare_db(str(tmp_path / "fares.db"), seed)
+    df = random_itineraries(seed)
+    expected = fares_pair_by_pair(df, "TST", db)
+
+    evaluator = ItineraryFareEvaluator(df, db, "TST", verbose=False)
+    result = evaluator.compute()
+    assert evaluator.size == expected.shape[0]
+    pandas.testing.assert_frame_equal(result, expected, check_dtype=False)
+    # Single segment pairs and walking-only pairs get no fare
+    sizes = df.groupby(["from_id", "to_id"]).size()
+    walking = df.assign(transit=df["mode"] != "WALK").groupby(["from_id", "to_id"])
+    priced = sizes[(sizes > 1) & walking.transit.any()].index
+    assert list(zip(result.from_id, result.to_id)) == list(priced)
+
+
+def test_fare_cache_evicts_least_recently_used():
+    cache = FareCache(maxsize=2)
+    assert cache.get("a") is None and cache.hit_rate == 0.0
+    cache.put("a", 100)
+    cache.put("b", 200)
+    # Reading "a" makes "b" the least recently used fare
+    assert cache.get("a") == 100
+    cache.put("c", 300)
+    assert len(cache) == 2
+    assert cache.get("b") is None
+    assert cache.get("a") == 100 and cache.get("c") == 300
+    assert (cache.hits, cache.misses) == (3, 2)
+    assert cache.hit_rate == 0.6
+    # Putting a cached key again refreshes it without growing the cache
+    cache.put("a", 150)
+    cache.put("d", 400)
+    assert len(cache) == 2 and cache.get("c") is None and cache.get("a") == 150
+
+
+def test_fare_signature_buckets_times_against_fare_duration(tmp_path):
+    rules = FareRuleSet(random_fare_db(str(tmp_path / "fares.db"), 0))
+    start = pandas.Timestamp("2023-09-27 08:00", tz="America/New_York")
+
+    def signature(feeds, stops, gaps):
+        times = [start + pandas.Timedelta(minutes=gap) for gap in gaps]
+        return fare_signature(
+            feeds,
+            [FARE_ROUTES.get(feed, ["M"])[0] for feed in feeds],
+            [stop for stop, _ in stops],
+            [stop for _, stop in stops],
+            times,
+            rules,
+        )
+
+    bus_rail = ["bus", "rail"]
+    stops = [("bus-0", "bus-1"), ("rail-0", "rail-4")]
+    # Bus fares last an hour, so only crossing it changes the signature
+    assert signature(bus_rail, stops, [0, 10]) == signature(bus_rail, stops, [0, 55])
+    assert signature(bus_rail, stops, [0, 55]) != signature(bus_rail, stops, [0, 65])
+    # Flat fare stops don't matter, zone fare stops only through their zones
+    assert signature(bus_rail, stops, [0, 10]) == signature(
+        bus_rail, [("bus-3", "bus-5"), ("rail-1", "rail-3")], [0, 10]
+    )
+    assert signature(bus_rail, stops, [0, 10]) != signature(
+        bus_rail, [("bus-0", "bus-1"), ("rail-0", "rail-1")], [0, 10]
+    )
+    # Fares without a duration never expire
+    assert signature(["ferry", "bus"], stops, [0, 10]) == signature(
+        ["ferry", "bus"], stops, [0, 600]
+    )
+    # Feeds without fare rules keep their stops
+    assert signature(["metro"], [("m-1", "m-2")], [0]) != signature(
+        ["metro"], [("m-1", "m-3")], [0]
+    )
+
+
+def test_fares_in_parallel_report_worker_cache_hits(tmp_path, capsys):
+    db = random_fare_db(str(tmp_path / "fares.db"), 1)
+    df = random_itineraries(1)
+    expected = ItineraryFareEvaluator(df, db, "TST", verbose=False)
+    expected_df = expected.compute()
+
+    capsys.readouterr()
+    result = pandas.concat(
+        [f for _, f in compute_fares_in_parallel(df, db, "TST", 2)],
+        ignore_index=True,
+    )
+    pandas.testing.assert_frame_equal(result, expected_df)
+    out = capsys.readouterr().out
+    assert "Fare cache:" in out
+    hits = int(out.split("Fare cache:")[1].split("hits")[0])
+    # Workers price their own origins, so they can only miss more often
+    assert 0 < hits <= expected.cache.hits
+
+
+@pytest.mark.parametrize("seed", range(2))
+def test_fare_matrix_is_the_same_on_any_number_of_workers(tmp_path, seed):
+    db = random_fare_db(str(tmp_path / "fares.db"), seed)
+    itineraries = str(tmp_path / "itineraries.parquet")
+    random_itineraries(seed).to_parquet(itineraries)
+
+    make_fare_matrix_from_itineraries(
+        itineraries, str(tmp_path / "serial.parquet"), db, "TST"
+    )
+    make_fare_matrix_from_itineraries(
+        itineraries, str(tmp_path / "parallel.parquet"), db, "TST", workers=2
+    )
+    expected = pandas.read_parquet(tmp_path / "serial.parquet")
+    assert expected.shape[0] > 0
+    pandas.testing.assert_frame_equal(
+        pandas.read_parquet(tmp_path / "parallel.parquet"), expected
+    )
+
+    # A loaded rule set is sent to the workers as its database path
+    result = pandas.concat(
+        [
+            f
+            for _, f in compute_fares_in_parallel(
+                itineraries, FareRuleSet(db), "TST", 2
+            )
+        ],
+        ignore_index=True,
+    )
+    pandas.testing.assert_frame_equal(result, expected, check_dtype=False)
+
+
+def test_fare_pair_reduction_groups_clusters_by_zone_and_feed(tmp_path):
+    db = make_fare_db(
+        str(tmp_path / "fares.db"),
+        fare_types=[("bus", "flat", 1, 120), ("rail", "zone", 1, 120)],
+        zones=[("rail", "r1", "A"), ("rail", "r2", "A"), ("rail", "r3", "B")],
+    )
+    # Clusters 0-2 sit by bus stops, 0 and 1 by rail zone A and 2 by zone B,
+    # 3 has nothing nearby
+    clusters = pandas.DataFrame(
+        {
+            "CLUSTER_ID": [0, 1, 2, 3],
+            "MEAN_X": [-122.30, -122.25, -122.20, -122.00],
+            "MEAN_Y": [47.60, 47.60, 47.60, 47.80],
+        }
+    )
+    stops = geopandas.GeoDataFrame(
+        {
+            "stop_id": ["b1", "b2", "b3", "r1", "r2", "r3"],
+            "agency": ["gtfs-bus"] * 3 + ["gtfs-rail"] * 3,
+        },
+        geometry=geopandas.points_from_xy(
+            [-122.30, -122.25, -122.20, -122.30, -122.25, -122.20], [47.60] * 6
+        ),
+        crs="EPSG:4326",
+    )
+    profiles = cluster_fare_profiles(clusters, stops, db, radius=200)
+    assert profiles[0] == profiles[1]
+    assert len({profiles[0], profiles[2], profiles[3]}) == 3
+
+    pairs = pandas.DataFrame(
+        [(o, d) for o in range(4) for d in range(4) if o != d],
+        columns=["from_id", "to_id"],
+    )
+    reduction = FarePairReduction(pairs, profiles, validation_share=0.5)
+    # 0 and 1 share a profile, so their pairs towards each other, towards 2
+    # and 3 and back fall into one class per direction and profile
+    assert reduction.representatives.shape[0] == 7
+    assert reduction.validation.shape[0] == 2
+
+    # A fare that depends only on the class is reproduced exactly
+    fares = reduction.query_pairs.copy()
+    fares["fare_cost"] = fares.merge(reduction.pairs)["class_id"].to_numpy() * 10
+    expanded = reduction.expand(fares)
+    assert expanded.shape[0] == 12
+    merged = expanded.merge(reduction.pairs)
+    assert (merged.fare_cost == merged.class_id * 10).all()
+
+    report = reduction.report(fares)
+    assert report["coverage"] == 1.0
+    assert report["exact"] == 1.0
+    assert report["reduction"] == 12 / 9
+
+
+def test_prune_fare_pairs_keeps_pairs_within_largest_cutoff_and_slack(capsys):
+    pairs = pandas.DataFrame(
+        {"from_id": range(6), "to_id": 0, "travel_time": [10, 60, 90, 105, 106, 179]}
+    )
+    pruned = prune_fare_pairs(pairs, cutoffs=[30, 90], slack=15)
+    assert pruned.travel_time.tolist() == [10, 60, 90, 105]
+    assert "2 (33.3%)" in capsys.readouterr().out
+    # The limit never exceeds the travel time past which itineraries are dropped
+    assert prune_fare_pairs(pairs, cutoffs=[90], slack=120).shape[0] == 6
+    # Pair lists without travel times are left alone
+    assert prune_fare_pairs(pairs[["from_id", "to_id"]]).shape[0] == 6
+
+
+def map_with_dataframe(fmx, c2bg, all_bgs, infinite_fare):
+    """The string merges map_fare_matrix_to_bg used before the dense matrix"""
+    pairs = pandas.DataFrame(
+        list(itertools.product(all_bgs, all_bgs)), columns=["BG20_from", "BG20_to"]
+    )
+    df = pandas.merge(fmx, c2bg, left_on="from_id", right_on="CLUSTER_ID", how="left")
+    df = pandas.merge(
+        df,
+        c2bg,
+        left_on="to_id",
+        right_on="CLUSTER_ID",
+        how="left",
+        suffixes=["_from", "_to"],
+    )
+    df = df[["BG20_from", "BG20_to", "fare_cost"]]
+    df = pandas.merge(pairs, df, on=["BG20_from", "BG20_to"], how="left")
+    return df["fare_cost"].fillna(infinite_fare).to_numpy()
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_dense_bg_fare_matrix_matches_dataframe_mapping(seed):
+    rnd = random.Random(seed)
+    all_bgs = [f"BG{idx}" for idx in range(30)]
+    # Some block groups have no cluster and some clusters have no fares
+    c2bg = pandas.DataFrame(
+        {"CLUSTER_ID": [rnd.randint(0, 12) for _ in range(25)], "BG20": all_bgs[:25]}
+    )
+    fmx = pandas.DataFrame(
+        [
+            (from_id, to_id, rnd.randint(0, 1000))
+            for from_id, to_id in itertools.product(range(15), range(15))
+            if rnd.random() < 0.6
+        ],
+        columns=["from_id", "to_id", "fare_cost"],
+    )
+    matrix = dense_bg_fare_matrix(fmx, c2bg, all_bgs, infinite_fare=9999)
+    assert matrix.dtype == "uint16"
+    expected = map_with_dataframe(fmx, c2bg, all_bgs, 9999)
+    assert (matrix.ravel() == expected).all()
+
+
+def test_dense_bg_fare_matrix_rejects_fares_beyond_uint16():
+    c2bg = pandas.DataFrame({"CLUSTER_ID": [0], "BG20": ["BG0"]})
+    fmx = pandas.DataFrame({"from_id": [0], "to_id": [0], "fare_cost": [70000]})
+    with pytest.raises(ValueError):
+        dense_bg_fare_matrix(fmx, c2bg, ["BG0"])
+
+
+def test_dense_bg_fare_matrix_rejects_block_groups_in_several_clusters():
+    fmx = pandas.DataFrame(
+        {"from_id": [0, 0, 1, 1], "to_id": [0, 1, 0, 1], "fare_cost": [1, 2, 3, 4]}
+    )
+    # Repeating the same assignment is harmless
+    c2bg = pandas.DataFrame({"CLUSTER_ID": [0, 0, 1], "BG20": ["BG0", "BG0", "BG1"]})
+    assert dense_bg_fare_matrix(fmx, c2bg, ["BG0", "BG1"]).tolist() == [[1, 2], [3, 4]]
+    c2bg = pandas.DataFrame({"CLUSTER_ID": [0, 1, 1], "BG20": ["BG0", "BG0", "BG1"]})
+    with pytest.raises(ValueError, match="BG0"):
+        dense_bg_fare_matrix(fmx, c2bg, ["BG0", "BG1"])
@@ -0,0 +1,339 @@
+import datetime
+import os
+import zipfile
+
+import geopandas
+import numpy
+import pandas
+import pytest
+from gtfslite import GTFS
+from shapely.geometry import box
+
+from ted.gtfs import (
+    cache_feed,
+    feed_digest,
+    compute_transit_service_intensity,
+    load_gtfs,
+    prune_feed_cache,
+    remove_routes_from_gtfs,
+    trip_stop_times,
+)
+
+
+def write_feed(path, stop_times, frequencies=None, stops=6):
+    """Write a small feed with a weekday and a weekend service"""
+    tables = {
+        "agency.txt": pandas.DataFrame(
+            {
+                "agency_id": ["A"],
+                "agency_name": ["Agency"],
+                "agency_url": ["https://example.com"],
+                "agency_timezone": ["America/Los_Angeles"],
+            }
+        ),
+        "stops.txt": pandas.DataFrame(
+            {
+                "stop_id": [f"s{idx}" for idx in range(stops)],
+                "stop_name": [f"Stop {idx}" for idx in range(stops)],
+                "stop_lat": 47.6,
+                "stop_lon": [-122.3 + 0.01 * idx for idx in range(stops)],
+            }
+        ),
+        "routes.txt": pandas.DataFrame(
+            {"route_id": ["r"], "agency_id": ["A"], "route_type": [3]}
+        ),
+        "trips.txt": stop_times[["trip_id"]]
+        .drop_duplicates()
+        .assign(
+            route_id="r",
+            service_id=lambda df: numpy.where(
+                df.trip_id.str.startswith("sat"), "weekend", "weekday"
+            ),
+        ),
+        "calendar.txt": pandas.DataFrame(
+            {
+                "service_id": ["weekday", "weekend"],
+                **{
+                    day: [1, 0]
+                    for day in ["monday", "tuesday", "wednesday", "thursday"]
+                },
+                "friday": [1, 0],
+                "saturday": [0, 1],
+                "sunday": [0, 1],
+                "start_date": "20230101",
+                "end_date": "20231231",
+            }
+        ),
+        "stop_times.txt": stop_times,
+    }
+    if frequencies is not None:
+        tables["frequencies.txt"] = frequencies
+    with zipfile.ZipFile(path, "w") as zf:
+        for name, df in tables.items():
+            zf.writestr(name, df.to_csv(index=False))
+
+
+def random_stop_times(seed, prefix, trips=80, stops=6):
+    rng = numpy.random.default_rng(seed)
+    rows = []
+    for idx in range(trips):
+        trip_id = f"{'sat' if idx % 4 == 0 else 'wd'}-{prefix}{idx}"
+        start = int(rng.integers(5 * 3600, 12 * 3600))
+        visited = rng.choice(stops, int(rng.integers(2, stops + 1)), replace=False)
+        for seq, stop in enumerate(visited):
+            time = start + seq * 300
+            rows.append(
+                (
+                    trip_id,
+                    f"{time // 3600:02d}:{time // 60 % 60:02d}:{time % 60:02d}",
+                    f"{time // 3600:02d}:{time // 60 % 60:02d}:{time % 60:02d}",
+                    f"s{stop}",
+                    seq,
+                )
+            )
+    return pandas.DataFrame(
+        rows,
+        columns=[
+            "trip_id",
+            "arrival_time",
+            "departure_time",
+            "stop_id",
+            "stop_sequence",
+        ],
+    )
+
+
+@pytest.fixture
+def areas():
+    # Overlapping areas, so some stops count towards two block groups
+    stops = geopandas.GeoSeries(
+        geopandas.points_from_xy([-122.3 + 0.01 * idx for idx in range(6)], [47.6] * 6),
+        crs="EPSG:4326",
+    ).to_crs("EPSG:32610")
+    x, y = stops.x.to_numpy(), stops.y.to_numpy()
+    return geopandas.GeoDataFrame(
+        {"BG20": ["bg0", "bg1", "bg2", "bg3"]},
+        geometry=[
+            box(x[0] - 50, y[0] - 50, x[2] + 50, y[0] + 50),
+            box(x[2] - 50, y[0] - 50, x[3] + 50, y[0] + 50),
+            box(x[5] - 50, y[0] - 50, x[5] + 50, y[0] + 50),
+            box(x[5] + 5000, y[0], x[5] + 6000, y[0] + 1000),
+        ],
+        crs="EPSG:32610",
+    )
+
+
+def test_service_intensity_matches_unique_trip_counts(tmp_path, areas):
+    feeds = tmp_path / "gtfs"
+    feeds.mkdir()
+    write_feed(feeds / "one.zip", random_stop_times(0, "a"))
+    write_feed(feeds / "two.zip", random_stop_times(1, "b"))
+    (feeds / "notes.zip").write_text("not a feed")
+    runs = {
+        "WEDAM": datetime.datetime(2023, 3, 15, 7),
+        "WEDPM": datetime.datetime(2023, 3, 15, 10, 30),
+        "SATAM": datetime.datetime(2023, 3, 18, 7),
+    }
+    result = compute_transit_service_intensity(
+        str(feeds), areas, runs, cache_folder=str(tmp_path / "cache")
+    )
+    assert result.index.tolist() == ["bg0", "bg1", "bg2", "bg3"]
+    assert result.columns.tolist() == list(runs)
+    assert (result.loc["bg0"] > 0).all() and (result.loc["bg3"] == 0).all()
+
+    stops = geopandas.sjoin(
+        geopandas.GeoDataFrame(
+            geometry=geopandas.points_from_xy(
+                [-122.3 + 0.01 * idx for idx in range(6)], [47.6] * 6
+            ),
+            crs="EPSG:4326",
+        )
+        .to_crs(areas.crs)
+        .assign(stop_id=[f"s{idx}" for idx in range(6)]),
+        areas,
+    )
+    for feed in ["one", "two"]:
+        gtfs = GTFS.load_zip(str(feeds / f"{feed}.zip"))
+        for bg, bg_stops in stops.groupby("BG20"):
+            for run_key, start in runs.items():
+                expected = gtfs.unique_trip_count_at_stops(
+                    bg_stops.stop_id.tolist(),
+                    date=start.date(),
+                    start_time=start.strftime("%H:%M:%S"),
+                    end_time=(start + datetime.timedelta(hours=2)).strftime("%H:%M:%S"),
+                )
+                result.loc[bg, run_key] -= expected
+    assert (result == 0).all().all()
+
+
+def test_frequency_trips_count_every_instance(tmp_path, areas):
+    stop_times = pandas.DataFrame(
+        {
+            "trip_id": ["wd-f", "wd-f", "wd-f", "wd-s"],
+            "arrival_time": ["00:00:00", "00:10:00", "00:40:00", "07:30:00"],
+            "departure_time": ["00:00:00", "00:10:00", "00:40:00", "07:30:00"],
+            "stop_id": ["s0", "s1", "s5", "s0"],
+            "stop_sequence": [0, 1, 2, 0],
+        }
+    )
+    # Every 15 minutes from 06:00 to 08:00, then every 30 minutes to 09:00
+    frequencies = pandas.DataFrame(
+        {
+            "trip_id": ["wd-f", "wd-f"],
+            "start_time": ["06:00:00", "08:00:00"],
+            "end_time": ["08:00:00", "09:00:00"],
+            "headway_secs": [900, 1800],
+        }
+    )
+    feeds = tmp_path / "gtfs"
+    feeds.mkdir()
+    write_feed(feeds / "freq.zip", stop_times, frequencies)
+    visits = trip_stop_times(GTFS.load_zip(str(feeds / "freq.zip")))
+    assert visits[visits.trip_id == "wd-f"].instance.nunique() == 10
+    last = visits[(visits.trip_id == "wd-f") & (visits.stop_id == "s5")].time.max()
+    assert last == 8 * 3600 + 30 * 60 + 40 * 60
+
+    result = compute_transit_service_intensity(
+        str(feeds),
+        areas,
+        {"WEDAM": datetime.datetime(2023, 3, 15, 7)},
+        cache_folder=str(tmp_path / "cache"),
+    )
+    # bg0 counts the six instances starting 07:00 to 09:00 once each, though
+    # they visit two of its stops, and the scheduled trip; bg2 counts the seven
+    # instances reaching s5 between 07:00 and 09:00
+    assert result.WEDAM.tolist() == [7, 0, 7, 0]
+
+
+def test_feed_cache_round_trips_gtfs_tables(tmp_path, capsys):
+    stop_times = random_stop_times(2, "c", trips=20)
+    stop_times.loc[3, ["arrival_time", "departure_time"]] = numpy.nan
+    frequencies = pandas.DataFrame(
+        {
+            "trip_id": ["wd-c1"],
+            "start_time": ["06:00:00"],
+            "end_time": ["25:30:00"],
+            "headway_secs": [600],
+        }
+    )
+    write_feed(tmp_path / "feed.zip", stop_times, frequencies)
+    cache = str(tmp_path / "cache")
+    expected = GTFS.load_zip(str(tmp_path / "feed.zip"))
+
+    folder = cache_feed(str(tmp_path / "feed.zip"), cache)
+    assert "Caching" in capsys.readouterr().out
+    cached = pandas.read_parquet(os.path.join(folder, "stop_times.parquet"))
+    assert str(cached.arrival_time.dtype) == "Int32"
+    assert isinstance(cached.trip_id.dtype, pandas.CategoricalDtype)
+
+    gtfs = load_gtfs(str(tmp_path / "feed.zip"), cache_folder=cache)
+    assert capsys.readouterr().out == ""
+    for table in ["agency", "stops", "routes", "trips", "stop_times", "calendar"]:
+        pandas.testing.assert_frame_equal(
+            getattr(gtfs, table), getattr(expected, table), check_dtype=False
+        )
+    pandas.testing.assert_frame_equal(
+        gtfs.frequencies, expected.frequencies, check_dtype=False
+    )
+    assert gtfs.calendar_dates is None
+    assert gtfs.unique_trip_count_at_stops(
+        ["s0", "s1"], datetime.date(2023, 3, 15), "07:00:00", "09:00:00"
+    ) == expected.unique_trip_count_at_stops(
+        ["s0", "s1"], datetime.date(2023, 3, 15), "07:00:00", "09:00:00"
+    )
+
+    seconds = load_gtfs(str(tmp_path / "feed.zip"), seconds=True, cache_folder=cache)
+    assert seconds.frequencies.end_time.tolist() == [25 * 3600 + 30 * 60]
+    pandas.testing.assert_frame_equal(
+        trip_stop_times(seconds), trip_stop_times(expected)
+    )
+
+    (tmp_path / "broken.zip").write_text("not a feed")
+    with pytest.raises(zipfile.BadZipFile):
+        load_gtfs(str(tmp_path / "broken.zip"), cache_folder=cache)
+
+
+def test_removing_routes_keeps_the_other_tables_as_written(tmp_path):
+    # Times without a leading zero, which the feed cache would re-render
+    tables = {
+        "agency.txt": "agency_id,agency_name,agency_url,agency_timezone\n"
+        "A,Agency,https://example.com,America/Los_Angeles\n",
+        "stops.txt": "stop_id,stop_name,stop_lat,stop_lon\n"
+        "s0,Stop 0,47.6,-122.3\ns1,Stop 1,47.61,-122.29\ns2,Stop 2,47.62,-122.28\n",
+        "routes.txt": "route_id,agency_id,route_short_name,route_type\n"
+        "local,A,1,3\nexpress,A,1X,3\n",
+        "trips.txt": "route_id,service_id,trip_id\n"
+        "local,weekday,wd-1\nexpress,weekday,wd-2\nlocal,weekday,wd-3\n",
+        "stop_times.txt": "trip_id,arrival_time,departure_time,stop_id,stop_sequence\n"
+        "wd-1,7:05:00,7:05:00,s0,1\nwd-1,,,s1,2\nwd-1,7:20:00,7:20:00,s2,3\n"
+        "wd-2,8:00:00,8:00:00,s0,1\nwd-2,8:10:00,8:10:00,s2,2\n"
+        "wd-3,25:01:00,25:01:00,s0,1\nwd-3,25:11:00,25:11:00,s1,2\n",
+        "calendar.txt": "service_id,monday,tuesday,wednesday,thursday,friday,"
+        "saturday,sunday,start_date,end_date\n"
+        "weekday,1,1,1,1,1,0,0,20230101,20231231\n",
+        "frequencies.txt": "trip_id,start_time,end_time,headway_secs\n"
+        "wd-3,6:00:00,9:00:00,600\n",
+    }
+    with zipfile.ZipFile(tmp_path / "feed.zip", "w") as zf:
+        for name, text in tables.items():
+            zf.writestr(name, text)
+    # A cached copy of the feed must not leak into the written one
+    load_gtfs(str(tmp_path / "feed.zip"), cache_folder=str(tmp_path / "cache"))
+    remove_routes_from_gtfs(
+        str(tmp_path / "feed.zip"), str(tmp_path / "out"), ["express"]
+    )
+
+    with zipfile.ZipFile(tmp_path / "out" / "feed.zip") as zf:
+        for name in ["agency.txt", "stops.txt", "calendar.txt", "frequencies.txt"]:
+            assert zf.read(name) == tables[name].encode()
+        kept = [
+            line
+            for line in tables["stop_times.txt"].splitlines()
+            if not line.startswith("wd-2,")
+        ]
+        assert zf.read("stop_times.txt").decode().splitlines() == kept
+        assert b"express" not in zf.read("routes.txt")
+
+
+def test_changed_feed_gets_a_new_cache_entry(tmp_path, capsys):
+    feeds = tmp_path / "gtfs"
+    feeds.mkdir()
+    cache = str(tmp_path / "cache")
+    write_feed(feeds / "feed.zip", random_stop_times(0, "a"))
+    before = load_gtfs(str(feeds / "feed.zip"), cache_folder=cache)
+    assert "Caching" in capsys.readouterr().out
+
+    # The same path with new contents is parsed again, not read from the old entry
+    write_feed(feeds / "feed.zip", random_stop_times(1, "b", trips=10))
+    after = load_gtfs(str(feeds / "feed.zip"), cache_folder=cache)
+    assert "Caching" in capsys.readouterr().out
+    assert after.trips.trip_id.tolist() != before.trips.trip_id.tolist()
+    pandas.testing.assert_frame_equal(
+        after.stop_times,
+        GTFS.load_zip(str(feeds / "feed.zip")).stop_times,
+        check_dtype=False,
+    )
+    assert len(os.listdir(cache)) == 2
+
+    # Only the entry of the current contents is kept
+    assert len(prune_feed_cache([str(tmp_path)], cache)) == 1
+    assert os.listdir(cache) == [feed_digest(str(feeds / "feed.zip"))]
+    load_gtfs(str(feeds / "feed.zip"), cache_folder=cache)
+    assert "Caching" not in capsys.readouterr().out
+    assert len(prune_feed_cache([], cache)) == 1
+    assert os.listdir(cache) == []
+
+
+def test_feeds_load_without_a_cache(tmp_path, capsys):
+    write_feed(tmp_path / "feed.zip", random_stop_times(0, "a"))
+    cached = load_gtfs(
+        str(tmp_path / "feed.zip"), seconds=True, cache_folder=str(tmp_path / "cache")
+    )
+    capsys.readouterr()
+    uncached = load_gtfs(str(tmp_path / "feed.zip"), seconds=True, cache_folder=None)
+    assert capsys.readouterr().out == ""
+    # Nothing was cached beside the entry written above
+    assert len(os.listdir(tmp_path / "cache")) == 1
+    pandas.testing.assert_frame_equal(
+        uncached.stop_times, cached.stop_times, check_dtype=False
+    )
@@ -0,0 +1,67 @@
+import numpy
+import pandas
+import pytest
+
+from ted.matrix import UNREACHABLE, DenseMatrix, make_index, open_dense_matrix
+
+
+@pytest.fixture
+def long_matrix():
+    ids = ["A", "B", "C"]
+    df = pandas.DataFrame(
+        [(o, d) for o in ids for d in ids], columns=["from_id", "to_id"]
+    )
+    df["travel_time"] = [0, 10, 20.5, 15, 0, numpy.nan, 30, 40, 0]
+    return df
+
+
+def test_dense_matrix_round_trips_long_parquet(tmp_path, long_matrix):
+    parquet = str(tmp_path / "full_matrix.parquet")
+    long_matrix.to_parquet(parquet)
+    index = make_index(["C", "A", "B", "D"])
+
+    matrix = DenseMatrix.from_parquet(parquet, index, out=str(tmp_path / "full.npy"))
+    assert isinstance(matrix.values, numpy.memmap)
+    assert matrix.origin("A").tolist() == [21, 0, 10, UNREACHABLE]
+    assert matrix.destination("C").tolist() == [0, 21, UNREACHABLE, UNREACHABLE]
+    # Fractional costs are rounded up so whole cutoffs keep the same pairs
+    assert (matrix.values <= 20).sum() == (long_matrix.travel_time <= 20).sum()
+
+    loaded = DenseMatrix.load(str(tmp_path / "full.npy"))
+    assert loaded.aligned(matrix)
+    assert (loaded.values == matrix.values).all()
+
+    out = str(tmp_path / "out.parquet")
+    loaded.reindex(make_index(["A", "B", "C"])).to_parquet(out)
+    df = pandas.read_parquet(out)
+    expected = long_matrix.assign(travel_time=numpy.ceil(long_matrix.travel_time))
+    pandas.testing.assert_frame_equal(df, expected)
+
+
+def test_dense_matrix_reindex_pads_missing_block_groups(long_matrix):
+    matrix = DenseMatrix.from_long(long_matrix, make_index(["A", "B", "C"]))
+    assert matrix.reindex(matrix.index).values is matrix.values
+    other = matrix.reindex(make_index(["B", "E"]))
+    assert not other.aligned(matrix)
+    assert other.values.tolist() == [[0, UNREACHABLE], [UNREACHABLE, UNREACHABLE]]
+
+
+def test_dense_matrix_rejects_costs_beyond_sentinel(long_matrix):
+    long_matrix.loc[0, "travel_time"] = UNREACHABLE
+    with pytest.raises(ValueError):
+        DenseMatrix.from_long(long_matrix, make_index(["A", "B", "C"]))
+    with pytest.raises(ValueError):
+        make_index(["A", "A"])
+
+
+def test_open_dense_matrix_converts_once(tmp_path, long_matrix, capsys):
+    parquet = str(tmp_path / "limited_matrix.parquet")
+    long_matrix.to_parquet(parquet)
+    index = make_index(["A", "B", "C"])
+    first = open_dense_matrix(parquet, index)
+    assert "Converting" in capsys.readouterr().out
+    second = open_dense_matrix(parquet, index)
+    assert capsys.readouterr().out == ""
+    assert (first.values == second.values).all()
+    # A different index converts again
+    assert len(open_dense_matrix(parquet, make_index(["A", "B"]))) == 2
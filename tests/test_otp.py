@@ -0,0 +1,387 @@
+import asyncio
+import datetime
+import os
+import socket
+import time
+
+import aiohttp
+import numpy
+import pandas
+import pyarrow.parquet
+import pytest
+
+from otp_stub import stub_in_thread
+from ted.otp import (
+    AsyncOTPClient,
+    EndpointPool,
+    OTP_SLOW_SAMPLES,
+    JobManifest,
+    OTPResponseCache,
+    cross_join_job_blocks,
+    dechunkify,
+    graph_inputs_hash,
+    iter_jobs,
+    pair_job_blocks,
+    run_otp_itineraries_from_pairs_list,
+)
+
+FEEDS = {"1": "stub-transit"}
+DEPARTURE = datetime.datetime(2023, 9, 27, 8)
+
+
+def make_jobs(n):
+    return [
+        (i, i + 1, 47.0 + i / 1000, -122.0, 47.5, -122.3 + i / 1000, DEPARTURE)
+        for i in range(n)
+    ]
+
+
+def test_async_client_writes_every_pair(tmp_path):
+    with stub_in_thread(latency=0.01) as (stub, endpoint):
+        client = AsyncOTPClient(FEEDS, endpoint=endpoint, concurrency=8, batch_size=1)
+        chunks = client.run_to_chunks(make_jobs(50), str(tmp_path), "TST", 20)
+
+    assert chunks == 3
+    assert sorted(os.listdir(tmp_path)) == [
+        "TST_0.parquet",
+        "TST_1.parquet",
+        "TST_2.parquet",
+    ]
+    df = pandas.concat(pandas.read_parquet(tmp_path / f) for f in os.listdir(tmp_path))
+    assert df.shape[0] == 150
+    assert sorted(df.from_id.unique()) == list(range(50))
+    assert set(df.feed.dropna()) == {"stub-transit"}
+    assert client.failed == []
+
+
+@pytest.mark.parametrize(
+    "stub_options",
+    [{"fail_every": 3}, {"fail_every": 3, "fail_status": 429}, {"garbage_every": 3}],
+)
+def test_async_client_retries_failed_requests(tmp_path, stub_options):
+    with stub_in_thread(**stub_options) as (stub, endpoint):
+        client = AsyncOTPClient(
+            FEEDS, endpoint=endpoint, concurrency=4, backoff=0.01, batch_size=1
+        )
+        client.run_to_chunks(make_jobs(30), str(tmp_path), "TST", 30)
+
+    df = pandas.read_parquet(tmp_path / "TST_0.parquet")
+    assert sorted(df.from_id.unique()) == list(range(30))
+    assert stub.requests > stub.plans == 30
+    assert client.failed == []
+
+
+@pytest.mark.parametrize(
+    "stub_options",
+    [{"fail_every": 1}, {"fail_every": 1, "fail_status": 400}, {"garbage_every": 1}],
+)
+def test_async_client_gives_up_after_retries(tmp_path, stub_options):
+    with stub_in_thread(**stub_options) as (stub, endpoint):
+        client = AsyncOTPClient(
+            FEEDS, endpoint=endpoint, concurrency=2, retries=2, backoff=0.01
+        )
+        client.run_to_chunks(make_jobs(4), str(tmp_path), "TST", 10)
+
+    assert stub.requests == 3
+    assert len(client.failed) == 4
+    assert os.listdir(tmp_path) == []
+
+
+def test_async_client_packs_plans_into_batches(tmp_path):
+    with stub_in_thread() as (stub, endpoint):
+        client = AsyncOTPClient(FEEDS, endpoint=endpoint, concurrency=2, batch_size=10)
+        client.run_to_chunks(make_jobs(45), str(tmp_path), "TST", 100)
+
+    assert stub.requests == 5
+    assert stub.plans == 45
+    df = pandas.read_parquet(tmp_path / "TST_0.parquet")
+    assert sorted(df.from_id.unique()) == list(range(45))
+    # Each pair gets the legs of its own plan back
+    bus = df[df["mode"] == "BUS"]
+    expected = bus.from_id.map(lambda i: f"S{round(47.0 + i / 1000, 3)}")
+    assert (bus.start_stop_id == expected).all()
+
+
+def test_async_client_retries_only_failed_plans(tmp_path):
+    with stub_in_thread(error_every=4) as (stub, endpoint):
+        client = AsyncOTPClient(
+            FEEDS, endpoint=endpoint, concurrency=1, batch_size=8, backoff=0.01
+        )
+        client.run_to_chunks(make_jobs(8), str(tmp_path), "TST", 100)
+
+    # Two of the first eight plans fail and are the only ones sent again
+    assert stub.requests == 2
+    assert stub.plans == 10
+    df = pandas.read_parquet(tmp_path / "TST_0.parquet")
+    assert sorted(df.from_id.unique()) == list(range(8))
+    assert client.failed == []
+
+
+def test_response_cache_answers_repeat_runs(tmp_path):
+    cache = OTPResponseCache(str(tmp_path / "cache.db"), "graph-a")
+    (tmp_path / "first").mkdir()
+    (tmp_path / "second").mkdir()
+    with stub_in_thread() as (stub, endpoint):
+        client = AsyncOTPClient(FEEDS, endpoint=endpoint, batch_size=5, cache=cache)
+        client.run_to_chunks(make_jobs(20), str(tmp_path / "first"), "TST", 100)
+        client.run_to_chunks(make_jobs(25), str(tmp_path / "second"), "TST", 100)
+
+    assert stub.plans == 25
+    assert (cache.hits, cache.misses) == (20, 25)
+    first = pandas.read_parquet(tmp_path / "first" / "TST_0.parquet")
+    second = pandas.read_parquet(tmp_path / "second" / "TST_0.parquet")
+    assert second.shape[0] == first.shape[0] * 25 // 20
+    cache.close()
+
+    # The same graph keeps its responses, a changed graph clears them
+    assert len(OTPResponseCache(str(tmp_path / "cache.db"), "graph-a")) == 25
+    assert len(OTPResponseCache(str(tmp_path / "cache.db"), "graph-b")) == 0
+
+
+def test_graph_inputs_hash_tracks_gtfs_zips(tmp_path):
+    (tmp_path / "gtfs-1.zip").write_bytes(b"feed one")
+    (tmp_path / "config.yaml").write_text("feeds: {}")
+    before = graph_inputs_hash(str(tmp_path))
+    (tmp_path / "otp_cache.db").write_bytes(b"ignored")
+    assert graph_inputs_hash(str(tmp_path)) == before
+    (tmp_path / "gtfs-1.zip").write_bytes(b"feed one, updated")
+    assert graph_inputs_hash(str(tmp_path)) != before
+
+
+def test_dechunkify_streams_typed_fragments(tmp_path):
+    chunks = tmp_path / "chunks"
+    chunks.mkdir()
+    with stub_in_thread() as (stub, endpoint):
+        client = AsyncOTPClient(FEEDS, endpoint=endpoint, batch_size=4)
+        client.run_to_chunks(make_jobs(12), str(chunks), "TST", 5)
+
+    output = str(tmp_path / "itineraries.parquet")
+    dechunkify(str(chunks), output)
+
+    schema = pyarrow.parquet.read_schema(output)
+    assert pyarrow.types.is_dictionary(schema.field("route_id").type)
+    assert pyarrow.types.is_timestamp(schema.field("departure_time").type)
+    df = pandas.read_parquet(output)
+    assert df.shape[0] == 36
+    assert sorted(df.from_id.unique()) == list(range(12))
+
+
+def test_cross_join_jobs_match_nested_loops():
+    points = pandas.DataFrame(
+        {
+            "cluster_id": [3, 1, 4, 5, 9, 2],
+            "MEAN_Y": [47.1, 47.2, 47.3, 47.4, 47.5, 47.6],
+            "MEAN_X": [-122.1, -122.2, -122.3, -122.4, -122.5, -122.6],
+        }
+    )
+    expected = [
+        (o.cluster_id, d.cluster_id, o.MEAN_Y, o.MEAN_X, d.MEAN_Y, d.MEAN_X, DEPARTURE)
+        for _, o in points.iterrows()
+        for _, d in points.iterrows()
+        if o.cluster_id != d.cluster_id
+    ]
+    blocks = cross_join_job_blocks(
+        points.cluster_id.to_numpy(),
+        points.MEAN_Y.to_numpy(),
+        points.MEAN_X.to_numpy(),
+        block_size=7,
+    )
+    assert list(iter_jobs(blocks, DEPARTURE)) == expected
+
+
+def test_pair_jobs_look_up_cluster_coordinates():
+    ids = numpy.array([10, 20, 30])
+    lats = numpy.array([1.0, 2.0, 3.0])
+    lons = numpy.array([-1.0, -2.0, -3.0])
+    blocks = pair_job_blocks(
+        numpy.array([30, 10, 20]), numpy.array([10, 20, 30]), ids, lats, lons, 2
+    )
+    assert list(iter_jobs(blocks, DEPARTURE)) == [
+        (30, 10, 3.0, -3.0, 1.0, -1.0, DEPARTURE),
+        (10, 20, 1.0, -1.0, 2.0, -2.0, DEPARTURE),
+        (20, 30, 2.0, -2.0, 3.0, -3.0, DEPARTURE),
+    ]
+
+
+def run_pairs(tmp_path, endpoint, pairs, **kwargs):
+    clusters = pandas.DataFrame(
+        {
+            "CLUSTER_ID": range(10),
+            "MEAN_Y": [47.0 + i / 100 for i in range(10)],
+            "MEAN_X": [-122.0 - i / 100 for i in range(10)],
+        }
+    )
+    run_otp_itineraries_from_pairs_list(
+        fares_yaml=str(tmp_path / "otp" / "config.yaml"),
+        pairs_df=pairs,
+        clusters=clusters,
+        departure=DEPARTURE,
+        output_folder=str(tmp_path / "chunks"),
+        region_key="TST",
+        chunk_size=5,
+        endpoint=endpoint,
+        batch_size=2,
+        **kwargs,
+    )
+
+
+def test_pairs_runner_resumes_from_manifest(tmp_path):
+    (tmp_path / "otp").mkdir()
+    (tmp_path / "otp" / "config.yaml").write_text("feeds:\n  1: stub-transit\n")
+    (tmp_path / "chunks").mkdir()
+    pairs = pandas.DataFrame(
+        [(o, d) for o in range(10) for d in range(10)], columns=["from_id", "to_id"]
+    )
+
+    with stub_in_thread() as (stub, endpoint):
+        # An interrupted run that only got through the first 40 pairs
+        run_pairs(tmp_path, endpoint, pairs.iloc[:44])
+        assert stub.plans == 40
+        # Damage one chunk, which puts its 5 pairs back in the queue, where the
+        # response cache answers them
+        (tmp_path / "chunks" / "TST_1.parquet").write_bytes(b"truncated")
+        run_pairs(tmp_path, endpoint, pairs)
+        assert stub.plans == 40 + 50
+
+    output = str(tmp_path / "itineraries.parquet")
+    dechunkify(str(tmp_path / "chunks"), output)
+    df = pandas.read_parquet(output)
+    assert df.groupby(["from_id", "to_id"]).size().eq(3).all()
+    assert df.groupby(["from_id", "to_id"]).ngroups == 90
+
+
+def test_pairs_runner_retries_only_empty_pairs(tmp_path):
+    (tmp_path / "otp").mkdir()
+    (tmp_path / "otp" / "config.yaml").write_text("feeds:\n  1: stub-transit\n")
+    (tmp_path / "chunks").mkdir()
+    pairs = pandas.DataFrame(
+        [(o, d) for o in range(5) for d in range(5)], columns=["from_id", "to_id"]
+    )
+
+    with stub_in_thread(empty_every=4) as (stub, endpoint):
+        run_pairs(tmp_path, endpoint, pairs)
+    with stub_in_thread() as (stub, endpoint):
+        run_pairs(tmp_path, endpoint, pairs, retry_failed=True)
+        assert stub.plans == 5
+        run_pairs(tmp_path, endpoint, pairs)
+        assert stub.plans == 5
+
+    manifest = JobManifest(str(tmp_path / "chunks"))
+    assert manifest.count("ok") == 20
+    assert manifest.count("empty", "failed") == 0
+
+
+def test_manifest_filters_blocks_with_repeated_pairs(tmp_path):
+    manifest = JobManifest(str(tmp_path))
+    ok = pandas.DataFrame({"from_id": [0]})
+    empty = pandas.DataFrame()
+    failed = pandas.DataFrame()
+    failed.attrs["failed"] = True
+    # Enough recorded pairs that numpy.isin sorts rather than compares them
+    statuses = {
+        (o, d): [ok, empty, failed][(o + d) % 3]
+        for o in range(8)
+        for d in range(8)
+        if (o * d) % 4 != 1
+    }
+    manifest.record_chunk(0, None, [(pair, legs) for pair, legs in statuses.items()])
+
+    rng = numpy.random.default_rng(0)
+    from_ids = rng.integers(0, 8, 300)
+    to_ids = rng.integers(0, 8, 300)
+    block = {"from_id": from_ids, "to_id": to_ids, "row": numpy.arange(300)}
+    pairs = list(zip(from_ids.tolist(), to_ids.tolist()))
+    done = [p for p, legs in statuses.items() if legs is not failed]
+    retry = [p for p, legs in statuses.items() if legs is not ok]
+
+    (todo,) = manifest.filter_blocks([block])
+    assert todo["row"].tolist() == [i for i, p in enumerate(pairs) if p not in done]
+    (todo,) = manifest.filter_blocks([block], retry_failed=True)
+    assert todo["row"].tolist() == [i for i, p in enumerate(pairs) if p in retry]
+    manifest.close()
+
+
+def closed_endpoint():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    return f"http://127.0.0.1:{port}/otp/routers/default/index/graphql"
+
+
+def test_endpoint_pool_balances_outstanding_requests(tmp_path):
+    with stub_in_thread(latency=0.01) as (a, url_a):
+        with stub_in_thread(latency=0.01) as (b, url_b):
+            client = AsyncOTPClient(
+                FEEDS, endpoint=[url_a, url_b], concurrency=8, batch_size=1
+            )
+            client.run_to_chunks(make_jobs(80), str(tmp_path), "TST", 100)
+
+    assert a.plans + b.plans == 80
+    assert abs(a.plans - b.plans) <= 8
+    report = client.pool.report()
+    assert url_a in report and "<0.05s" in report
+
+
+def test_endpoint_pool_routes_around_dead_instances(tmp_path):
+    dead = closed_endpoint()
+    with stub_in_thread() as (stub, url):
+        client = AsyncOTPClient(
+            FEEDS, endpoint=[dead, url], concurrency=4, batch_size=1, backoff=0.01
+        )
+        client.run_to_chunks(make_jobs(40), str(tmp_path), "TST", 100)
+
+    assert stub.plans == 40
+    assert client.failed == []
+    dead_endpoint = client.pool.endpoints[0]
+    assert not dead_endpoint.healthy
+    assert dead_endpoint.requests <= 4
+
+
+def test_single_endpoint_pool_stays_healthy_after_errors():
+    pool = EndpointPool(["http://only"])
+    endpoint = pool.acquire()
+    pool.release(endpoint, None)
+    assert endpoint.errors == 1 and endpoint.healthy
+    assert pool.available() == [endpoint]
+
+
+def test_endpoint_pool_ejects_slow_instances():
+    pool = EndpointPool(["http://fast", "http://slow"], slow_factor=3)
+    fast, slow = pool.endpoints
+    latencies = {"http://fast": 0.01, "http://slow": 0.025}
+
+    def serve(requests):
+        for _ in range(requests):
+            endpoint = pool.acquire()
+            pool.release(endpoint, latencies[endpoint.url])
+
+    # Idle endpoints take turns, and 2.5 times slower is still within the factor
+    serve(4 * OTP_SLOW_SAMPLES)
+    assert fast.requests == slow.requests == 2 * OTP_SLOW_SAMPLES
+    assert slow.ejected_until == 0
+
+    # The slow endpoint is out once half of its recent requests are too slow
+    latencies["http://slow"] = 0.05
+    serve(OTP_SLOW_SAMPLES)
+    assert slow.ejected_until > time.monotonic()
+    assert slow.requests == 2 * OTP_SLOW_SAMPLES + OTP_SLOW_SAMPLES // 2
+    assert len(slow.recent) == 0
+    assert pool.available() == [fast]
+    serve(10)
+    assert slow.requests == 2 * OTP_SLOW_SAMPLES + OTP_SLOW_SAMPLES // 2
+
+
+def test_endpoint_pool_health_check_restores_instances():
+    async def check(pool):
+        async with aiohttp.ClientSession() as session:
+            await pool.check_health(session)
+
+    with stub_in_thread() as (stub, url):
+        with stub_in_thread(fail_every=1, fail_status=404) as (missing, url_404):
+            pool = EndpointPool([url, closed_endpoint(), url_404])
+            for endpoint in pool.endpoints:
+                endpoint.healthy = False
+            asyncio.run(check(pool))
+
+    # An instance answering with a client error would fail every query too
+    assert [e.healthy for e in pool.endpoints] == [True, False, False]